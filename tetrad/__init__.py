@@ -5,14 +5,14 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_cors import CORS, cross_origin
 from firebase_admin import initialize_app
-from tetrad import utils 
 from os import getenv, environ
-import google.cloud.logging 
-gcloud_logging_client = google.cloud.logging.Client()
-gcloud_logging_client.get_default_handler()
-gcloud_logging_client.setup_logging()
 import logging
 
+# One Cloud Logging client and a queued, batched handler for the whole process
+from tetrad import log_shipping
+log_shipping.setup()
+from tetrad import utils
+
 logging.error("Inside __init__.py setup")
 
 # app = Flask(__name__)
@@ -40,3 +40,7 @@ cache = Cache(app)
 
 # Load our many route files
 from tetrad import api_routes, basic_routes, fb_routes, ota_routes
+
+# /_ah/warmup
+from tetrad import warmup
+warmup.install(app)
@@ -9,10 +9,8 @@ from os import getenv
 from flask import request
 import re
 import base64
-import google.cloud.logging 
-gcloud_logging_client = google.cloud.logging.Client()
-gcloud_logging_client.get_default_handler()
-gcloud_logging_client.setup_logging()
+from time import time
+from tetrad.api_consts import *
 import logging
 
 
@@ -86,21 +84,45 @@ def ingroup(group_or_groups):
     return inner 
 
 
+_sm_client = None
+_gs_client = None
+_secrets = {}   # (secret_id, version_id) -> (payload, fetched)
+
+
+def _secretClient():
+    """One Secret Manager client per process, created on first use"""
+    global _sm_client
+    if _sm_client is None:
+        _sm_client = secretmanager.SecretManagerServiceClient()
+    return _sm_client
+
+
+def _gsClient():
+    """One Storage client per process, created on first use"""
+    global _gs_client
+    if _gs_client is None:
+        _gs_client = storage.Client()
+    return _gs_client
+
+
 def _access_secret_version(secret_id, version_id="latest"):
     """
     Access the payload for the given secret version if one exists. The version
     can be a version number as a string (e.g. "5") or an alias (e.g. "latest").
+    Numbered versions never change and are kept for good; aliases are
+    re-read after SECRET_CACHE_TTL_SEC.
     """
-
-    # Create the Secret Manager client.
-    client = secretmanager.SecretManagerServiceClient()
+    cached = _secrets.get((secret_id, version_id))
+    if cached is not None and (version_id.isdigit() or time() - cached[1] < SECRET_CACHE_TTL_SEC):
+        return cached[0]
 
     # Build the resource name of the secret version.
     name = f"projects/{getenv('GOOGLE_CLOUD_PROJECT')}/secrets/{secret_id}/versions/{version_id}"
 
     # Access the secret version.
-    response = client.access_secret_version(request={"name": name})
+    response = _secretClient().access_secret_version(request={"name": name})
     json_response = json.loads(response.payload.data.decode("UTF-8"))
+    _secrets[(secret_id, version_id)] = (json_response, time())
     return json_response
 
 
@@ -163,8 +185,7 @@ def gs_get_blob(bucket_name, source_blob_name, dnl_type):
     Download blob from GS bucket into bytes object
     @parm dnl_type: one of "string", "text", "bytes"
     """
-    c = storage.Client()
-    bucket = c.bucket(bucket_name)
+    bucket = _gsClient().bucket(bucket_name)
     blob = bucket.blob(source_blob_name)
     try:
         if dnl_type == "string":
@@ -16,6 +16,89 @@ BQ_LABEL_GLOBAL = getenv("BQ_LABEL_BADGPS")
 SPACE_KERNEL_FACTOR_PADDING = float(getenv("SPACE_KERNEL_FACTOR_PADDING"))
 TIME_KERNEL_FACTOR_PADDING = float(getenv("TIME_KERNEL_FACTOR_PADDING"))
 
+# /liveSensors in-memory snapshot (see live_snapshot.py)
+LIVE_SNAPSHOT_WINDOW_MIN = int(getenv("LIVE_SNAPSHOT_WINDOW_MIN", 60))
+LIVE_SNAPSHOT_REFRESH_SEC = int(getenv("LIVE_SNAPSHOT_REFRESH_SEC", 60))
+LIVE_SNAPSHOT_OVERLAP_SEC = int(getenv("LIVE_SNAPSHOT_OVERLAP_SEC", 120))
+
+# Rows per page (and per chunk) for streamed /requestData responses
+STREAM_PAGE_SIZE = int(getenv("STREAM_PAGE_SIZE", 10000))
+
+# How query results are read: "rows" (Row -> dict) or "arrow" (Storage Read API column batches)
+BQ_FETCH_ENGINE = getenv("BQ_FETCH_ENGINE", "rows")
+
+# /requestData result cache (see result_cache.py). Rows older than
+# INGEST_LAG_SEC are assumed final and cached for the long TTL.
+INGEST_LAG_SEC = int(getenv("INGEST_LAG_SEC", 3600))
+RESULT_CACHE_MAX_BYTES = int(getenv("RESULT_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+RESULT_CACHE_TTL_HISTORICAL_SEC = int(getenv("RESULT_CACHE_TTL_HISTORICAL_SEC", 24 * 3600))
+RESULT_CACHE_TTL_RECENT_SEC = int(getenv("RESULT_CACHE_TTL_RECENT_SEC", 60))
+
+# Long /requestData ranges are split into day-aligned sub-queries run in parallel
+PARALLEL_QUERY_WORKERS = int(getenv("PARALLEL_QUERY_WORKERS", 8))
+# Sub-query threads shared by all requests in a worker process
+PARALLEL_QUERY_POOL_SIZE = int(getenv("PARALLEL_QUERY_POOL_SIZE", 16))
+PARALLEL_QUERY_MIN_RANGE_HOURS = int(getenv("PARALLEL_QUERY_MIN_RANGE_HOURS", 48))
+PARALLEL_QUERY_PREFETCH_PAGES = int(getenv("PARALLEL_QUERY_PREFETCH_PAGES", 2))
+
+# BigQuery cost control (see bq_utils.py). Per-endpoint budgets are
+# BQ_BYTE_BUDGET_<ENDPOINT>, e.g. BQ_BYTE_BUDGET_REQUESTDATA
+BQ_BYTE_BUDGET_DEFAULT = int(getenv("BQ_BYTE_BUDGET_DEFAULT", 10 * 1024**3))
+BQ_HEAVY_QUERY_BYTES = int(getenv("BQ_HEAVY_QUERY_BYTES", 2 * 1024**3))
+BQ_HEAVY_QUERY_SLOTS = int(getenv("BQ_HEAVY_QUERY_SLOTS", 2))
+BQ_HEAVY_QUERY_QUEUE_SEC = int(getenv("BQ_HEAVY_QUERY_QUEUE_SEC", 60))
+
+# Identical queries within this many seconds share one BigQuery job (see single_flight.py)
+SINGLE_FLIGHT_TTL_SEC = int(getenv("SINGLE_FLIGHT_TTL_SEC", 10))
+SINGLE_FLIGHT_DIR = getenv("SINGLE_FLIGHT_DIR", "/tmp/tetrad-single-flight")
+
+# Cursor pagination for /requestData (see pagination.py)
+PAGE_LIMIT_MAX = int(getenv("PAGE_LIMIT_MAX", 100000))
+# Secret Manager secret holding the page-token signing key. Unset turns pagination off
+PAGE_TOKEN_SECRET = getenv("PAGE_TOKEN_SECRET")
+
+# Rolling in-memory window of recent telemetry for /requestData (see ring_buffer.py). 0 hours disables it
+RING_BUFFER_HOURS = int(getenv("RING_BUFFER_HOURS", 24))
+RING_BUFFER_REFRESH_SEC = int(getenv("RING_BUFFER_REFRESH_SEC", 60))
+
+# Device position index for pruning box/radius queries (see device_index.py)
+DEVICE_INDEX_LOOKBACK_DAYS = int(getenv("DEVICE_INDEX_LOOKBACK_DAYS", 30))
+DEVICE_INDEX_REFRESH_SEC = int(getenv("DEVICE_INDEX_REFRESH_SEC", 600))
+DEVICE_INDEX_CELL_DEG = float(getenv("DEVICE_INDEX_CELL_DEG", 0.25))
+DEVICE_INDEX_MAX_IDS = int(getenv("DEVICE_INDEX_MAX_IDS", 5000))
+
+# How often REGION_INFO in GCS is revalidated (conditional GET, see gcs_config.py)
+REGION_INFO_REFRESH_SEC = int(getenv("REGION_INFO_REFRESH_SEC", 300))
+
+# How often the correction factors in GCS are revalidated (see utils.correctionFactors)
+CORRECTION_FACTORS_REFRESH_SEC = int(getenv("CORRECTION_FACTORS_REFRESH_SEC", 300))
+
+# Secret Manager payloads read through an alias ("latest") are re-read after this long
+SECRET_CACHE_TTL_SEC = int(getenv("SECRET_CACHE_TTL_SEC", 3600))
+
+# Run the warmup steps (see warmup.py) in every worker as soon as it starts
+WARMUP_ON_START = getenv("WARMUP_ON_START", "1") == "1"
+
+# Bad-value flags/thresholds for cleaning (see cleaning.py), parsed once
+PM_BAD_FLAG = float(getenv("PM_BAD_FLAG", -1))
+PM_BAD_THRESH = float(getenv("PM_BAD_THRESH", 500))
+TEMP_BAD_FLAG = float(getenv("TEMP_BAD_FLAG", -1000))
+HUM_BAD_FLAG = float(getenv("HUM_BAD_FLAG", -1000))
+
+# Do /requestData's bad-value handling and PM2.5 correction in BigQuery (query_compiler.cleanedSource)
+BQ_CLEAN_IN_SQL = getenv("BQ_CLEAN_IN_SQL", "0") == "1"
+
+# Log shipping (see log_shipping.py): records queued per worker before drops, and transport batching
+LOG_QUEUE_SIZE = int(getenv("LOG_QUEUE_SIZE", 10000))
+LOG_BATCH_SIZE = int(getenv("LOG_BATCH_SIZE", 500))
+LOG_MAX_LATENCY_SEC = float(getenv("LOG_MAX_LATENCY_SEC", 1.0))
+
+# /gridData spatial aggregation (see spatial_grid.py)
+GRID_BUCKET_SEC = int(getenv("GRID_BUCKET_SEC", 3600))
+GRID_MAX_BUCKETS = int(getenv("GRID_MAX_BUCKETS", 744))
+GRID_LATLON_RES_MIN = float(getenv("GRID_LATLON_RES_MIN", 0.001))
+GRID_S2_LEVEL_MAX = int(getenv("GRID_S2_LEVEL_MAX", 20))
+
 Q_ALL_SOURCES = "all"
 Q_ALL_GPS_SOURCES = "allgps"
 
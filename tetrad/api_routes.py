@@ -1,12 +1,21 @@
 from datetime import datetime, timedelta
 import pytz
-from flask import request, jsonify, render_template
+from flask import request, jsonify, render_template, g
 import functools
-from google.cloud.bigquery import Client as BQClient, QueryJobConfig, ScalarQueryParameter
-from tetrad import app, cache, admin_utils, limiter, utils
+import itertools
+from google.cloud.bigquery import ScalarQueryParameter
+from tetrad import app, cache, admin_utils, limiter, utils, bq_utils
 from tetrad.api_consts import *
-from tetrad.classes import ArgumentError, NoDataError
-# from tetrad import gaussian_model_utils
+from tetrad.bq_utils import bq_client
+from tetrad.classes import ArgumentError, NoDataError, QueryCostError
+from tetrad.live_snapshot import LiveSnapshot
+from tetrad.ring_buffer import TelemetryBuffer
+from tetrad.device_index import DeviceIndex
+from tetrad import streaming, columnar, result_cache, parallel_query, query_compiler, pagination
+from tetrad import spatial_grid, warmup, log_shipping, cleaning
+from tetrad.lazy_import import lazyModule
+# torch/scipy load on first use, only in workers that run estimation
+gaussian_model_utils = lazyModule('tetrad.gaussian_model_utils')
 import json
 import numpy as np 
 from os import getenv
@@ -14,10 +23,6 @@ from os import getenv
 import re 
 import requests
 from time import time 
-import google.cloud.logging 
-gcloud_logging_client = google.cloud.logging.Client()
-gcloud_logging_client.get_default_handler()
-gcloud_logging_client.setup_logging()
 import logging
 
 
@@ -39,7 +44,52 @@ def handle_nodata_error(error):
     return response
 
 
-bq_client = BQClient()
+@app.errorhandler(QueryCostError)
+def handle_query_cost_error(error):
+    d = error.to_dict()
+    d['message'] += ' For more information, please visit: https://github.com/tetradsensors/tetrad_site'
+    response = jsonify(d)
+    response.status_code = error.status_code
+    return response
+
+
+def wait_for_region_info(f):
+    """
+    Decorator for routes that read REGION_INFO. It loads in the background;
+    only requests to these routes arriving before it has wait here.
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            utils.region_config.wait()
+        except Exception as e:
+            logging.error(f"REGION_INFO is not available: {repr(e)}")
+            return "Region info is not available right now. Try again shortly.", 503
+        return f(*args, **kwargs)
+    return wrapper
+
+
+@app.after_request
+def add_bytes_estimate_header(response):
+    """Let clients see how much BigQuery scanning their request cost"""
+    if 'bq_bytes_estimate' in g:
+        response.headers['X-BigQuery-Bytes-Estimate'] = str(g.bq_bytes_estimate)
+    return response
+
+
+@app.after_request
+def add_correction_factors_header(response):
+    """Calibration version the response's PM2.5 was corrected with, so clients can invalidate on change"""
+    if 'correction_factors_version' in g:
+        response.headers['X-Correction-Factors'] = g.correction_factors_version
+    return response
+
+
+live_snapshot = LiveSnapshot(bq_client)
+telemetry_buffer = TelemetryBuffer(bq_client)
+device_index = DeviceIndex(bq_client)
+request_data_cache = result_cache.ResultCache('requestData')
+grid_cache = result_cache.ResultCache('gridData')
 
 @app.route('/', subdomain=getenv('SUBDOMAIN_API'))
 def home():
@@ -53,6 +103,7 @@ def home():
 @app.route("/liveSensors", methods=["GET"], subdomain=getenv('SUBDOMAIN_API'))
 # @app.route("/liveSensors", methods=["GET"])
 # @cache.cached(timeout=119)
+@wait_for_region_info
 def liveSensors():
 
     def argParseDelta(delta):
@@ -75,103 +126,46 @@ def liveSensors():
         srcs   = utils.argParseSources(request.args.get('src', type=str))
         fields = utils.argParseFields(request.args.get('field', type=str))
         delta  = argParseDelta(request.args.get('delta', type=int))
+        fmt    = utils.argParseFormat(request.args.get('format', type=str), streaming.availableFormats())
     except ArgumentError:
         raise
 
     #################################
-    # Query Builder
+    # Snapshot
     #################################
 
-    Q_FIELDS = utils.queryBuildFields(fields)
-    Q_LABELS = utils.queryBuildLabels(srcs)
-    # Build the query
-    SUBQ = f"""SELECT 
-                    {Q_FIELDS}
-                FROM 
-                    `{BQ_PATH_TELEMETRY}`
-                WHERE 
-                    {Q_LABELS}
-                        AND
-                    {FIELD_MAP["TIMESTAMP"]} >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {delta} MINUTE)
-            """
-
-    # Build the full query
-    q = f"""
-    SELECT 
-        * EXCEPT(row_num)
-    FROM
-        (
-            SELECT 
-                *, 
-                ROW_NUMBER() 
-            OVER
-                (
-                    PARTITION BY 
-                        {FIELD_MAP["DEVICEID"]} 
-                    ORDER BY 
-                        {FIELD_MAP["TIMESTAMP"]} DESC
-                ) row_num
-            FROM 
-                (
-                    {SUBQ}
-                )
-        )
-    WHERE 
-        row_num = 1;
-    """
-
-    # TODO: Tom added this manually as a quick fix to the huge bigquery cost
-    query = """
-    SELECT 
-        * EXCEPT(row_num)
-    FROM
-        (
-            SELECT 
-                *, 
-                ROW_NUMBER() 
-            OVER
-                (
-                    PARTITION BY 
-                        DeviceID 
-                    ORDER BY 
-                        Timestamp DESC
-                ) row_num
-            FROM 
-                (
-                    SELECT 
-                      DeviceID, 
-                      Timestamp,
-                      Source,
-                      Label,
-                      ST_Y(GPS) AS Latitude, 
-                      ST_X(GPS) AS Longitude,
-                      PM2_5
-                    FROM 
-                      `tetrad-296715.telemetry.telemetry`
-                    WHERE 
-                    (
-                      Label = 'slc_ut' OR Label = 'chatt_tn' OR Label = 'kc_mo' OR Label = 'clev_oh' OR Label = 'global' OR Label = 'pv_ma'
-                    )
-                      AND
-                    Timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 15 MINUTE)
-                )
-        )
-    WHERE 
-        row_num = 1;
-    """
-    query_job = bq_client.query(query=query)
-    rows = query_job.result()
-
-    data = [dict(r) for r in rows]
+    # Anything inside the snapshot window is answered from memory.
+    # Only unusually large 'delta' values still go to BigQuery.
+    if delta <= live_snapshot.window_min:
+        live_snapshot.start()
+        data = live_snapshot.latest(srcs, fields, delta)
+    else:
+        data = _liveSensorsQuery(srcs, fields, delta)
 
     # Clean data and apply correction factors
     data = utils.tuneAllFields(data, fields)
 
+    fmt = fmt or streaming.negotiateFormat(request.accept_mimetypes)
+    if fmt:
+        return streaming.streamResponse([data], fmt=fmt, columns=utils.columnKinds(fields))
     return jsonify(data), 200
 
+
+def _liveSensorsQuery(srcs, fields, delta):
+    """
+    Latest row per device straight from BigQuery. Only used when 'delta'
+    reaches further back than the live snapshot keeps.
+    """
+    query, params = query_compiler.liveSensorsQuery(srcs, fields, delta)
+    query_job = bq_utils.runQuery(query, params, endpoint="liveSensors")
+    rows = query_job.result()
+
+    return [dict(r) for r in rows]
+
 # https://api.tetradsensors.com/requestData?src=slc_ut&field=pm2_5&start=2021-01-01T00:00:00Z&end=2021-01-22T00:00:00Z
 @app.route("/requestData", methods=["GET"], subdomain=getenv('SUBDOMAIN_API'))
 # @app.route("/requestData", methods=["GET"])
+@wait_for_region_info
 def requestData():
     """
     Arguments:
@@ -183,8 +177,19 @@ def requestData():
     @param: box     (optional)  List of coordinates in this order: North, South, East, West
     @param: radius  (optional)  Radius in kilometers
     @param: center  (optional)  Required if 'radius' is supplied. Lat,Lon center of radius. &center=42.012,-111.423&
+    @param: stream  (optional)  'true'/'json' or 'ndjson'. Send the result page-by-page as a chunked response
+    @param: format  (optional)  json, ndjson, columns, csv, msgpack or parquet (also picked from the Accept header).
+                                Implies streaming
+    @param: limit   (optional)  Rows per page. Returns the first page plus an X-Page-Token header
+    @param: page_token (optional) X-Page-Token from a previous response. Only 'page' and 'format' are needed with it
+    @param: page    (optional)  0-based page number to read with 'page_token'
+    @param: agg     (optional)  Aggregate each device's rows into buckets of this size: 30s, 5m, 1h, 1d...
+    @param: fn      (optional)  Aggregate function with 'agg': mean (default), median, min, max, count
     """
 
+    if 'page_token' in request.args:
+        return _requestDataNextPage()
+
     args = [
         'src',
         'field',
@@ -193,7 +198,12 @@ def requestData():
         'device',
         'box',
         'radius',
-        'center'
+        'center',
+        'stream',
+        'format',
+        'limit',
+        'agg',
+        'fn',
     ]
 
     req_args = [
@@ -220,6 +230,11 @@ def requestData():
         rc      = utils.argParseRadiusArgs(
                     request.args.get('radius', type=float),
                     request.args.get('center', type=str))
+        stream  = utils.argParseStream(request.args.get('stream', type=str))
+        fmt     = utils.argParseFormat(request.args.get('format', type=str), streaming.availableFormats())
+        limit   = utils.argParseLimit(request.args.get('limit', type=int))
+        agg     = utils.argParseAgg(request.args.get('agg', type=str))
+        fn      = utils.argParseAggFn(request.args.get('fn', type=str), agg, list(query_compiler.AGG_FUNCTIONS))
     except ArgumentError as e:
         raise
     except Exception as e:
@@ -229,26 +244,115 @@ def requestData():
     #################################
     # Query Picker
     #################################
-    data = None
     if box and rc:
         raise ArgumentError("Must choose either 'box' or 'radius','center' arguments", status_code=400)
     elif rc:
-        data = _requestData(srcs, fields, start, end, radius=rc[0], center=rc[1], id_ls=devices)
+        region = dict(radius=rc[0], center=rc[1])
     else:
-        data = _requestData(srcs, fields, start, end, bbox=box, id_ls=devices)
+        region = dict(bbox=box)
+    region.update(agg=agg, fn=fn)
+
+    fmt = fmt or stream or streaming.negotiateFormat(request.accept_mimetypes)
+
+    # PM2.5 corrected in SQL is only good for the calibration it was corrected with
+    corrections = utils.correctionFactors().version if BQ_CLEAN_IN_SQL and "PM2_5" in fields else None
+
+    if limit:
+        return _requestDataFirstPage(srcs, fields, start, end, devices, region, fmt, limit)
 
-    if isinstance(data, int):
-        if data == 408:
-            return "Timeout (2 minutes). Try a smaller query.", 408
+    return _requestDataCached(srcs, fields, start, end, devices, region, fmt, corrections)
+
+
+def _requestDataNextPage():
+    """/requestData?page_token=...&page=N[&format=...]"""
+    args = [
+        'page_token',
+        'page',
+        'format',
+        'stream',
+    ]
+
+    try:
+        utils.verifyPossibleArgs(request.args, args)
+        token   = request.args.get('page_token', type=str)
+        page    = utils.argParsePage(request.args.get('page', type=int))
+        stream  = utils.argParseStream(request.args.get('stream', type=str))
+        fmt     = utils.argParseFormat(request.args.get('format', type=str), streaming.availableFormats())
+    except ArgumentError:
+        raise
+
+    job_id, location, limit = pagination.decodeToken(token)
+    data, total_rows = pagination.readPage(bq_client, job_id, location, page, limit)
+    fmt = fmt or stream or streaming.negotiateFormat(request.accept_mimetypes)
+    return _pageResponse(data, fmt, pagination.pageHeaders(token, page, limit, total_rows))
+
+
+def _requestDataFirstPage(srcs, fields, start, end, devices, region, fmt, limit):
+    """/requestData?...&limit=N: run once, answer with page 0 and an X-Page-Token for the rest"""
+    # Run once; this and every later page is read from the job's results table
+    pagination.checkAvailable()
+    pruned = _pruneDevices(start, end, bbox=region.get('bbox'), radius=region.get('radius'),
+                           center=region.get('center'), id_ls=devices)
+    query_job = _requestDataJob(srcs, fields, start, end, id_ls=pruned, labels=pagination.PAGE_JOB_LABEL,
+                                **region)
+    query_job.result()
+    token = pagination.encodeToken(query_job, limit)
+    data, total_rows = pagination.readPage(bq_client, query_job.job_id, query_job.location, 0, limit)
+    if total_rows == 0:
+        raise NoDataError("No data returned.", status_code=222)
+    return _pageResponse(data, fmt, pagination.pageHeaders(token, 0, limit, total_rows),
+                         columns=utils.columnKinds(fields, region.get('fn')))
+
+
+def _requestDataCached(srcs, fields, start, end, devices, region, fmt, corrections):
+    """/requestData without 'limit': answer from the result cache, or query, stream and fill it"""
+    cache_key = result_cache.canonicalKey(
+        'requestData', srcs=srcs, fields=fields, start=start, end=end, id_ls=devices, corrections=corrections,
+        **region)
+    cache_ttl = request_data_cache.ttlFor(end)
+    data = request_data_cache.get(cache_key)
+    cache_status = 'HIT' if data is not None else 'MISS'
+
+    stream = fmt
+    if stream:
+        if data is not None:
+            pages = [data]
         else:
-            return "Something went wrong. That's all we know. Contact the developers.", data
+            pages = _requestDataPages(srcs, fields, start, end, id_ls=devices, **region)
+            pages = result_cache.cachePages(pages, request_data_cache, cache_key, cache_ttl)
+        response = streaming.streamResponse(pages, fmt=stream, columns=utils.columnKinds(fields, region.get('fn')))
+        response.headers['X-Cache'] = cache_status
+        return response
+
+    if data is None:
+        data = _requestData(srcs, fields, start, end, id_ls=devices, **region)
+
+        if isinstance(data, int):
+            if data == 408:
+                return "Timeout (2 minutes). Try a smaller query.", 408
+            else:
+                return "Something went wrong. That's all we know. Contact the developers.", data
+
+        request_data_cache.put(cache_key, data, result_cache.estimateSize(data), cache_ttl)
 
     response = jsonify(data)
     response.status_code = 200
+    response.headers['X-Cache'] = cache_status
     return response
 
 
-def _requestData(srcs, fields, start, end, bbox=None, radius=None, center=None, id_ls=None, removeNulls=False):
+def _pageResponse(data, fmt, headers, columns=None):
+    if fmt:
+        response = streaming.streamResponse([data], fmt=fmt, columns=columns)
+    else:
+        response = jsonify(data)
+        response.status_code = 200
+    response.headers.extend(headers)
+    return response
+
+
+def _requestData(srcs, fields, start, end, bbox=None, radius=None, center=None, id_ls=None, removeNulls=False,
+                 agg=None, fn=None):
     """
     Function to query a field (like Temperature, Humidity, PM, etc.) 
     or list of fields, in date range [start, end], inside a bounding
@@ -257,61 +361,145 @@ def _requestData(srcs, fields, start, end, bbox=None, radius=None, center=None,
     If radius, radius is in meters, center is dict {'lat', 'lon'}
     Can include an ID or a list of IDs
     """
+    pages = _requestDataPages(srcs, fields, start, end, bbox=bbox, radius=radius, center=center, id_ls=id_ls,
+                              agg=agg, fn=fn)
 
-    if id_ls:
-        query_devs = utils.idsToWHEREClause(id_ls, FIELD_MAP['DEVICEID'])
-    else:
-        query_devs = "True"
-
-    query_fields = utils.queryBuildFields(fields)
-
-    if bbox:
-        n, s, e, w = bbox['lat_hi'], bbox['lat_lo'], bbox['lon_hi'], bbox['lon_lo']
-        query_region = f"""
-            ST_WITHIN(
-                {FIELD_MAP["GPS"]}, 
-                ST_GeogFromGeoJSON(
-                    '{{"type": "Polygon", "coordinates": [[[{e},{n}],[{e},{s}],[{w},{s}],[{w},{n}],[{e},{n}]]]}}'
-                )
-            )
-        """
-    elif radius:
-        query_region = f"""
-            ST_DWITHIN(
-                {FIELD_MAP["GPS"]}, 
-                ST_GEOGPOINT({center['lon']}, {center['lat']}),
-                {radius * 1000}
-            )
-        """
-    else:
-        query_region = "True"
-
-    query_labels = utils.queryBuildLabels(srcs)
-    QUERY = f"""
-        SELECT 
-            {query_fields}
-        FROM 
-            `{BQ_PATH_TELEMETRY}` 
-        WHERE 
-            {query_labels}
-                AND
-            {FIELD_MAP["TIMESTAMP"]} >= "{start}"
-                AND
-            {FIELD_MAP["TIMESTAMP"]} <= "{end}"
-                AND
-            {query_region}
-                AND
-            {query_devs}
-        ORDER BY
-            {FIELD_MAP["TIMESTAMP"]}
+    # # Convert Response object (generator) to list-of-dicts
+    data = [r for page in pages for r in page]
+
+    # # Clean data and apply correction factors
+    # data = utils.tuneAllFields(data, fields, removeNulls=removeNulls)
+
+    # Apply correction factors to data
+    
+    return data
+
+
+def _iterResultPages(rows, fields=None, tune=False):
+    """
+    Pages (lists of dicts) of a RowIterator, read with the configured
+    BQ_FETCH_ENGINE: "rows" (one Row at a time) or "arrow" (column batches).
+    With 'tune', bad values are cleaned and PM2.5 corrected in Python, per page
+    (column-wise on the arrow engine), for results the query didn't clean.
+    """
+    if BQ_FETCH_ENGINE == "arrow" and columnar.available():
+        return columnar.iterColumnPages(rows, fields=fields, tune=tune, batch_size=STREAM_PAGE_SIZE)
+    pages = streaming.iterPages(rows)
+    if tune:
+        return (utils.tuneAllFields(page, fields) for page in pages)
+    return pages
+
+
+def _requestDataPages(srcs, fields, start, end, bbox=None, radius=None, center=None, id_ls=None, agg=None, fn=None):
+    """
+    Pages (lists of dicts) of the /requestData result in Timestamp order.
+    The recent part of the range, up to the buffer's last refresh, comes from
+    the in-memory telemetry buffer (ring_buffer.py); what is older than the
+    buffer goes to BigQuery, and so does anything newer if the buffer is stale.
+    """
+    telemetry_buffer.start()
+    before, buffered, after = telemetry_buffer.route(start, end, fields, agg=agg)
+    region = dict(bbox=bbox, radius=radius, center=center)
+
+    if buffered is None:
+        return _requestDataBQPages(srcs, fields, start, end, id_ls=id_ls, agg=agg, fn=fn, **region)
+
+    # [start, covered_from) and, if the buffer is stale, (covered_until, end] from BigQuery; the middle from the buffer
+    parts = []
+    if before is not None:
+        parts.append(lambda: _requestDataBQPages(srcs, fields, *before, id_ls=id_ls, end_exclusive=True, **region))
+    parts.append(lambda: telemetry_buffer.pages(srcs, fields, *buffered, id_ls=id_ls, clean=True, **region))
+    if after is not None:
+        parts.append(lambda: _requestDataBQPages(srcs, fields, *after, id_ls=id_ls, **region))
+
+    pages = []
+    for part in parts:
+        try:
+            pages.append(part())
+        except NoDataError:
+            pass
+    if not pages:
+        raise NoDataError("No data returned.", status_code=222)
+    return itertools.chain.from_iterable(pages)
+
+
+def _requestDataBQPages(srcs, fields, start, end, bbox=None, radius=None, center=None, id_ls=None, agg=None, fn=None,
+                        end_exclusive=False):
+    """
+    Pages of the /requestData result straight from BigQuery.
+    Long ranges run as parallel day-aligned sub-queries (parallel_query.py).
     """
+    id_ls = _pruneDevices(start, end, bbox=bbox, radius=radius, center=center, id_ls=id_ls)
+
+    def fetch_pages(sub_start, sub_end, end_exclusive=False, estimate=True):
+        rows = _requestDataRows(srcs, fields, sub_start, sub_end, bbox=bbox, radius=radius, center=center,
+                                id_ls=id_ls, page_size=STREAM_PAGE_SIZE, end_exclusive=end_exclusive,
+                                estimate=estimate, agg=agg, fn=fn)
+        # Aggregated buckets can only be cleaned before aggregating, i.e. in SQL
+        return _iterResultPages(rows, fields=fields, tune=not BQ_CLEAN_IN_SQL and not agg)
+
+    # Day-aligned splits only keep aggregation buckets whole if a bucket divides a day
+    if parallel_query.shouldSplit(start, end) and (not agg or 86400 % agg == 0):
+        # Admit the range as a whole here, in the request thread; the sub-queries then run without
+        # their own dry runs, and a heavy range holds one heavy-query slot until its pages are merged.
+        QUERY, params = query_compiler.requestDataQuery(
+            srcs, fields, start, end, bbox=bbox, radius=radius, center=center, id_ls=id_ls,
+            end_exclusive=end_exclusive, agg=agg, fn=fn)
+        nbytes = bq_utils.estimateBytes(QUERY, params)
+        bq_utils.recordEstimate(nbytes)
+        bq_utils.admit("requestData", nbytes)
+        heavy = bq_utils.acquireHeavySlot(nbytes)
+        try:
+            pages = parallel_query.mergedPages(lambda s, e, x: fetch_pages(s, e, end_exclusive=x, estimate=False),
+                                               start, end, end_exclusive=end_exclusive)
+        except BaseException:
+            if heavy:
+                bq_utils.releaseHeavySlot()
+            raise
+        return bq_utils.HeavySlotPages(pages) if heavy else pages
+    return fetch_pages(start, end, end_exclusive=end_exclusive)
+
+
+def _pruneDevices(start, end, bbox=None, radius=None, center=None, id_ls=None):
+    """
+    Narrow a box/radius query to the devices that have been inside the region
+    (device_index.py). Returns the device list to filter on, or 'id_ls' unchanged.
+    """
+    device_index.start()
+    pruned = device_index.prune(start, end, bbox=bbox, radius=radius, center=center, id_ls=id_ls)
+    if pruned is not None and not pruned:
+        raise NoDataError("No data returned.", status_code=222)
+    return pruned
+
+
+def _requestDataJob(srcs, fields, start, end, bbox=None, radius=None, center=None, id_ls=None,
+                    end_exclusive=False, estimate=True, agg=None, fn=None, labels=None):
+    """Start the /requestData query and return its QueryJob. 'labels' are set on the job"""
+    QUERY, params = query_compiler.requestDataQuery(
+        srcs, fields, start, end, bbox=bbox, radius=radius, center=center, id_ls=id_ls, end_exclusive=end_exclusive,
+        agg=agg, fn=fn)
 
     # data = ' '.join([i for i in QUERY.replace('\n', ' ').split(' ') if i])
 
+    return bq_utils.runQuery(QUERY, params, endpoint="requestData", estimate=estimate,
+                             **({'labels': labels} if labels else {}))
+
+
+def _requestDataRows(srcs, fields, start, end, bbox=None, radius=None, center=None, id_ls=None, page_size=None,
+                     end_exclusive=False, estimate=True, agg=None, fn=None):
+    """
+    Run the /requestData query and return the BigQuery RowIterator
+    without materializing it. 'page_size' controls how many rows
+    each page (and each streamed chunk) holds. With 'end_exclusive'
+    the range is [start, end) instead of [start, end]. 'estimate=False'
+    skips the dry run/admission (see bq_utils.runQuery).
+    """
+    query_job = _requestDataJob(srcs, fields, start, end, bbox=bbox, radius=radius, center=center, id_ls=id_ls,
+                                end_exclusive=end_exclusive, estimate=estimate, agg=agg, fn=fn)
+
     # Run the query and collect the result
     # try:
-    query_job = bq_client.query(QUERY)
-    rows = query_job.result()   
+    rows = query_job.result(page_size=page_size)
     # except Exception as e:
     #     print(str(e))
     #     return 408
@@ -319,16 +507,105 @@ def _requestData(srcs, fields, start, end, bbox=None, radius=None, center=None,
     # # break on empty iterator
     if rows.total_rows == 0:
         raise NoDataError("No data returned.", status_code=222)
-        
-    # # Convert Response object (generator) to list-of-dicts
-    data = [dict(r) for r in rows]
 
-    # # Clean data and apply correction factors
-    # data = utils.tuneAllFields(data, fields, removeNulls=removeNulls)
+    return rows
 
-    # Apply correction factors to data
-    
-    return data
+
+# https://api.tetradsensors.com/gridData?src=allgps&field=pm2_5&start=2021-01-01T00:00:00Z&end=2021-01-02T00:00:00Z&res=0.05
+@app.route("/gridData", methods=["GET"], subdomain=getenv('SUBDOMAIN_API'))
+@wait_for_region_info
+def gridData():
+    """
+    Per-cell statistics for map overviews. One row per (time bucket, cell):
+    Timestamp, Cell, Latitude, Longitude, Count, Mean, Max, Devices
+
+    Arguments:
+    @param: src     (required)
+    @param: field   (required)  A single numeric field
+    @param: start   (required)
+    @param: end     (required)
+    @param: grid    (optional)  'latlon' (default) or 's2'
+    @param: res     (optional)  Cell size in degrees for 'latlon' (default 0.01), S2 level for 's2' (default 12)
+    @param: region  (optional)  Only use readings inside this region's bounds, e.g. slc_ut
+    @param: agg     (optional)  Time bucket size: 30m, 1h (default), 1d... Buckets are aligned to the epoch
+    @param: format  (optional)  json, ndjson, columns, csv, msgpack or parquet
+    """
+
+    args = [
+        'src',
+        'field',
+        'start',
+        'end',
+        'grid',
+        'res',
+        'region',
+        'agg',
+        'format',
+    ]
+
+    req_args = [
+        'src',
+        'field',
+        'start',
+        'end',
+    ]
+
+    try:
+        utils.verifyArgs(request.args, req_args, args)
+        srcs      = utils.argParseSources(request.args.get('src', type=str))
+        field     = utils.argParseNumericField(request.args.get('field', type=str))
+        start     = utils.argParseDatetime(request.args.get('start', type=str))
+        end       = utils.argParseDatetime(request.args.get('end', type=str))
+        grid, res = utils.argParseGrid(request.args.get('grid', type=str), request.args.get('res', type=str))
+        region    = utils.argParseRegion(request.args.get('region', type=str))
+        bucket    = utils.argParseAgg(request.args.get('agg', type=str)) or GRID_BUCKET_SEC
+        fmt       = utils.argParseFormat(request.args.get('format', type=str), streaming.availableFormats())
+    except ArgumentError:
+        raise
+
+    if end <= start:
+        raise ArgumentError("Argument 'end' must be after 'start'", status_code=400)
+
+    def fetch(lo, hi):
+        query, params = query_compiler.gridQuery(srcs, field, lo, hi, grid, res, bucket, region=region)
+        return [dict(r) for r in bq_utils.runQuery(query, params, endpoint="gridData").result()]
+
+    buckets = spatial_grid.bucketStarts(start, end, bucket)
+    # Cells corrected in SQL are only good for the calibration they were corrected with
+    corrections = utils.correctionFactors().version if field == "PM2_5" else None
+    key_args = dict(srcs=srcs, field=field, region=region, grid=grid, res=res, bucket_sec=bucket,
+                    corrections=corrections)
+    data, n_cached = spatial_grid.gridCells(grid_cache, key_args, buckets, bucket, fetch)
+
+    fmt = fmt or streaming.negotiateFormat(request.accept_mimetypes)
+    if fmt:
+        response = streaming.streamResponse([data], fmt=fmt)
+    else:
+        response = jsonify(data)
+        response.status_code = 200
+    response.headers['X-Cache'] = 'HIT' if n_cached == len(buckets) else ('PARTIAL' if n_cached else 'MISS')
+    return response
+
+
+@app.route("/cacheStats", methods=["GET"], subdomain=getenv('SUBDOMAIN_API'))
+def cacheStats():
+    """Hit/miss/eviction counters for this worker's caches"""
+    stats = result_cache.allStats()
+    stats['telemetryBuffer'] = telemetry_buffer.stats()
+    stats['deviceIndex'] = device_index.stats()
+    stats['regionInfo'] = utils.region_config.stats()
+    stats['logShipping'] = log_shipping.stats()
+    stats['cleaning'] = cleaning.stats()
+    stats['correctionFactors'] = dict(
+        utils.correctionFactors().stats(),
+        gcs=utils.correction_config.stats() if utils.correction_config else None)
+    return jsonify(stats), 200
+
+
+@app.route("/warmupStats", methods=["GET"], subdomain=getenv('SUBDOMAIN_API'))
+def warmupStats():
+    """Per-step timings of this worker's /_ah/warmup (null if it never ran)"""
+    return jsonify(warmup.LAST_RUN), 200
 
 
 @app.route("/nickname", methods=["GET"], subdomain=getenv('SUBDOMAIN_API'))
@@ -359,12 +636,16 @@ def nickname():
     UPDATE
         `{PROJECT_ID}.{getenv('BQ_DATASET_META')}.{getenv('BQ_TABLE_META_DEVICES')}`
     SET
-        {getenv('FIELD_NN')} = "{nickname}"
+        {getenv('FIELD_NN')} = @nickname
     WHERE
-        {getenv('FIELD_ID')} = "{device}"
+        {getenv('FIELD_ID')} = @device
     '''
+    params = [
+        ScalarQueryParameter("nickname", "STRING", nickname),
+        ScalarQueryParameter("device", "STRING", device),
+    ]
 
     print(query)
-    bq_client.query(query)
+    bq_utils.runQuery(query, params, endpoint="nickname", coalesce=False)
 
     return 'success', 200
@@ -0,0 +1,157 @@
+"""
+Shared BigQuery client and cost-controlled query execution.
+
+Every query goes through runQuery(), which
+  1. dry-runs it to get total_bytes_processed,
+  2. rejects it (QueryCostError) if that is over the endpoint's byte budget,
+  3. makes heavy queries wait for one of a few process-wide slots (a split
+     query holds one slot for all of its sub-queries),
+  4. runs it with maximum_bytes_billed set, so BigQuery itself refuses
+     anything that would bill more than the budget,
+and identical queries running at the same time share a single job.
+The estimated bytes are added up per request and sent back in the
+X-BigQuery-Bytes-Estimate header (see api_routes.after_request).
+"""
+from os import getenv
+import threading
+from flask import g, has_request_context
+from google.cloud.bigquery import Client as BQClient, QueryJobConfig
+from tetrad.api_consts import *
+from tetrad.classes import QueryCostError
+from tetrad import single_flight
+import logging
+
+
+bq_client = BQClient()
+
+_heavy_slots = threading.BoundedSemaphore(BQ_HEAVY_QUERY_SLOTS)
+
+
+def byteBudget(endpoint):
+    """Byte budget for 'endpoint', e.g. BQ_BYTE_BUDGET_REQUESTDATA, else BQ_BYTE_BUDGET_DEFAULT"""
+    return int(getenv(f"BQ_BYTE_BUDGET_{endpoint.upper()}", BQ_BYTE_BUDGET_DEFAULT))
+
+
+def estimateBytes(sql, params=None, client=None):
+    """total_bytes_processed of a dry run (nothing is billed)"""
+    client = client or bq_client
+    job_config = QueryJobConfig(query_parameters=params or [], dry_run=True, use_query_cache=False)
+    return client.query(sql, job_config=job_config).total_bytes_processed or 0
+
+
+def recordEstimate(nbytes):
+    """Add to this request's X-BigQuery-Bytes-Estimate (no-op outside a request)"""
+    if has_request_context():
+        g.bq_bytes_estimate = g.get('bq_bytes_estimate', 0) + nbytes
+
+
+def admit(endpoint, nbytes):
+    """Raise QueryCostError if 'nbytes' is over the endpoint's budget"""
+    budget = byteBudget(endpoint)
+    if nbytes > budget:
+        logging.warning(f"Rejected {endpoint} query: {nbytes} bytes > budget {budget}")
+        raise QueryCostError(
+            f"Query would scan {nbytes} bytes, over the {budget} byte limit for this endpoint. "
+            "Try a shorter time range, fewer sources or a smaller region.",
+            status_code=413,
+            payload={'bytes_estimate': nbytes, 'bytes_budget': budget})
+
+
+def jobConfig(endpoint, params=None, **kwargs):
+    """QueryJobConfig with maximum_bytes_billed capped at the endpoint's budget"""
+    return QueryJobConfig(query_parameters=params or [], maximum_bytes_billed=byteBudget(endpoint), **kwargs)
+
+
+def acquireHeavySlot(nbytes):
+    """
+    Wait for one of the process-wide heavy-query slots if 'nbytes' is at
+    least BQ_HEAVY_QUERY_BYTES. Returns True if a slot was taken (give it
+    back with releaseHeavySlot()), False if the query is too small to need
+    one. Raises QueryCostError (503) if none frees up in time.
+    """
+    if nbytes is None or nbytes < BQ_HEAVY_QUERY_BYTES:
+        return False
+    # Heavy queries queue for a slot instead of all hitting BigQuery at once
+    if not _heavy_slots.acquire(timeout=BQ_HEAVY_QUERY_QUEUE_SEC):
+        raise QueryCostError("Too many large queries running. Try again shortly.", status_code=503,
+                             payload={'bytes_estimate': nbytes})
+    return True
+
+
+def releaseHeavySlot():
+    _heavy_slots.release()
+
+
+class HeavySlotPages:
+    """
+    Pages of a query admitted as a whole but run as several sub-queries
+    (a split /requestData range), holding one heavy-query slot for all of
+    them. The sub-queries run with estimate=False and take no slots of their
+    own. The slot is given back once the pages run out or are closed (a
+    streamed response closes them when it ends), at the latest when they
+    are garbage collected.
+    """
+
+    def __init__(self, pages):
+        self._pages = iter(pages)
+        self._lock = threading.Lock()
+        self._held = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._pages)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            held, self._held = self._held, False
+        if held:
+            try:
+                getattr(self._pages, "close", lambda: None)()
+            finally:
+                releaseHeavySlot()
+
+    def __del__(self):
+        self.close()
+
+
+def runQuery(sql, params=None, endpoint="default", client=None, estimate=True, coalesce=True, **kwargs):
+    """
+    Dry-run, admit and run 'sql'. Returns the QueryJob.
+    Pass estimate=False when the caller already admitted the query
+    (e.g. the sub-queries of a split /requestData range, see HeavySlotPages).
+    With 'coalesce', identical concurrent queries share one job (single_flight.py).
+    """
+    client = client or bq_client
+
+    def start():
+        nbytes = None
+        if estimate:
+            nbytes = estimateBytes(sql, params, client=client)
+            admit(endpoint, nbytes)
+
+        job_config = jobConfig(endpoint, params, **kwargs)
+        if acquireHeavySlot(nbytes):
+            try:
+                job = client.query(sql, job_config=job_config)
+                job.result()
+            finally:
+                releaseHeavySlot()
+            return job, nbytes
+
+        return client.query(sql, job_config=job_config), nbytes
+
+    if coalesce:
+        key = single_flight.queryKey(sql, params, endpoint=endpoint, **kwargs)
+        job, nbytes, _ = single_flight.coalescedJob(key, start, client)
+    else:
+        job, nbytes = start()
+
+    if nbytes is not None:
+        recordEstimate(nbytes)
+    return job
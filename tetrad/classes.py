@@ -32,4 +32,22 @@ class NoDataError(Exception):
     def to_dict(self):
         rv = dict(self.payload or ())
         rv['message'] = self.message 
-        return rv 
\ No newline at end of file
+        return rv
+
+
+class QueryCostError(Exception):
+    status_code = 413
+
+    def __init__(self, message, status_code=None, payload=None):
+        Exception.__init__(self)
+        self.message = message
+        if status_code is not None:
+            self.status_code = status_code
+        else:
+            self.status_code = 413
+        self.payload = payload
+
+    def to_dict(self):
+        rv = dict(self.payload or ())
+        rv['message'] = self.message
+        return rv
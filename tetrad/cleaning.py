@@ -0,0 +1,116 @@
+"""
+Column-wise cleaning of PM2.5, temperature and humidity.
+
+Works on {name: np.ndarray} columns (columnar.py batches, or dict rows
+turned into columns by utils._tuneData). The bad-value thresholds are parsed
+into floats once, in api_consts, and each field gets a single boolean mask:
+
+    PM2.5        == PM_BAD_FLAG  or  >= PM_BAD_THRESH
+    temperature  == TEMP_BAD_FLAG
+    humidity     == HUM_BAD_FLAG
+
+Bad values become NaN, and PM2.5 gets its correction factors in the same
+pass. removeNulls is one combined mask over the chosen columns. Every call
+returns a report with rejected counts per field, and the counts also
+accumulate per process for /cacheStats.
+"""
+import threading
+import numpy as np
+from tetrad.api_consts import *
+import logging
+
+
+_totals_lock = threading.Lock()
+_totals = {'rows': 0, 'rejected': {}, 'nulls': {}, 'removed': 0}
+
+
+def nullMask(a):
+    """True where a column value is null (NaN/NaT/None)"""
+    if a.dtype.kind == "f":
+        return np.isnan(a)
+    if a.dtype.kind == "M":
+        return np.isnat(a)
+    if a.dtype.kind == "O":
+        return np.equal(a, None)
+    return np.zeros(len(a), dtype=bool)
+
+
+def floatColumn(values):
+    """List of numbers/None -> float64 array with NaN for None; None if any value isn't numeric"""
+    try:
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+
+
+def cleanValues(cols, pm25_key=None, temp_key=None, hum_key=None, factors=None, ts=None):
+    """
+    Replace bad values with NaN (in 'cols', new arrays) and correct PM2.5 with
+    'factors' (a corrections.CorrectionFactors) at 'ts' (epoch seconds).
+    Only float columns are touched. Returns {column: rejected count}.
+    """
+    rejected = {}
+    rules = ((pm25_key, PM_BAD_FLAG, PM_BAD_THRESH), (temp_key, TEMP_BAD_FLAG, None), (hum_key, HUM_BAD_FLAG, None))
+    for key, flag, thresh in rules:
+        if not key or cols.get(key) is None or cols[key].dtype.kind != "f":
+            continue
+        a = cols[key]
+        with np.errstate(invalid='ignore'):
+            bad = a == flag
+            if thresh is not None:
+                bad |= a >= thresh
+        if key == pm25_key and factors is not None and ts is not None:
+            out = factors.apply(a, ts)
+        else:
+            out = a.copy()
+        out[bad] = np.nan
+        cols[key] = out
+        rejected[key] = int(bad.sum())
+    return rejected
+
+
+def keepMask(cols, keys):
+    """(True where none of 'keys' is null, {column: null count})"""
+    n = len(next(iter(cols.values()), []))
+    keep = np.ones(n, dtype=bool)
+    nulls = {}
+    for k in keys:
+        m = nullMask(cols[k])
+        nulls[k] = int(m.sum())
+        keep &= ~m
+    return keep, nulls
+
+
+def clean(cols, pm25_key=None, temp_key=None, hum_key=None, factors=None, ts=None, null_keys=None):
+    """
+    cleanValues(), then drop every row with a null in any of 'null_keys'
+    (None: keep all rows). Returns (cols, report).
+    """
+    n = len(next(iter(cols.values()), []))
+    report = {'rows': n, 'rejected': cleanValues(cols, pm25_key, temp_key, hum_key, factors, ts),
+              'nulls': {}, 'removed': 0}
+    if null_keys is not None:
+        keep, report['nulls'] = keepMask(cols, null_keys)
+        report['removed'] = n - int(keep.sum())
+        if report['removed']:
+            cols = {k: v[keep] for k, v in cols.items()}
+    record(report)
+    return cols, report
+
+
+def record(report):
+    """Add one call's counts to the per-process totals (and log what was dropped)"""
+    with _totals_lock:
+        _totals['rows'] += report['rows']
+        _totals['removed'] += report['removed']
+        for part in ('rejected', 'nulls'):
+            for k, c in report[part].items():
+                _totals[part][k] = _totals[part].get(k, 0) + c
+    if report['removed'] or any(report['rejected'].values()):
+        logging.info(f"Cleaning: {report}")
+
+
+def stats():
+    with _totals_lock:
+        return {'rows': _totals['rows'], 'removed': _totals['removed'],
+                'rejected': dict(_totals['rejected']), 'nulls': dict(_totals['nulls'])}
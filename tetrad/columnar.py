@@ -0,0 +1,179 @@
+"""
+Columnar (Arrow) fetch path for BigQuery results.
+
+The default path turns every BigQuery Row into a dict one at a time. Here the
+result is read as Arrow record batches (through the BigQuery Storage Read
+API, unless the whole result came back with the query) and each batch
+becomes a dict of NumPy columns:
+    {column name: np.ndarray}
+Cleaning and correction (utils.tuneAllColumns) work on those arrays directly,
+and rows are only assembled at the very end, for serialization.
+"""
+from datetime import timezone
+import numpy as np
+from tetrad import utils
+
+try:
+    import pyarrow as pa
+    from google.cloud import bigquery_storage
+except ImportError:
+    pa = None
+    bigquery_storage = None
+
+
+_bqstorage_client = None
+
+
+def available():
+    """pyarrow and google-cloud-bigquery-storage are both installed"""
+    return pa is not None and bigquery_storage is not None
+
+
+def getBQStorageClient():
+    """One Storage Read API client per process, created on first use"""
+    global _bqstorage_client
+    if _bqstorage_client is None:
+        _bqstorage_client = bigquery_storage.BigQueryReadClient()
+    return _bqstorage_client
+
+
+# BigQuery column type -> Arrow type for pages read without the Storage Read API
+_ARROW_TYPES = {
+    "FLOAT": "float64", "FLOAT64": "float64",
+    "INTEGER": "int64", "INT64": "int64",
+    "BOOLEAN": "bool_", "BOOL": "bool_",
+    "STRING": "string",
+}
+
+
+def _arrowType(field):
+    if field.field_type in ("TIMESTAMP", "DATETIME"):
+        return pa.timestamp("us", tz="UTC" if field.field_type == "TIMESTAMP" else None)
+    name = _ARROW_TYPES.get(field.field_type)
+    return getattr(pa, name)() if name and field.mode != "REPEATED" else None
+
+
+def _pageBatches(rows):
+    """One RecordBatch per result page, typed from the query's schema"""
+    names = [f.name for f in rows.schema]
+    types = [_arrowType(f) for f in rows.schema]
+    for page in rows.pages:
+        values = [list(r.values()) for r in page]
+        arrays = [pa.array([v[i] for v in values], type=types[i]) for i in range(len(names))]
+        yield pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def _storageBatches(rows):
+    """
+    Read the query's destination table through the Storage Read API as one
+    stream (so ORDER BY order is kept), a record batch per message. Batches
+    are pulled as the caller consumes them; nothing is read ahead.
+    """
+    client = getBQStorageClient()
+    requested = bigquery_storage.types.ReadSession(
+        table=rows._table.to_bqstorage(), data_format=bigquery_storage.types.DataFormat.ARROW)
+    session = client.create_read_session(parent=f"projects/{rows._project}", read_session=requested,
+                                         max_stream_count=1)
+    if not session.streams:
+        return
+    for page in client.read_rows(session.streams[0].name).rows(session).pages:
+        yield page.to_arrow()
+
+
+def _useStorageAPI(rows):
+    """
+    The result isn't already in the first REST page, and there is a table to read
+    (the same test RowIterator.to_arrow() uses before it opens a read session)
+    """
+    return getattr(rows, "_table", None) is not None and rows._validate_bqstorage(getBQStorageClient(), False)
+
+
+def iterBatches(rows, batch_size=None):
+    """
+    Yield Arrow RecordBatches for a finished query's RowIterator, one at a
+    time so the whole result is never in memory. Row order is kept.
+
+    The pinned google-cloud-bigquery (2.13) has no to_arrow_iterable(), and its
+    to_arrow() reads the entire result first, so the destination table is read
+    with the Storage Read API here (_storageBatches). Results small enough to
+    have come back with the query are built from the RowIterator's own pages.
+    Batches longer than 'batch_size' are sliced (zero-copy).
+    """
+    if hasattr(rows, "to_arrow_iterable"):
+        batches = rows.to_arrow_iterable(bqstorage_client=getBQStorageClient())
+    elif _useStorageAPI(rows):
+        batches = _storageBatches(rows)
+    else:
+        batches = _pageBatches(rows)
+
+    for batch in batches:
+        if not batch_size or batch.num_rows <= batch_size:
+            yield batch
+            continue
+        for offset in range(0, batch.num_rows, batch_size):
+            yield batch.slice(offset, batch_size)
+
+
+def batchToColumns(batch):
+    """
+    Arrow RecordBatch -> {name: np.ndarray}
+      - floats:              float64, nulls as NaN
+      - ints without nulls:  int64
+      - timestamps:          datetime64[us] (UTC)
+      - everything else:     object array of Python values
+    """
+    cols = {}
+    for name, col in zip(batch.schema.names, batch.columns):
+        t = col.type
+        if pa.types.is_floating(t):
+            cols[name] = col.to_numpy(zero_copy_only=False).astype(np.float64)
+        elif pa.types.is_integer(t) and col.null_count == 0:
+            cols[name] = col.to_numpy().astype(np.int64)
+        elif pa.types.is_timestamp(t):
+            cols[name] = col.cast(pa.timestamp("us", tz=t.tz)).to_numpy(zero_copy_only=False).astype("datetime64[us]")
+        else:
+            cols[name] = np.array(col.to_pylist(), dtype=object)
+    return cols
+
+
+def numRows(cols):
+    for v in cols.values():
+        return len(v)
+    return 0
+
+
+def epochSeconds(ts):
+    """datetime64 column -> float seconds since the epoch"""
+    return ts.astype("datetime64[us]").astype(np.int64) / 1e6
+
+
+def columnToList(a):
+    """NumPy column -> list of JSON-able Python values (NaN/NaT -> None, timestamps UTC-aware)"""
+    if a.dtype.kind == "f":
+        out = a.astype(object)
+        out[np.isnan(a)] = None
+        return out.tolist()
+    if a.dtype.kind == "M":
+        # UTC-aware, like the datetimes the "rows" engine returns
+        return [None if d is None else d.replace(tzinfo=timezone.utc)
+                for d in a.astype("datetime64[us]").astype(object).tolist()]
+    return a.tolist()
+
+
+def columnsToRows(cols):
+    """Assemble the list-of-dicts that jsonify() and the stream encoders expect"""
+    names = list(cols)
+    lists = [columnToList(cols[n]) for n in names]
+    return [dict(zip(names, vals)) for vals in zip(*lists)]
+
+
+def iterColumnPages(rows, fields=None, tune=False, removeNulls=False, batch_size=None):
+    """
+    Arrow counterpart of streaming.iterPages(): one list of dicts per record batch.
+    If 'tune', batches are cleaned/corrected column-wise first.
+    """
+    for batch in iterBatches(rows, batch_size=batch_size):
+        cols = batchToColumns(batch)
+        if tune:
+            cols = utils.tuneAllColumns(cols, fields, removeNulls=removeNulls)
+        yield columnsToRows(cols)
@@ -0,0 +1,77 @@
+"""
+PM2.5 correction factors as a searchable time index.
+
+A correction factor is a time range [start_date, end_date) with a slope and
+an intercept; a reading inside it becomes max(0, pm * slope + intercept).
+Instead of scanning the factor list for every reading, CorrectionFactors
+cuts the time axis at every start/end once, at load:
+
+    boundaries  b0 < b1 < ... < bn      (epoch seconds)
+    segment i   [b_i, b_(i+1))  ->  index of the first factor covering it, or -1
+
+so a whole column of timestamps is located with one np.searchsorted() and
+corrected with one vectorized multiply-add. "First factor in the file wins"
+for overlapping ranges, exactly like the old linear scan.
+"""
+import numpy as np
+
+
+class CorrectionFactors:
+
+    def __init__(self, factors, version=None):
+        """
+        factors: [{'start_date': datetime, 'end_date': datetime, '3003_slope': float,
+                   '3003_intercept': float}, ...] in file order (see utils.loadCorrectionFactors)
+        """
+        self.version = version
+        self.n_factors = len(factors)
+        starts = np.array([f['start_date'].timestamp() for f in factors], dtype=np.float64)
+        ends = np.array([f['end_date'].timestamp() for f in factors], dtype=np.float64)
+        self.slope = np.array([f['3003_slope'] for f in factors], dtype=np.float64)
+        self.intercept = np.array([f['3003_intercept'] for f in factors], dtype=np.float64)
+
+        self.boundaries = np.unique(np.concatenate([starts, ends]))
+        # Factor covering each segment; iterate in reverse so the earliest listed factor ends up on top
+        self.segment_factor = np.full(len(self.boundaries), -1, dtype=np.int64)
+        for i in range(self.n_factors - 1, -1, -1):
+            lo, hi = np.searchsorted(self.boundaries, [starts[i], ends[i]])
+            self.segment_factor[lo:hi] = i
+
+    def factorIndex(self, ts):
+        """Index of the factor for each timestamp (epoch seconds), -1 where none applies"""
+        ts = np.asarray(ts, dtype=np.float64)
+        if not self.n_factors:
+            return np.full(ts.shape, -1, dtype=np.int64)
+        seg = np.searchsorted(self.boundaries, ts, side='right') - 1
+        # Before the first boundary (seg == -1) or NaN timestamps (sorted past the end) -> no factor
+        idx = self.segment_factor[np.clip(seg, 0, None)]
+        idx[(seg < 0) | np.isnan(ts)] = -1
+        return idx
+
+    def apply(self, pm, ts):
+        """
+        Corrected copy of 'pm' (float array) for timestamps 'ts' (epoch seconds).
+        Readings with no factor are returned unchanged; NaN stays NaN.
+        """
+        pm = np.asarray(pm, dtype=np.float64)
+        idx = self.factorIndex(ts)
+        hit = idx >= 0
+        out = pm.copy()
+        out[hit] = np.maximum(0, pm[hit] * self.slope[idx[hit]] + self.intercept[idx[hit]])
+        return out
+
+    def segments(self):
+        """
+        The index as plain lists for SQL (query_compiler.cleaningParams):
+        boundaries in epoch microseconds, and per segment whether a factor
+        covers it and that factor's slope/intercept (0 where none does).
+        """
+        covered = self.segment_factor >= 0
+        idx = np.where(covered, self.segment_factor, 0)
+        slope = np.where(covered, self.slope[idx], 0.0) if self.n_factors else np.zeros(0)
+        intercept = np.where(covered, self.intercept[idx], 0.0) if self.n_factors else np.zeros(0)
+        bounds_us = np.round(self.boundaries * 1e6).astype(np.int64)
+        return bounds_us.tolist(), covered.tolist(), slope.tolist(), intercept.tolist()
+
+    def stats(self):
+        return {'version': self.version, 'factors': self.n_factors, 'segments': len(self.boundaries)}
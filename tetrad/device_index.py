@@ -0,0 +1,219 @@
+"""
+In-memory index of where devices have been, for pruning box/radius queries.
+
+A 'box' or 'radius' filter alone makes BigQuery evaluate ST_WITHIN/ST_DWITHIN
+on every row in the time range. The index keeps, per DeviceID, the bounding
+box of every position it reported since it was built, bucketed into a coarse
+lat/lon grid. A spatial filter first resolves to the devices whose box
+touches it, and the query then also filters on those DeviceIDs (the table is
+clustered on DeviceID, so this cuts bytes scanned). The exact geography
+predicate stays in the query. A box is widened by how far its great-circle
+edges bulge past its corners first (see _geodesicBox), so the result is
+unchanged.
+
+The index only answers for time ranges it has fully seen: from when it was
+built up to INGEST_LAG_SEC before its last refresh (rows newer than that may
+still be arriving). Anything else is left unpruned.
+"""
+from datetime import datetime, timedelta
+import math
+import threading
+from time import sleep
+from google.cloud.bigquery import ScalarQueryParameter
+import numpy as np
+import pytz
+from tetrad import bq_utils, geometry
+from tetrad.api_consts import *
+import logging
+
+
+def _geodesicBox(bbox):
+    """
+    (lat_lo, lat_hi, lon_lo, lon_hi) around the /requestData box polygon as
+    BigQuery reads it (ST_GEOGFROMGEOJSON): its north and south edges are
+    great-circle arcs, which bulge towards the pole (about 0.43 degrees at
+    40N across 20 degrees of longitude). None if an edge spans 180 degrees
+    or more, since it then runs over the pole.
+    """
+    lat_lo, lat_hi, lon_lo, lon_hi = bbox['lat_lo'], bbox['lat_hi'], bbox['lon_lo'], bbox['lon_hi']
+    dlon = abs(lon_hi - lon_lo)
+    if dlon >= 180:
+        return None
+    if lat_hi > 0:
+        lat_hi = min(90.0, float(geometry.greatCircleMaxLat(lat_hi, dlon)))
+    if lat_lo < 0:
+        lat_lo = max(-90.0, float(geometry.greatCircleMaxLat(lat_lo, dlon)))
+    # Rounding margin
+    return lat_lo - 1e-9, lat_hi + 1e-9, lon_lo, lon_hi
+
+
+class DeviceIndex:
+    """
+    Per-device position bounds on a grid of 'cell_deg' degree cells.
+    Each refresh builds a new index and swaps it in, so readers never lock.
+    """
+
+    def __init__(self, bq_client, lookback_days=DEVICE_INDEX_LOOKBACK_DAYS, refresh_sec=DEVICE_INDEX_REFRESH_SEC,
+                 cell_deg=DEVICE_INDEX_CELL_DEG, ingest_lag_sec=INGEST_LAG_SEC):
+        self.bq_client = bq_client
+        self.lookback = timedelta(days=lookback_days)
+        self.refresh_sec = refresh_sec
+        self.cell_deg = cell_deg
+        self.ingest_lag = timedelta(seconds=ingest_lag_sec)
+
+        self._bounds = {}       # DeviceID -> [lat_lo, lat_hi, lon_lo, lon_hi]
+        self._index = None      # (ids, bounds array, {cell: device rows}, wide device rows)
+        self._covered = None    # (from, to)
+        self._refresh_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._index is not None
+
+    def start(self):
+        """Start the background refresh thread (once per process)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="device-index", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"DeviceIndex refresh failed: {repr(e)}")
+            sleep(self.refresh_sec)
+
+    def _query(self, since):
+        query = f"""
+            SELECT
+                {FIELD_MAP["DEVICEID"]},
+                MIN(ST_Y({FIELD_MAP["GPS"]})) AS lat_lo,
+                MAX(ST_Y({FIELD_MAP["GPS"]})) AS lat_hi,
+                MIN(ST_X({FIELD_MAP["GPS"]})) AS lon_lo,
+                MAX(ST_X({FIELD_MAP["GPS"]})) AS lon_hi
+            FROM
+                `{BQ_PATH_TELEMETRY}`
+            WHERE
+                {FIELD_MAP["TIMESTAMP"]} >= @since
+                    AND
+                {FIELD_MAP["GPS"]} IS NOT NULL
+            GROUP BY
+                {FIELD_MAP["DEVICEID"]}
+        """
+        params = [ScalarQueryParameter("since", "TIMESTAMP", since)]
+        return bq_utils.runQuery(query, params, endpoint="deviceIndex", client=self.bq_client).result()
+
+    def refresh(self):
+        """
+        Widen each device's bounds with the positions reported since the
+        index was last complete. Bounds only ever grow, which can only
+        make pruning less selective, never wrong.
+        """
+        with self._refresh_lock:
+            now = datetime.now(pytz.utc)
+            since = now - self.lookback if self._covered is None else self._covered[1]
+
+            bounds = dict(self._bounds)
+            for r in self._query(since):
+                dev = r[FIELD_MAP["DEVICEID"]]
+                b = bounds.get(dev)
+                if b is None:
+                    bounds[dev] = [r['lat_lo'], r['lat_hi'], r['lon_lo'], r['lon_hi']]
+                else:
+                    bounds[dev] = [min(b[0], r['lat_lo']), max(b[1], r['lat_hi']),
+                                   min(b[2], r['lon_lo']), max(b[3], r['lon_hi'])]
+
+            self._bounds = bounds
+            self._index = self._build(bounds)
+            self._covered = (since if self._covered is None else self._covered[0], now - self.ingest_lag)
+
+    def _cells(self, lat_lo, lat_hi, lon_lo, lon_hi):
+        return (range(math.floor(lat_lo / self.cell_deg), math.floor(lat_hi / self.cell_deg) + 1),
+                range(math.floor(lon_lo / self.cell_deg), math.floor(lon_hi / self.cell_deg) + 1))
+
+    def _build(self, bounds):
+        ids = list(bounds)
+        arr = np.array([bounds[d] for d in ids], dtype=np.float64).reshape(-1, 4)
+        grid, wide = {}, []
+        for i, (lat_lo, lat_hi, lon_lo, lon_hi) in enumerate(arr):
+            ys, xs = self._cells(lat_lo, lat_hi, lon_lo, lon_hi)
+            # Devices that roam over many cells are checked on every lookup instead
+            if len(ys) * len(xs) > 16:
+                wide.append(i)
+                continue
+            for y in ys:
+                for x in xs:
+                    grid.setdefault((y, x), []).append(i)
+        return ids, arr, grid, wide
+
+    def covers(self, start, end):
+        return self._covered is not None and self._covered[0] <= start and end <= self._covered[1]
+
+    def candidates(self, lat_lo, lat_hi, lon_lo, lon_hi):
+        """DeviceIDs whose position bounds intersect the box"""
+        ids, arr, grid, wide = self._index
+        ys, xs = self._cells(lat_lo, lat_hi, lon_lo, lon_hi)
+        rows = set(wide)
+        if len(ys) * len(xs) > len(grid):
+            rows.update(i for cell in grid.values() for i in cell)
+        else:
+            for y in ys:
+                for x in xs:
+                    rows.update(grid.get((y, x), ()))
+        if not rows:
+            return []
+
+        rows = np.fromiter(rows, dtype=np.int64)
+        b = arr[rows]
+        hit = (b[:, 0] <= lat_hi) & (b[:, 1] >= lat_lo) & (b[:, 2] <= lon_hi) & (b[:, 3] >= lon_lo)
+        return [ids[i] for i in rows[hit]]
+
+    def prune(self, start, end, bbox=None, radius=None, center=None, id_ls=None):
+        """
+        Devices that can have rows inside the region during [start, end],
+        or 'id_ls' unchanged when the index can't tell (no region, not
+        covered yet, or too many candidates to be worth a device filter).
+        """
+        if not (bbox or radius) or not self.ready or not self.covers(start, end):
+            return id_ls
+
+        if bbox:
+            box = _geodesicBox(bbox)
+            if box is None:
+                return id_ls
+        else:
+            # Box around the circle (a little generous: 110 km per degree);
+            # the query still applies the exact distance
+            dlat = radius / 110.0
+            coslat = max(math.cos(math.radians(min(abs(center['lat']) + dlat, 90))), 1e-6)
+            dlon = min(radius / (110.0 * coslat), 180)
+            box = (center['lat'] - dlat, center['lat'] + dlat, center['lon'] - dlon, center['lon'] + dlon)
+            if box[2] < -180 or box[3] > 180:
+                return id_ls
+
+        found = self.candidates(*box)
+        if id_ls:
+            wanted = set(id_ls)
+            found = [d for d in found if d in wanted]
+        elif len(found) > DEVICE_INDEX_MAX_IDS:
+            return id_ls
+        return found
+
+    def stats(self):
+        if not self.ready:
+            return {'devices': 0, 'covered_from': None, 'covered_to': None}
+        ids, _, grid, wide = self._index
+        return {
+            'devices': len(ids),
+            'cells': len(grid),
+            'wide_devices': len(wide),
+            'covered_from': self._covered[0].isoformat(),
+            'covered_to': self._covered[1].isoformat(),
+        }
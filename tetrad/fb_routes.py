@@ -1,13 +1,8 @@
 from firebase_admin import auth#, initialize_app
 from flask import request, send_file
 from tetrad import app, admin_utils
-import traceback 
 from os import getenv
 from io import BytesIO
-import google.cloud.logging
-gcloud_logging_client = google.cloud.logging.Client()
-gcloud_logging_client.get_default_handler()
-gcloud_logging_client.setup_logging()
 import logging
 
 
@@ -17,8 +12,6 @@ import logging
 @app.route("/signup", methods=["POST"], subdomain=getenv('SUBDOMAIN_API'))
 # @app.route("/signup", methods=["POST"])
 def signup():
-    logging.error("HTTP_HOST: " + request.environ.get('HTTP_HOST'))
-    logging.error("SERVER_NAME: " + app.config['SERVER_NAME'])
     email = request.form.get('email')
     password = request.form.get('password')
     if email is None or password is None:
@@ -34,7 +27,7 @@ def signup():
         )
         return {'message': f'Successfully created user {user.uid}'}, 200
     except Exception as e:
-        logging.error(traceback.print_exc())
+        logging.exception("signup failed")
         return str(repr(e)), 400
 
 
@@ -48,7 +41,7 @@ def requestToken():
         jwt = user['idToken']
         return {'token': jwt}, 200
     except Exception as e:
-        logging.error(traceback.print_exc())
+        logging.exception("requestToken failed")
         return 'ERROR: There was an error logging in:' + repr(e), 400
 
 
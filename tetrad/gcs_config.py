@@ -0,0 +1,137 @@
+"""
+Config files in GCS (JSON unless another 'parse' is given), loaded in the
+background and kept fresh.
+
+A GCSConfig downloads its blob once on a background thread and then
+revalidates every 'refresh_sec' with a conditional metadata GET
+(ifGenerationNotMatch): an unchanged blob costs one 304 and no download.
+When the generation changes, the new contents are parsed and every onChange()
+listener is called with them, so dependent caches can be rebuilt; only once
+all of that has succeeded is the version swapped in and its generation
+remembered. A bad upload (one that 'parse' or a listener rejects by raising)
+is therefore retried on the next revalidation instead of being skipped for
+good. Importing a module that owns a GCSConfig never waits on the network;
+only code that needs the data before the first load has finished blocks, in
+wait().
+"""
+import json
+import threading
+from time import sleep, time
+from google.api_core.exceptions import NotModified
+from google.cloud.storage import Client as GSClient
+import logging
+
+
+class GCSConfig:
+
+    def __init__(self, bucket_name, blob_name, refresh_sec, name=None, load_timeout_sec=30, parse=json.loads):
+        """'parse' turns the blob's bytes into the data handed to listeners"""
+        self.bucket_name = bucket_name
+        self.blob_name = blob_name
+        self.refresh_sec = refresh_sec
+        self.name = name or blob_name
+        self.load_timeout_sec = load_timeout_sec
+        self.parse = parse
+
+        self.data = None
+        self.generation = None
+        self.etag = None
+        self.loaded_at = None
+        self.checked_at = None
+        self.reloads = 0
+
+        self._client = None
+        self._listeners = []
+        self._loaded = threading.Event()
+        self._attempted = threading.Event()
+        self._load_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._loaded.is_set()
+
+    def onChange(self, fn):
+        """
+        Call fn(data, generation) for every new version before it is swapped
+        in (and now, if one already is). Raising rejects the version.
+        """
+        self._listeners.append(fn)
+        if self.ready:
+            fn(self.data, self.generation)
+
+    def start(self):
+        """Start the background load/revalidate thread (once per process)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name=f"gcs-config-{self.name}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.load()
+            except Exception as e:
+                logging.error(f"GCSConfig {self.name}: reload failed: {repr(e)}")
+            finally:
+                self._attempted.set()
+            sleep(self.refresh_sec)
+
+    def _blob(self):
+        if self._client is None:
+            self._client = GSClient()
+        return self._client.bucket(self.bucket_name).blob(self.blob_name)
+
+    def load(self):
+        """
+        Fetch the blob if its generation changed since the last load.
+        Returns True if a new version was swapped in.
+        """
+        with self._load_lock:
+            blob = self._blob()
+            self.checked_at = time()
+            try:
+                blob.reload(if_generation_not_match=self.generation)
+            except NotModified:
+                return False
+
+            # Pin the download to the generation we just saw, so data and generation agree
+            generation, etag = blob.generation, blob.etag
+            data = self.parse(blob.download_as_bytes(if_generation_match=generation))
+            for fn in self._listeners:
+                fn(data, generation)
+            self.data, self.generation, self.etag = data, generation, etag
+            self.loaded_at = time()
+            self.reloads += 1
+            self._loaded.set()
+            logging.info(f"GCSConfig {self.name}: loaded generation {self.generation}")
+            return True
+
+    def wait(self):
+        """
+        Block until the first version is loaded. If the background thread is
+        slow, or its first attempt failed, load here (raising if that fails too).
+        """
+        if self.ready:
+            return self.data
+        self._attempted.wait(self.load_timeout_sec)
+        if not self.ready:
+            self.load()
+        return self.data
+
+    def get(self):
+        return self.data if self.ready else self.wait()
+
+    def stats(self):
+        return {
+            'blob': f"gs://{self.bucket_name}/{self.blob_name}",
+            'generation': self.generation,
+            'etag': self.etag,
+            'loaded_at': self.loaded_at,
+            'checked_at': self.checked_at,
+            'reloads': self.reloads,
+        }
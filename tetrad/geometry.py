@@ -0,0 +1,54 @@
+"""
+Vectorized great-circle geometry.
+
+Every function takes whole arrays of latitudes/longitudes (degrees) and works
+on them at once with NumPy, instead of one coordinate pair at a time with
+'math'. Scalars work too and come back as 0-d results.
+"""
+import numpy as np
+
+
+# Mean Earth radius in kilometers
+EARTH_RADIUS_KM = 6371
+
+
+def haversineKm(lat, lon, lat0, lon0):
+    """Great-circle distance (km) from each (lat, lon) to (lat0, lon0)"""
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    lat0, lon0 = np.radians(lat0), np.radians(lon0)
+    a = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat) * np.cos(lat0) * np.sin((lon - lon0) / 2) ** 2
+    # arcsin form of atan2(sqrt(a), sqrt(1 - a)); clip guards against a > 1 from rounding
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def greatCircleMaxLat(lat, dlon):
+    """
+    Latitude furthest from the equator on the great-circle arc between
+    (lat, 0) and (lat, dlon), for |dlon| < 180. An east-west polygon edge in
+    BigQuery GEOGRAPHY is such an arc, so it bulges towards the pole.
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    half = np.radians(np.abs(np.asarray(dlon, dtype=np.float64))) / 2
+    return np.degrees(np.arctan(np.tan(lat) / np.cos(half)))
+
+
+def radiusMask(lat, lon, radius, lat0, lon0):
+    """True where (lat, lon) is within 'radius' km of (lat0, lon0). NaN coordinates are outside"""
+    with np.errstate(invalid='ignore'):
+        return haversineKm(lat, lon, lat0, lon0) <= radius
+
+
+def bboxMask(lat, lon, lat_lo, lat_hi, lon_lo, lon_hi):
+    """True where (lat, lon) is inside the box (edges included). NaN coordinates are outside"""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        return (lat >= lat_lo) & (lat <= lat_hi) & (lon >= lon_lo) & (lon <= lon_hi)
+
+
+def coordsFromRows(rows, lat_key="Latitude", lon_key="Longitude"):
+    """(lat, lon) float arrays from a list of dicts; missing coordinates become NaN"""
+    lat = np.array([r.get(lat_key) for r in rows], dtype=np.float64)
+    lon = np.array([r.get(lon_key) for r in rows], dtype=np.float64)
+    return lat, lon
@@ -0,0 +1,50 @@
+"""
+Deferred imports for heavy, rarely used modules.
+
+    gaussian_model_utils = lazyModule('tetrad.gaussian_model_utils')
+
+binds a placeholder at import time; the real module (and everything it
+imports, e.g. torch and scipy) is loaded on the first attribute access, in
+whichever worker first needs it. Workers that never serve estimation never
+pay for it. tools/import_profile.py checks that these modules stay out of a
+cold 'import tetrad'.
+"""
+import importlib
+import sys
+import threading
+
+
+class LazyModule:
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazyModule(name):
+    """The module itself if it is already imported, else a LazyModule placeholder"""
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def isLoaded(name):
+    return name in sys.modules
@@ -0,0 +1,149 @@
+"""
+In-memory snapshot of the latest telemetry row for every DeviceID.
+
+/liveSensors used to run a ROW_NUMBER() window query over the last 15 minutes
+of telemetry on every call. Instead, each worker keeps the newest row per device
+in memory and a background thread tops it up with only the rows newer than the
+last Timestamp it has seen.
+"""
+from datetime import datetime, timedelta
+import threading
+from time import sleep, time
+from google.cloud.bigquery import ScalarQueryParameter
+import pytz
+from tetrad import utils, bq_utils
+from tetrad.api_consts import *
+import logging
+
+
+# Everything we can hand back from /liveSensors. DeviceID, Timestamp, Source,
+# Label, Latitude and Longitude are always part of queryBuildFields().
+SNAPSHOT_FIELDS = [f for f in FIELD_MAP if f not in ("TIMESTAMP", "DEVICEID", "SOURCE", "LABEL")]
+
+
+class LiveSnapshot:
+    """
+    Latest row per DeviceID, refreshed incrementally from BigQuery.
+
+    Readers never take a lock: each refresh builds a new dict and swaps it in.
+    """
+
+    def __init__(self, bq_client, window_min=LIVE_SNAPSHOT_WINDOW_MIN,
+                 refresh_sec=LIVE_SNAPSHOT_REFRESH_SEC, overlap_sec=LIVE_SNAPSHOT_OVERLAP_SEC):
+        self.bq_client = bq_client
+        self.window = timedelta(minutes=window_min)
+        self.refresh_sec = refresh_sec
+        self.overlap = timedelta(seconds=overlap_sec)
+
+        self._rows = {}
+        self._watermark = None
+        self._last_refresh = None
+        self._refresh_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._last_refresh is not None
+
+    @property
+    def window_min(self):
+        return self.window.total_seconds() / 60
+
+    def start(self):
+        """Start the background refresh thread (once per process)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="live-snapshot", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"LiveSnapshot refresh failed: {repr(e)}")
+            sleep(self.refresh_sec)
+
+    def _query(self, since):
+        """Only fetch rows newer than 'since' (and never outside the window)"""
+        query = f"""
+            SELECT
+                {utils.queryBuildFields(SNAPSHOT_FIELDS)}
+            FROM
+                `{BQ_PATH_TELEMETRY}`
+            WHERE
+                {FIELD_MAP["TIMESTAMP"]} > @since
+                    AND
+                {FIELD_MAP["TIMESTAMP"]} >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(self.window_min)} MINUTE)
+        """
+        params = [ScalarQueryParameter("since", "TIMESTAMP", since)]
+        return bq_utils.runQuery(query, params, endpoint="liveSnapshot", client=self.bq_client).result()
+
+    def refresh(self):
+        """
+        Pull rows newer than the watermark and merge them into the snapshot.
+        The watermark is backed off by 'overlap' so late-arriving rows still
+        get picked up; merging keeps whichever row per device is newest.
+        Rows more than 'overlap' in the future are dropped.
+        """
+        with self._refresh_lock:
+            now = datetime.now(pytz.utc)
+            oldest = now - self.window
+            if self._watermark is None:
+                since = oldest
+            else:
+                since = max(oldest, self._watermark - self.overlap)
+
+            rows = dict(self._rows)
+            watermark = self._watermark
+            # Devices with bad clocks report from the future; keeping those
+            # rows would serve them as "latest" for every 'delta'.
+            future = now + self.overlap
+            for r in self._query(since):
+                r = dict(r)
+                ts = r[FIELD_MAP["TIMESTAMP"]]
+                if ts > future:
+                    continue
+                dev = r[FIELD_MAP["DEVICEID"]]
+                cur = rows.get(dev)
+                if cur is None or ts >= cur[FIELD_MAP["TIMESTAMP"]]:
+                    rows[dev] = r
+                # Nor let them push the watermark past 'now' and stall the refresh
+                if ts <= now and (watermark is None or ts > watermark):
+                    watermark = ts
+
+            # Drop devices that have gone quiet for longer than the window
+            rows = {k: v for k, v in rows.items() if v[FIELD_MAP["TIMESTAMP"]] >= oldest}
+
+            self._rows = rows
+            self._watermark = watermark
+            self._last_refresh = time()
+
+    def latest(self, srcs, fields, delta):
+        """
+        Latest row per device that reported in the last 'delta' minutes,
+        filtered to 'srcs' and projected to 'fields' (same columns
+        as queryBuildFields(fields)).
+        """
+        if not self.ready:
+            self.refresh()
+
+        cutoff = datetime.now(pytz.utc) - timedelta(minutes=delta)
+        keys = [
+            FIELD_MAP["DEVICEID"],
+            FIELD_MAP["TIMESTAMP"],
+            FIELD_MAP["SOURCE"],
+            FIELD_MAP["LABEL"],
+            "Latitude",
+            "Longitude",
+        ] + [FIELD_MAP[f] for f in fields]
+
+        return [
+            {k: r.get(k) for k in keys}
+            for r in self._rows.values()
+            if r[FIELD_MAP["TIMESTAMP"]] >= cutoff and utils.rowMatchesLabels(r, srcs)
+        ]
@@ -0,0 +1,137 @@
+"""
+One Cloud Logging pipeline per process.
+
+setup() creates the single google.cloud.logging Client and the default
+handler for the environment (AppEngineHandler on App Engine), and attaches
+it to the root logger once. Every module then just uses 'import logging'.
+
+Request threads never touch the network or the handler:
+  request thread:  logging.info(...) -> _RequestFields filter (adds trace,
+                   http_request and labels while the Flask request is still
+                   available) -> _BoundedQueueHandler (put_nowait)
+  listener thread: QueueListener -> Cloud Logging handler ->
+                   BackgroundThreadTransport, which batches entries
+                   (LOG_BATCH_SIZE / LOG_MAX_LATENCY_SEC) into write calls
+
+The queue holds at most LOG_QUEUE_SIZE records. When it is full the record
+is dropped and counted instead of blocking the request; stats() reports the
+depth and drop count.
+
+Per-request fields: addFields(key=value) during a request adds labels to
+every later record of that request.
+"""
+import atexit
+import functools
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from flask import g, has_request_context, request
+from tetrad.api_consts import *
+
+
+# The logging library's own loggers must not feed back into the pipeline
+EXCLUDED_LOGGERS = ("google.cloud", "google.auth", "google_auth_httplib2", "urllib3")
+
+_setup_lock = threading.Lock()
+_listener = None
+_queue_handler = None
+_project = None
+
+
+class _BoundedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking when the queue is full"""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.enqueued = 0
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+
+class _RequestFields(logging.Filter):
+    """Stamps request data on the record while it is still on the request thread"""
+
+    def filter(self, record):
+        if not has_request_context():
+            return True
+        record.http_request = {
+            'requestMethod': request.method,
+            'requestUrl': request.url,
+            'userAgent': request.user_agent.string,
+            'remoteIp': request.remote_addr,
+            'referer': request.referrer,
+        }
+        header = request.headers.get('X-Cloud-Trace-Context')
+        if header and _project:
+            record.trace = f"projects/{_project}/traces/{header.split('/', 1)[0]}"
+        labels = {'endpoint': str(request.endpoint)}
+        labels.update(g.get('log_fields', {}))
+        record.labels = labels
+        return True
+
+
+def addFields(**fields):
+    """Add labels to every record logged for the rest of this request"""
+    if has_request_context():
+        if 'log_fields' not in g:
+            g.log_fields = {}
+        g.log_fields.update({k: str(v) for k, v in fields.items()})
+
+
+def setup():
+    """Attach the queued Cloud Logging pipeline to the root logger (once per process)"""
+    global _listener, _queue_handler, _project
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        import google.cloud.logging
+        from google.cloud.logging_v2.handlers.transports import BackgroundThreadTransport
+
+        client = google.cloud.logging.Client()
+        _project = client.project
+        transport = functools.partial(
+            BackgroundThreadTransport,
+            batch_size=LOG_BATCH_SIZE,
+            max_latency=LOG_MAX_LATENCY_SEC,
+        )
+        cloud_handler = client.get_default_handler(transport=transport)
+
+        _queue_handler = _BoundedQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        _queue_handler.addFilter(_RequestFields())
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, cloud_handler,
+                                                   respect_handler_level=True)
+        _listener.start()
+        # Registered after the transport's own atexit flush, so it runs first:
+        # drain our queue into the transport, then the transport flushes.
+        atexit.register(_listener.stop)
+
+        root = logging.getLogger()
+        # The App Engine runtime installs its own stderr handler; entries would be written twice
+        root.handlers.clear()
+        root.setLevel(logging.INFO)
+        root.addHandler(_queue_handler)
+
+        for name in EXCLUDED_LOGGERS:
+            excluded = logging.getLogger(name)
+            excluded.propagate = False
+            excluded.addHandler(logging.StreamHandler(sys.stderr))
+
+
+def stats():
+    if _queue_handler is None:
+        return None
+    return {
+        'queued': _queue_handler.queue.qsize(),
+        'capacity': LOG_QUEUE_SIZE,
+        'enqueued': _queue_handler.enqueued,
+        'dropped': _queue_handler.dropped,
+    }
@@ -0,0 +1,96 @@
+"""
+Cursor-based pagination for /requestData.
+
+The first request (with 'limit') runs the query once. Its page token is a
+signed reference to that finished BigQuery job and the page size, and every
+page after that is read straight out of the job's destination (results) table with
+list_rows(start_index=page * limit) -- the query is never re-run. Because a
+page is addressed by (page_token, page), clients can fetch pages in any order
+or in parallel. BigQuery keeps query results for about 24 hours, after which
+the token expires.
+
+Tokens are signed with a key kept in Secret Manager (the secret named by
+PAGE_TOKEN_SECRET, a JSON object {"key": "..."}); without it pagination is
+turned off rather than signed with something guessable. A token can only
+point at a job /requestData created for paging: those jobs carry the
+PAGE_JOB_LABEL label, and readPage() refuses any other job.
+"""
+from itsdangerous import BadSignature, URLSafeSerializer
+from google.api_core.exceptions import NotFound
+from google.cloud.bigquery import QueryJob
+from tetrad import admin_utils
+from tetrad.api_consts import *
+from tetrad.classes import ArgumentError
+import logging
+
+
+# Label on the query jobs page tokens may refer to
+PAGE_JOB_LABEL = {'tetrad_pages': 'requestdata'}
+
+
+def _serializer():
+    """Serializer keyed with the current secret; ArgumentError (503) if there isn't one"""
+    try:
+        key = admin_utils._access_secret_version(PAGE_TOKEN_SECRET)['key'] if PAGE_TOKEN_SECRET else None
+    except Exception as e:
+        logging.error(f"Could not read the page token secret: {repr(e)}")
+        key = None
+    if not key:
+        raise ArgumentError("Pagination ('limit', 'page_token') is not available right now.", status_code=503)
+    return URLSafeSerializer(key, salt="requestData.page_token")
+
+
+def checkAvailable():
+    """Fail before running a paged query if its token couldn't be signed"""
+    _serializer()
+
+
+def encodeToken(job, limit):
+    return _serializer().dumps({'job': job.job_id, 'loc': job.location, 'limit': limit})
+
+
+def decodeToken(token):
+    """(job_id, location, limit) of a page token"""
+    serializer = _serializer()
+    try:
+        d = serializer.loads(token)
+        job_id, location, limit = d['job'], d['loc'], d['limit']
+    except (BadSignature, KeyError, TypeError):
+        raise ArgumentError("Argument 'page_token' is not valid", status_code=400)
+    if not isinstance(limit, int) or not (0 < limit <= PAGE_LIMIT_MAX):
+        raise ArgumentError("Argument 'page_token' is not valid", status_code=400)
+    return job_id, location, limit
+
+
+def pageCount(total_rows, limit):
+    return max(1, -(-total_rows // limit))
+
+
+def readPage(client, job_id, location, page, limit):
+    """
+    Rows [page * limit, (page + 1) * limit) of a finished query job.
+    Returns (rows as list of dicts, total_rows).
+    """
+    try:
+        job = client.get_job(job_id, location=location)
+        if (not isinstance(job, QueryJob) or job.destination is None
+                or any(job.labels.get(k) != v for k, v in PAGE_JOB_LABEL.items())):
+            raise ArgumentError("Argument 'page_token' is not valid", status_code=400)
+        rows = client.list_rows(job.destination, start_index=page * limit, max_results=limit, page_size=limit)
+        data = [dict(r) for r in rows]
+    except NotFound:
+        raise ArgumentError("Argument 'page_token' has expired. Re-run the query without it.", status_code=410)
+    return data, rows.total_rows
+
+
+def pageHeaders(token, page, limit, total_rows):
+    n_pages = pageCount(total_rows, limit)
+    headers = {
+        'X-Page-Token': token,
+        'X-Page': str(page),
+        'X-Page-Count': str(n_pages),
+        'X-Total-Rows': str(total_rows),
+    }
+    if page + 1 < n_pages:
+        headers['X-Next-Page'] = str(page + 1)
+    return headers
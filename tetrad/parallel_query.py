@@ -0,0 +1,174 @@
+"""
+Run one long-range query as several day-aligned sub-queries at once.
+
+A multi-week SELECT ... ORDER BY Timestamp is one big sort in BigQuery and one
+long serial download here. Splitting [start, end] on UTC day boundaries (the
+telemetry table's partitions) lets the sub-queries run concurrently; each one
+is fetched by its own thread into a small bounded queue, and the sub-results
+are k-way merged back into Timestamp order as they are consumed.
+
+All requests in a process share one pool of PARALLEL_QUERY_POOL_SIZE threads.
+A request reserves a thread for every sub-query before starting any of them
+(and splits into fewer pieces when the pool is busy, or runs serially when it
+is full), so a producer never waits in the pool's queue behind another
+request's producers while its own consumer waits on it.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import heapq
+import math
+import queue
+import threading
+import pytz
+from tetrad.api_consts import *
+from tetrad.classes import NoDataError
+
+
+_DONE = object()
+
+_pool = ThreadPoolExecutor(max_workers=PARALLEL_QUERY_POOL_SIZE, thread_name_prefix="parallel-query")
+_free_lock = threading.Lock()
+_free = PARALLEL_QUERY_POOL_SIZE
+
+
+def _reserve(n):
+    """Reserve up to 'n' pool threads; returns how many were reserved"""
+    global _free
+    with _free_lock:
+        k = min(n, _free)
+        _free -= k
+        return k
+
+
+def _release(n=1):
+    global _free
+    with _free_lock:
+        _free += n
+
+
+def splitRange(start, end, max_parts=PARALLEL_QUERY_WORKERS, end_exclusive=False):
+    """
+    Split [start, end] on UTC midnights into at most 'max_parts' pieces.
+    Returns [(sub_start, sub_end, end_exclusive), ...]; every piece is
+    [sub_start, sub_end) except the last, which keeps the inclusive 'end'
+    (unless 'end_exclusive').
+    """
+    start_utc = start.astimezone(pytz.utc)
+    day = datetime(start_utc.year, start_utc.month, start_utc.day, tzinfo=pytz.utc) + timedelta(days=1)
+    bounds = []
+    while day < end:
+        bounds.append(day)
+        day += timedelta(days=1)
+
+    # Too many days: group consecutive days so there are at most 'max_parts' pieces
+    step = math.ceil((len(bounds) + 1) / max(1, max_parts))
+    bounds = bounds[step - 1::step] if step > 1 else bounds
+
+    edges = [start] + bounds + [end]
+    return [(edges[i], edges[i + 1], end_exclusive or i + 1 < len(edges) - 1) for i in range(len(edges) - 1)]
+
+
+def _produce(fetch_pages, sub_range, q, cancelled):
+    """Fetch one sub-range page by page into 'q' until done (or the consumer goes away)"""
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for page in fetch_pages(*sub_range):
+            if not put(page):
+                return
+    except NoDataError:
+        # Empty sub-range, nothing to contribute
+        pass
+    except Exception as e:
+        put(e)
+    put(_DONE)
+
+
+def _producer(fetch_pages, sub_range, q, cancelled):
+    """_produce() on a reserved pool thread, handed back once it is done"""
+    try:
+        _produce(fetch_pages, sub_range, q, cancelled)
+    finally:
+        _release()
+
+
+def _consume(q):
+    """Rows from one producer's queue, in the order they were fetched"""
+    while True:
+        item = q.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        for row in item:
+            yield row
+
+
+def _paged(rows, page_size):
+    page = []
+    for row in rows:
+        page.append(row)
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def _mergedPages(fetch_pages, ranges, page_size, prefetch):
+    """Merge 'ranges' fetched on the shared pool; one pool thread must already be reserved per range"""
+    cancelled = threading.Event()
+    queues = [queue.Queue(maxsize=prefetch) for _ in ranges]
+    try:
+        for sub_range, q in zip(ranges, queues):
+            _pool.submit(_producer, fetch_pages, sub_range, q, cancelled)
+
+        ts = FIELD_MAP["TIMESTAMP"]
+        merged = heapq.merge(*[_consume(q) for q in queues], key=lambda r: r[ts])
+        yield from _paged(merged, page_size)
+    finally:
+        cancelled.set()
+
+
+def mergedPages(fetch_pages, start, end, page_size=STREAM_PAGE_SIZE,
+                max_parts=PARALLEL_QUERY_WORKERS, prefetch=PARALLEL_QUERY_PREFETCH_PAGES, end_exclusive=False):
+    """
+    Pages (lists of dicts) for [start, end] in Timestamp order, fetched as
+    concurrent day-aligned sub-queries.
+    'fetch_pages(sub_start, sub_end, end_exclusive)' must return an iterator of
+    pages for one sub-range (raising NoDataError if it is empty).
+
+    The first page is fetched before returning, so a completely
+    empty result raises NoDataError here rather than mid-response.
+    """
+    ranges = splitRange(start, end, max_parts, end_exclusive)
+    k = _reserve(len(ranges))
+    if k < 2:
+        # Pool is (nearly) full: one query in the request thread instead
+        _release(k)
+        pages = iter(fetch_pages(start, end, end_exclusive))
+    else:
+        if k < len(ranges):
+            ranges = splitRange(start, end, k, end_exclusive)
+            _release(k - len(ranges))
+        pages = _mergedPages(fetch_pages, ranges, page_size, prefetch)
+    try:
+        first = next(pages)
+    except StopIteration:
+        raise NoDataError("No data returned.", status_code=222)
+
+    def gen():
+        yield first
+        yield from pages
+    return gen()
+
+
+def shouldSplit(start, end):
+    return (end - start) >= timedelta(hours=PARALLEL_QUERY_MIN_RANGE_HOURS)
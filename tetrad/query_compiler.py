@@ -0,0 +1,355 @@
+"""
+Parameterized SQL for the API routes.
+
+Every query is split into a fixed template, which depends only on the *shape*
+of the request (fields x label mode x region mode x device filter x
+aggregation), and the request's values, which are bound as BigQuery query
+parameters. Identical shapes produce byte-identical SQL, so BigQuery's result
+cache can work, no value is ever spliced into the SQL, and templates are
+memoized so repeated shapes skip string building altogether.
+"""
+import functools
+import json
+from google.cloud.bigquery import ArrayQueryParameter, ScalarQueryParameter
+from tetrad import utils
+from tetrad.api_consts import *
+
+
+def regionMode(bbox=None, radius=None):
+    if bbox:
+        return "bbox"
+    elif radius:
+        return "radius"
+    return None
+
+
+# agg 'fn' argument -> BigQuery aggregate
+AGG_FUNCTIONS = {
+    "mean":   "AVG({})",
+    "median": "APPROX_QUANTILES({}, 2)[OFFSET(1)]",
+    "min":    "MIN({})",
+    "max":    "MAX({})",
+    "count":  "COUNT({})",
+}
+
+# Fields that can't be averaged; one value per bucket is kept instead
+NON_NUMERIC_FIELDS = ("TIMESTAMP", "DEVICEID", "SOURCE", "LABEL")
+
+
+def aggregateFields(fields, fn):
+    """
+    SELECT list for time-bucketed rows: one row per (DeviceID, @agg_sec bucket),
+    same column names as queryBuildFields(fields).
+    Buckets are aligned to the epoch so they never depend on 'start'.
+    """
+    agg = AGG_FUNCTIONS[fn]
+    cols = [
+        FIELD_MAP["DEVICEID"],
+        f'TIMESTAMP_SECONDS(DIV(UNIX_SECONDS({FIELD_MAP["TIMESTAMP"]}), @agg_sec) * @agg_sec) '
+        f'AS {FIELD_MAP["TIMESTAMP"]}',
+        f'ANY_VALUE({FIELD_MAP["SOURCE"]}) AS {FIELD_MAP["SOURCE"]}',
+        f'ANY_VALUE({FIELD_MAP["LABEL"]}) AS {FIELD_MAP["LABEL"]}',
+        f'AVG(ST_Y({FIELD_MAP["GPS"]})) AS Latitude',
+        f'AVG(ST_X({FIELD_MAP["GPS"]})) AS Longitude',
+    ]
+    for field in fields:
+        col = FIELD_MAP[field]
+        if field == "GPS":
+            cols.append(f"ST_CENTROID_AGG({col}) AS {col}")
+        elif field in NON_NUMERIC_FIELDS:
+            cols.append(f"ANY_VALUE({col}) AS {col}")
+        else:
+            cols.append(f"{agg.format(col)} AS {col}")
+    return ",\n            ".join(cols)
+
+
+def cleanedSource(fields):
+    """
+    FROM-clause source with the requested PM2.5/temperature/humidity columns
+    cleaned inside BigQuery, the SQL form of cleaning.cleanValues():
+      - bad flags/thresholds become NULL
+      - PM2.5 is corrected with the calibration segment its Timestamp falls in.
+        RANGE_BUCKET over @cal_bounds is np.searchsorted over
+        CorrectionFactors.boundaries, and the per-segment slope/intercept
+        arrays are the calibration table, bound as parameters (cleaningParams)
+    """
+    pm, temp, hum = FIELD_MAP["PM2_5"], FIELD_MAP["TEMPERATURE"], FIELD_MAP["HUMIDTY"]
+    replace = []
+    if "PM2_5" in fields:
+        replace.append(f"""CASE
+                    WHEN {pm} = @pm_bad_flag OR {pm} >= @pm_bad_thresh THEN NULL
+                    WHEN @cal_covered[SAFE_OFFSET(_cal)]
+                        THEN GREATEST(0, {pm} * @cal_slope[SAFE_OFFSET(_cal)] + @cal_intercept[SAFE_OFFSET(_cal)])
+                    ELSE {pm}
+                END AS {pm}""")
+    if "TEMPERATURE" in fields:
+        replace.append(f"IF({temp} = @temp_bad_flag, NULL, {temp}) AS {temp}")
+    if "HUMIDTY" in fields:
+        replace.append(f"IF({hum} = @hum_bad_flag, NULL, {hum}) AS {hum}")
+    if not replace:
+        return f"`{BQ_PATH_TELEMETRY}`"
+
+    if "PM2_5" in fields:
+        return f"""(
+            SELECT * EXCEPT (_cal) REPLACE (
+                {", ".join(replace)})
+            FROM (
+                SELECT *, RANGE_BUCKET(UNIX_MICROS({FIELD_MAP["TIMESTAMP"]}), @cal_bounds) - 1 AS _cal
+                FROM `{BQ_PATH_TELEMETRY}`)
+        )"""
+    return f"""(
+            SELECT * REPLACE (
+                {", ".join(replace)})
+            FROM `{BQ_PATH_TELEMETRY}`
+        )"""
+
+
+def cleaningParams(fields):
+    """Parameters of cleanedSource(fields), from the active correction factors"""
+    params = []
+    if "PM2_5" in fields:
+        bounds_us, covered, slope, intercept = utils.correctionFactors().segments()
+        params += [
+            ScalarQueryParameter("pm_bad_flag", "FLOAT64", PM_BAD_FLAG),
+            ScalarQueryParameter("pm_bad_thresh", "FLOAT64", PM_BAD_THRESH),
+            ArrayQueryParameter("cal_bounds", "INT64", bounds_us),
+            ArrayQueryParameter("cal_covered", "BOOL", covered),
+            ArrayQueryParameter("cal_slope", "FLOAT64", slope),
+            ArrayQueryParameter("cal_intercept", "FLOAT64", intercept),
+        ]
+    if "TEMPERATURE" in fields:
+        params.append(ScalarQueryParameter("temp_bad_flag", "FLOAT64", TEMP_BAD_FLAG))
+    if "HUMIDTY" in fields:
+        params.append(ScalarQueryParameter("hum_bad_flag", "FLOAT64", HUM_BAD_FLAG))
+    return params
+
+
+@functools.lru_cache(maxsize=512)
+def requestDataTemplate(fields, label_mode, region_mode, with_devices, end_exclusive=False, agg_fn=None, clean=False):
+    """
+    SQL template for one /requestData shape. 'fields' must be a tuple.
+    With 'agg_fn', rows are aggregated per device into @agg_sec buckets.
+    With 'clean', bad values and correction factors are handled in SQL (cleanedSource).
+    """
+    if region_mode == "bbox":
+        query_region = f"ST_WITHIN({FIELD_MAP['GPS']}, ST_GEOGFROMGEOJSON(@bbox))"
+    elif region_mode == "radius":
+        query_region = f"ST_DWITHIN({FIELD_MAP['GPS']}, ST_GEOGPOINT(@center_lon, @center_lat), @radius_m)"
+    else:
+        query_region = "True"
+
+    query_devs = utils.idsToWHEREClause(FIELD_MAP['DEVICEID']) if with_devices else "True"
+
+    if agg_fn:
+        query_fields = aggregateFields(fields, agg_fn)
+        group_by = "GROUP BY 1, 2"
+    else:
+        query_fields = utils.queryBuildFields(fields)
+        group_by = ""
+
+    return f"""
+        SELECT
+            {query_fields}
+        FROM
+            {cleanedSource(fields) if clean else f"`{BQ_PATH_TELEMETRY}`"}
+        WHERE
+            {utils.queryBuildLabelMode(label_mode)}
+                AND
+            {FIELD_MAP["TIMESTAMP"]} >= @start
+                AND
+            {FIELD_MAP["TIMESTAMP"]} {'<' if end_exclusive else '<='} @end
+                AND
+            {query_region}
+                AND
+            {query_devs}
+        {group_by}
+        ORDER BY
+            {FIELD_MAP["TIMESTAMP"]}
+    """
+
+
+def regionParams(bbox=None, radius=None, center=None):
+    if bbox:
+        n, s, e, w = bbox['lat_hi'], bbox['lat_lo'], bbox['lon_hi'], bbox['lon_lo']
+        polygon = {"type": "Polygon", "coordinates": [[[e, n], [e, s], [w, s], [w, n], [e, n]]]}
+        return [ScalarQueryParameter("bbox", "STRING", json.dumps(polygon))]
+    elif radius:
+        return [
+            ScalarQueryParameter("center_lat", "FLOAT64", center['lat']),
+            ScalarQueryParameter("center_lon", "FLOAT64", center['lon']),
+            ScalarQueryParameter("radius_m", "FLOAT64", radius * 1000),
+        ]
+    return []
+
+
+def requestDataQuery(srcs, fields, start, end, bbox=None, radius=None, center=None, id_ls=None, end_exclusive=False,
+                     agg=None, fn=None, clean=BQ_CLEAN_IN_SQL):
+    """(sql, query_parameters) for a /requestData request. 'agg' is the bucket size in seconds"""
+    agg_fn = (fn or "mean") if agg else None
+    sql = requestDataTemplate(
+        tuple(fields), utils.queryLabelMode(srcs), regionMode(bbox, radius), bool(id_ls), end_exclusive, agg_fn,
+        clean)
+
+    params = [
+        ScalarQueryParameter("start", "TIMESTAMP", start),
+        ScalarQueryParameter("end", "TIMESTAMP", end),
+    ]
+    params += utils.queryLabelParams(srcs)
+    params += regionParams(bbox, radius, center)
+    if id_ls:
+        params += utils.idsQueryParams(id_ls)
+    if agg:
+        params.append(ScalarQueryParameter("agg_sec", "INT64", agg))
+    if clean:
+        params += cleaningParams(fields)
+    return sql, params
+
+
+@functools.lru_cache(maxsize=256)
+def liveSensorsTemplate(fields, label_mode):
+    """Latest row per device over the last @delta minutes. 'fields' must be a tuple"""
+    return f"""
+    SELECT
+        * EXCEPT(row_num)
+    FROM
+        (
+            SELECT
+                *,
+                ROW_NUMBER()
+            OVER
+                (
+                    PARTITION BY
+                        {FIELD_MAP["DEVICEID"]}
+                    ORDER BY
+                        {FIELD_MAP["TIMESTAMP"]} DESC
+                ) row_num
+            FROM
+                (
+                    SELECT
+                        {utils.queryBuildFields(fields)}
+                    FROM
+                        `{BQ_PATH_TELEMETRY}`
+                    WHERE
+                        {utils.queryBuildLabelMode(label_mode)}
+                            AND
+                        {FIELD_MAP["TIMESTAMP"]} >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @delta MINUTE)
+                )
+        )
+    WHERE
+        row_num = 1;
+    """
+
+
+def liveSensorsQuery(srcs, fields, delta):
+    """(sql, query_parameters) for the /liveSensors BigQuery fallback"""
+    sql = liveSensorsTemplate(tuple(fields), utils.queryLabelMode(srcs))
+    params = [ScalarQueryParameter("delta", "INT64", delta)] + utils.queryLabelParams(srcs)
+    return sql, params
+
+
+# /gridData cell expressions: (inner SELECT columns, outer SELECT columns, GROUP BY columns)
+GRID_CELLS = {
+    # Regular lat/lon grid, @res degrees per cell. Cells are reported at their centers
+    "latlon": (
+        f"""CAST(FLOOR(ST_Y({FIELD_MAP["GPS"]}) / @res) AS INT64) AS CellY,
+                    CAST(FLOOR(ST_X({FIELD_MAP["GPS"]}) / @res) AS INT64) AS CellX""",
+        """FORMAT('%d:%d', CellY, CellX) AS Cell,
+            (CellY + 0.5) * @res AS Latitude,
+            (CellX + 0.5) * @res AS Longitude""",
+        "CellY, CellX",
+    ),
+    # Hierarchical S2 cells at level @res. Cells are reported at the centroid of their readings
+    "s2": (
+        f"""S2_CELLIDFROMPOINT({FIELD_MAP["GPS"]}, @res) AS CellID,
+                    ST_Y({FIELD_MAP["GPS"]}) AS Lat,
+                    ST_X({FIELD_MAP["GPS"]}) AS Lon""",
+        """CAST(CellID AS STRING) AS Cell,
+            AVG(Lat) AS Latitude,
+            AVG(Lon) AS Longitude""",
+        "CellID",
+    ),
+}
+
+
+@functools.lru_cache(maxsize=256)
+def gridTemplate(field, label_mode, grid, with_region):
+    """
+    Per-cell statistics of 'field' for every @bucket_sec time bucket in [@start, @end).
+    Readings are cleaned and corrected first (cleanedSource), so bad flags don't
+    skew the cells and PM2.5 matches /requestData.
+    With 'with_region', only readings inside @lat_lo..@lat_hi, @lon_lo..@lon_hi count.
+    """
+    inner_cols, outer_cols, group_cols = GRID_CELLS[grid]
+    if with_region:
+        query_region = f"""ST_Y({FIELD_MAP["GPS"]}) BETWEEN @lat_lo AND @lat_hi
+                        AND
+                    ST_X({FIELD_MAP["GPS"]}) BETWEEN @lon_lo AND @lon_hi"""
+    else:
+        query_region = "True"
+
+    return f"""
+        SELECT
+            {FIELD_MAP["TIMESTAMP"]},
+            {outer_cols},
+            COUNT(*) AS Count,
+            AVG(Value) AS Mean,
+            MAX(Value) AS Max,
+            COUNT(DISTINCT {FIELD_MAP["DEVICEID"]}) AS Devices
+        FROM
+            (
+                SELECT
+                    TIMESTAMP_SECONDS(DIV(UNIX_SECONDS({FIELD_MAP["TIMESTAMP"]}), @bucket_sec) * @bucket_sec)
+                        AS {FIELD_MAP["TIMESTAMP"]},
+                    {inner_cols},
+                    {FIELD_MAP["DEVICEID"]},
+                    {FIELD_MAP[field]} AS Value
+                FROM
+                    {cleanedSource((field,))}
+                WHERE
+                    {utils.queryBuildLabelMode(label_mode)}
+                        AND
+                    {FIELD_MAP["TIMESTAMP"]} >= @start
+                        AND
+                    {FIELD_MAP["TIMESTAMP"]} < @end
+                        AND
+                    {FIELD_MAP["GPS"]} IS NOT NULL
+                        AND
+                    {FIELD_MAP[field]} IS NOT NULL
+                        AND
+                    {query_region}
+            )
+        GROUP BY
+            {FIELD_MAP["TIMESTAMP"]}, {group_cols}
+        ORDER BY
+            {FIELD_MAP["TIMESTAMP"]}
+    """
+
+
+def gridQuery(srcs, field, start, end, grid, res, bucket_sec, region=None):
+    """(sql, query_parameters) for /gridData over [start, end). 'region' is a REGION_INFO entry"""
+    sql = gridTemplate(field, utils.queryLabelMode(srcs), grid, bool(region))
+
+    params = [
+        ScalarQueryParameter("start", "TIMESTAMP", start),
+        ScalarQueryParameter("end", "TIMESTAMP", end),
+        ScalarQueryParameter("bucket_sec", "INT64", bucket_sec),
+        ScalarQueryParameter("res", "INT64" if grid == "s2" else "FLOAT64", res),
+    ]
+    params += utils.queryLabelParams(srcs)
+    params += cleaningParams((field,))
+    if region:
+        params += [ScalarQueryParameter(k, "FLOAT64", region[k]) for k in ("lat_lo", "lat_hi", "lon_lo", "lon_hi")]
+    return sql, params
+
+
+def clearTemplates():
+    """Drop every memoized template (e.g. after the region config changes)"""
+    requestDataTemplate.cache_clear()
+    liveSensorsTemplate.cache_clear()
+    gridTemplate.cache_clear()
+    utils.queryBuildLabelMode.cache_clear()
+    utils._queryBuildFields.cache_clear()
+
+
+# Region predicates are baked into the templates
+utils.region_config.onChange(lambda region_info, generation: clearTemplates())
@@ -0,0 +1,80 @@
+"""
+Region geometry from REGION_INFO, compiled once per load.
+
+Regions are lat/lon bounding boxes. Instead of re-serializing every enabled
+region into a GeoJSON ST_WITHIN polygon on each request, compileRegions()
+turns them into
+  - a SQL fragment of plain range comparisons on ST_Y/ST_X, which BigQuery
+    evaluates far more cheaply than a polygon test per row, and
+  - NumPy arrays of the box edges, so in-process code can tell which region
+    a whole array of points falls in without any SQL.
+"""
+import numpy as np
+from tetrad.api_consts import *
+
+
+def regionSQL(lat_lo, lat_hi, lon_lo, lon_hi):
+    """Range-comparison predicate for one box (edges included)"""
+    return (f'(ST_Y({FIELD_MAP["GPS"]}) BETWEEN {lat_lo} AND {lat_hi} '
+            f'AND ST_X({FIELD_MAP["GPS"]}) BETWEEN {lon_lo} AND {lon_hi})')
+
+
+def regionsSQL(region_list):
+    """(<inside box> OR <inside box> OR ...); False for no regions"""
+    if not region_list:
+        return "False"
+    return '(' + ' OR '.join(
+        regionSQL(r['lat_lo'], r['lat_hi'], r['lon_lo'], r['lon_hi']) for r in region_list
+    ) + ')'
+
+
+class CompiledRegions:
+    """Enabled regions of one REGION_INFO, as arrays and as SQL"""
+
+    def __init__(self, region_info):
+        enabled = [(k, v) for k, v in region_info.items() if v['enabled']]
+        self.names = [k for k, _ in enabled]
+        self.lat_lo = np.array([v['lat_lo'] for _, v in enabled], dtype=np.float64)
+        self.lat_hi = np.array([v['lat_hi'] for _, v in enabled], dtype=np.float64)
+        self.lon_lo = np.array([v['lon_lo'] for _, v in enabled], dtype=np.float64)
+        self.lon_hi = np.array([v['lon_hi'] for _, v in enabled], dtype=np.float64)
+        self.sql = regionsSQL([v for _, v in enabled])
+
+    def _inside(self, lat, lon):
+        """(n_points, n_regions) boolean matrix"""
+        lat = np.asarray(lat, dtype=np.float64).reshape(-1, 1)
+        lon = np.asarray(lon, dtype=np.float64).reshape(-1, 1)
+        with np.errstate(invalid='ignore'):
+            return (lat >= self.lat_lo) & (lat <= self.lat_hi) & (lon >= self.lon_lo) & (lon <= self.lon_hi)
+
+    def inAny(self, lat, lon):
+        """True where a point is inside any enabled region. NaN coordinates are outside"""
+        return self._inside(lat, lon).any(axis=1)
+
+    def classify(self, lat, lon):
+        """
+        Index into self.names of the first region containing each point, -1 for none.
+        Overlapping regions resolve to the one listed first in REGION_INFO.
+        """
+        inside = self._inside(lat, lon)
+        if not self.names:
+            # argmax of an (n, 0) matrix raises
+            return np.full(len(inside), -1, dtype=np.int64)
+        idx = inside.argmax(axis=1)
+        idx[~inside.any(axis=1)] = -1
+        return idx
+
+    def labels(self, lat, lon, default=None):
+        """Region name for each point ('default' outside every region)"""
+        names = np.array(self.names + [default], dtype=object)
+        return names[self.classify(lat, lon)]
+
+    def contains(self, lat, lon):
+        """Single point version of inAny()"""
+        if lat is None or lon is None:
+            return False
+        return bool(self.inAny(lat, lon)[0])
+
+
+def compileRegions(region_info):
+    return CompiledRegions(region_info)
@@ -0,0 +1,173 @@
+"""
+In-process cache for /requestData results.
+
+Data older than the ingest lag never changes, so a historical window only has
+to be pulled from BigQuery once. Entries are keyed on a canonical form of the
+parsed arguments (sorted sources/fields/devices, timestamps in UTC), expire on
+a TTL that depends on whether the window touches "now", and are evicted LRU
+once the cache grows past its byte budget.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import sys
+import threading
+from time import time
+import pytz
+from tetrad.api_consts import *
+
+
+# name -> cache, so every cache's counters can be reported from one route
+CACHES = {}
+
+
+def _canonical(value):
+    """Hashable, order-independent form of a parsed argument"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.astimezone(pytz.utc).isoformat()
+    if isinstance(value, dict):
+        return tuple(sorted((k, _canonical(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(sorted(_canonical(v) for v in value))
+    if isinstance(value, float):
+        return repr(value)
+    return value
+
+
+def canonicalKey(endpoint, **args):
+    """
+    Key for a request: same arguments in any order/timezone -> same key.
+    canonicalKey('requestData', srcs=['b','a'], start=dt, ...)
+    """
+    return (endpoint,) + tuple(sorted((k, _canonical(v)) for k, v in args.items()))
+
+
+def estimateSize(data, sample=100):
+    """
+    Rough size in bytes of a list of flat dicts. Only the first
+    'sample' rows are measured and the rest are assumed similar.
+    """
+    if not data:
+        return sys.getsizeof(data)
+    head = data[:sample]
+    per_row = sum(
+        sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r.values())
+        for r in head
+    ) / len(head)
+    return int(sys.getsizeof(data) + per_row * len(data))
+
+
+class ResultCache:
+    """
+    LRU-by-bytes cache with per-entry TTL.
+    Windows ending before (now - ingest lag) get 'ttl_historical',
+    anything that touches "now" gets 'ttl_recent'.
+    """
+
+    def __init__(self, name, max_bytes=RESULT_CACHE_MAX_BYTES, ttl_historical=RESULT_CACHE_TTL_HISTORICAL_SEC,
+                 ttl_recent=RESULT_CACHE_TTL_RECENT_SEC, ingest_lag_sec=INGEST_LAG_SEC):
+        self.name = name
+        self.max_bytes = max_bytes
+        # One entry may use at most a quarter of the cache
+        self.max_item_bytes = max_bytes // 4
+        self.ttl_historical = ttl_historical
+        self.ttl_recent = ttl_recent
+        self.ingest_lag = timedelta(seconds=ingest_lag_sec)
+
+        self._entries = OrderedDict()   # key -> (value, nbytes, expires)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+
+        CACHES[name] = self
+
+    def ttlFor(self, end):
+        """TTL (seconds) for a window ending at 'end'"""
+        if end is not None and end < datetime.now(pytz.utc) - self.ingest_lag:
+            return self.ttl_historical
+        return self.ttl_recent
+
+    def get(self, key):
+        """Cached value, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, nbytes, expires = entry
+            if expires <= time():
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes, ttl):
+        """Store 'value' (of size 'nbytes') for 'ttl' seconds, evicting LRU entries as needed"""
+        if ttl <= 0 or nbytes > self.max_item_bytes:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, nbytes, time() + ttl)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+        return True
+
+    def _drop(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._bytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'rejected': self.rejected,
+            }
+
+
+def cachePages(pages, cache, key, ttl):
+    """
+    Pass pages (lists of dicts) through unchanged while collecting them,
+    and cache the whole result once the last page has gone out. Collection
+    stops as soon as the result gets too big for the cache.
+    """
+    collected, nbytes = [], 0
+    for page in pages:
+        if collected is not None:
+            collected.extend(page)
+            nbytes += estimateSize(page)
+            if nbytes > cache.max_item_bytes:
+                collected = None
+        yield page
+    if collected is not None:
+        cache.put(key, collected, nbytes, ttl)
+
+
+def allStats():
+    return {name: c.stats() for name, c in CACHES.items()}
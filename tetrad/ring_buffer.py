@@ -0,0 +1,405 @@
+"""
+Rolling in-memory window of recent telemetry, per device.
+
+Most /requestData calls ask for the last few hours. Each worker keeps the last
+RING_BUFFER_HOURS of every VALID_QUERY_FIELDS column for every device, and
+route() sends just the parts of a request outside the buffer to BigQuery.
+
+Devices upload backlogs late (after reconnecting, say), so a time range is
+only final once it is INGEST_LAG_SEC old -- the same assumption result_cache
+makes. The buffer keeps two parts:
+    settled   rows up to INGEST_LAG_SEC before the last refresh; appended to,
+              never re-read (a watermark, like LiveSnapshot)
+    tail      everything newer, up to the last refresh; re-read and replaced
+              as a whole on every refresh, so late rows show up in it
+Each refresh is one query from the watermark to now. A request for the most
+recent hours is answered from memory up to the last refresh (at most
+RING_BUFFER_REFRESH_SEC old, like /liveSensors); only if refreshes have
+stopped does the newest part go to BigQuery.
+
+Columns are flat typed arrays, not lists of dicts:
+    Timestamp            int64 microseconds since the epoch
+    Latitude/Longitude   float64, NaN without GPS
+    Source/Label         one byte per row (index into a shared string table;
+                         wider once a table outgrows 256 entries)
+    fields               float64, NaN for NULL
+so a row costs 8 * (3 + n_fields) + 2 bytes instead of a few hundred, and
+comes back exactly as BigQuery returns it.
+"""
+from array import array
+from datetime import datetime, timedelta
+import threading
+from time import sleep, time
+from google.cloud.bigquery import ScalarQueryParameter
+import numpy as np
+import pytz
+from tetrad import utils, bq_utils, geometry, cleaning
+from tetrad.api_consts import *
+from tetrad.classes import NoDataError
+import logging
+
+
+# Column name -> field, for every field the buffer keeps
+BUFFER_COLUMNS = {c: f for f, c in FIELD_MAP.items() if c and c in VALID_QUERY_FIELDS.values()}
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _micros(dt):
+    """datetime -> integer microseconds since the epoch (exact, unlike timestamp() * 1e6)"""
+    return (dt - _EPOCH) // _MICROSECOND
+
+
+class _Codes:
+    """Small string table so Source/Label cost one byte per row"""
+
+    def __init__(self):
+        self.values = []
+        self.index = {}
+
+    def code(self, value):
+        c = self.index.get(value)
+        if c is None:
+            c = len(self.values)
+            self.values.append(value)
+            self.index[value] = c
+        return c
+
+    def codes(self, values):
+        return [self.index[v] for v in values if v in self.index]
+
+
+def _column(arr, dtype):
+    return np.frombuffer(arr, dtype=dtype) if len(arr) else np.empty(0, dtype=dtype)
+
+
+class DeviceSeries:
+    """Buffered rows of one device, oldest first"""
+
+    __slots__ = ("ts", "lat", "lon", "src", "lbl", "values")
+
+    def __init__(self, columns):
+        self.ts = array('q')
+        self.lat = array('d')
+        self.lon = array('d')
+        self.src = array('B')
+        self.lbl = array('B')
+        self.values = {c: array('d') for c in columns}
+
+    def __len__(self):
+        return len(self.ts)
+
+    def append(self, ts_us, lat, lon, src, lbl, row):
+        self.ts.append(ts_us)
+        self.lat.append(np.nan if lat is None else lat)
+        self.lon.append(np.nan if lon is None else lon)
+        # Codes past 255: widen this series' code column instead of failing
+        if src > 255 and self.src.typecode == 'B':
+            self.src = array('I', self.src)
+        if lbl > 255 and self.lbl.typecode == 'B':
+            self.lbl = array('I', self.lbl)
+        self.src.append(src)
+        self.lbl.append(lbl)
+        for c, arr in self.values.items():
+            v = row.get(c)
+            arr.append(np.nan if v is None else v)
+
+    def trim(self, cutoff_us):
+        """Drop rows older than 'cutoff_us'. Returns the number of rows left"""
+        k = int(np.searchsorted(_column(self.ts, np.int64), cutoff_us, side='left'))
+        if k:
+            for arr in (self.ts, self.lat, self.lon, self.src, self.lbl, *self.values.values()):
+                del arr[:k]
+        return len(self.ts)
+
+    def slice(self, start_us, end_us, columns):
+        """Copies of the rows in [start_us, end_us] as numpy arrays, or None"""
+        ts = _column(self.ts, np.int64)
+        i0 = int(np.searchsorted(ts, start_us, side='left'))
+        i1 = int(np.searchsorted(ts, end_us, side='right'))
+        if i0 >= i1:
+            return None
+        return {
+            'ts': ts[i0:i1].copy(),
+            'lat': _column(self.lat, np.float64)[i0:i1].copy(),
+            'lon': _column(self.lon, np.float64)[i0:i1].copy(),
+            'src': np.array(self.src[i0:i1], dtype=np.uint32),
+            'lbl': np.array(self.lbl[i0:i1], dtype=np.uint32),
+            'values': {c: _column(self.values[c], np.float64)[i0:i1].copy() for c in columns},
+        }
+
+
+class TelemetryBuffer:
+    """
+    Last 'hours' of telemetry per DeviceID, refreshed incrementally from BigQuery.
+    Appends and reads share one lock; reads copy the rows they need out under it.
+    """
+
+    def __init__(self, bq_client, hours=RING_BUFFER_HOURS, refresh_sec=RING_BUFFER_REFRESH_SEC,
+                 lag_sec=INGEST_LAG_SEC):
+        self.bq_client = bq_client
+        self.window = timedelta(hours=hours)
+        self.refresh_sec = refresh_sec
+        self.lag = timedelta(seconds=lag_sec)
+        self.columns = list(BUFFER_COLUMNS)
+
+        self._series = {}
+        self._tail = {}
+        self._sources = _Codes()
+        self._labels = _Codes()
+        self._filled_from = None
+        self._watermark = None
+        self._tail_until = None
+        self._last_refresh = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.window > timedelta(0)
+
+    @property
+    def ready(self):
+        return self._last_refresh is not None
+
+    @property
+    def fresh(self):
+        """Refreshed within the last two refresh periods"""
+        return self.ready and time() - self._last_refresh <= 2 * self.refresh_sec
+
+    def start(self):
+        """Start the background refresh thread (once per process)"""
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="telemetry-buffer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"TelemetryBuffer refresh failed: {repr(e)}")
+            sleep(self.refresh_sec)
+
+    def _query(self, since, until):
+        query = f"""
+            SELECT
+                {utils.queryBuildFields([BUFFER_COLUMNS[c] for c in self.columns])}
+            FROM
+                `{BQ_PATH_TELEMETRY}`
+            WHERE
+                {FIELD_MAP["TIMESTAMP"]} > @since
+                    AND
+                {FIELD_MAP["TIMESTAMP"]} <= @until
+            ORDER BY
+                {FIELD_MAP["TIMESTAMP"]}
+        """
+        params = [ScalarQueryParameter("since", "TIMESTAMP", since), ScalarQueryParameter("until", "TIMESTAMP", until)]
+        job = bq_utils.runQuery(query, params, endpoint="ringBuffer", client=self.bq_client)
+        return job.result(page_size=STREAM_PAGE_SIZE).pages
+
+    def _append(self, series_map, ts_us, r):
+        dev = r[FIELD_MAP["DEVICEID"]]
+        series = series_map.get(dev)
+        if series is None:
+            series = series_map[dev] = DeviceSeries(self.columns)
+        elif ts_us < series.ts[-1]:
+            return
+        series.append(ts_us, r.get("Latitude"), r.get("Longitude"),
+                      self._sources.code(r.get(FIELD_MAP["SOURCE"])), self._labels.code(r.get(FIELD_MAP["LABEL"])), r)
+
+    def refresh(self):
+        """
+        Read everything after the watermark, up to now. Rows that have become
+        final (more than 'lag' old) are appended to the settled part, the rest
+        replace the tail; rows that have aged out of the window are dropped.
+        """
+        with self._refresh_lock:
+            now = datetime.now(pytz.utc)
+            oldest = now - self.window
+            since = oldest if self._watermark is None else max(oldest, self._watermark)
+            settled = max(since, now - self.lag)
+            settled_us = _micros(settled)
+
+            # Reads stop at the old watermark in _series until the new tail is swapped in below
+            tail = {}
+            for page in self._query(since, now):
+                with self._lock:
+                    for r in page:
+                        ts_us = _micros(r[FIELD_MAP["TIMESTAMP"]])
+                        self._append(self._series if ts_us <= settled_us else tail, ts_us, r)
+
+            # Trim once rows are a tenth of the window past due, not on every refresh
+            cutoff_us = _micros(oldest)
+            slack_us = int(self.window.total_seconds() * 1e5)
+            with self._lock:
+                for dev in list(self._series):
+                    series = self._series[dev]
+                    if series.ts[0] < cutoff_us - slack_us and series.trim(cutoff_us) == 0:
+                        del self._series[dev]
+                if self._filled_from is None:
+                    self._filled_from = since
+                self._watermark, self._tail, self._tail_until = settled, tail, now
+                self._last_refresh = time()
+
+    def coveredFrom(self):
+        """Start of the time range the buffer holds completely, or None before the first fill"""
+        if not self.ready:
+            return None
+        return max(self._filled_from, datetime.now(pytz.utc) - self.window)
+
+    def coveredUntil(self):
+        """End (inclusive) of the time range the buffer holds: its last refresh, or None before the first fill"""
+        return self._tail_until if self.ready else None
+
+    def route(self, start, end, fields, agg=None):
+        """
+        Split [start, end] between BigQuery and the buffer. Returns
+        (before, buffer, after), each a (start, end) pair or None:
+            before   [start, covered_from)          BigQuery, end-exclusive
+            buffer   [lo, hi]                       the buffer
+            after    [covered_until + 1us, end]     BigQuery, only if the buffer is stale
+        Without a buffered part, 'before' is the whole (inclusive) request.
+        """
+        lo = self.coveredFrom() if self.enabled else None
+        if lo is None or agg or any(FIELD_MAP.get(f) not in BUFFER_COLUMNS for f in fields):
+            return (start, end), None, None
+        hi = self.coveredUntil()
+        if end < lo or start > hi:
+            return (start, end), None, None
+        before = (start, lo) if start < lo else None
+        after = (hi + _MICROSECOND, end) if end > hi and not self.fresh else None
+        return before, (max(start, lo), min(end, hi)), after
+
+    def _labelMask(self, srcs, part):
+        mode = utils.queryLabelMode(srcs)
+        if mode == "all":
+            return None
+        if mode in ("tetrad", "purpleair", "aqandu"):
+            name = {"tetrad": "Tetrad", "purpleair": "PurpleAir", "aqandu": "AQ&U"}[mode]
+            return np.isin(part['src'], self._sources.codes([name]))
+        if mode == "labels":
+            return np.isin(part['lbl'], self._labels.codes(srcs))
+
+        # allgps
+        not_pa = ~np.isin(part['src'], self._sources.codes(["PurpleAir", None]))
+        is_global = np.isin(part['lbl'], self._labels.codes([BQ_LABEL_GLOBAL, "global"]))
+        bad = np.isin(part['lbl'], self._labels.codes([BQ_LABEL_BADGPS, "badgps"]))
+        has_gps = ~np.isnan(part['lat']) & ~np.isnan(part['lon'])
+        in_region = has_gps & utils.REGIONS.inAny(part['lat'], part['lon'])
+        return not_pa & (is_global | (~bad & in_region))
+
+    def _regionMask(self, part, bbox=None, radius=None, center=None):
+        if not (bbox or radius):
+            return None
+        lat, lon = part['lat'], part['lon']
+        if bbox:
+            return geometry.bboxMask(lat, lon, bbox['lat_lo'], bbox['lat_hi'], bbox['lon_lo'], bbox['lon_hi'])
+        return geometry.radiusMask(lat, lon, radius, center['lat'], center['lon'])
+
+    def _slices(self, start_us, end_us, columns, devices):
+        """
+        Copies of each device's buffered rows in [start_us, end_us], taken under
+        the lock: settled rows up to the watermark, tail rows after it.
+        Returns (parts, source names, label names).
+        """
+        parts = []
+        with self._lock:
+            watermark_us = _micros(self._watermark)
+            for series_map, lo, hi in ((self._series, start_us, min(end_us, watermark_us)),
+                                       (self._tail, max(start_us, watermark_us + 1), end_us)):
+                for dev, series in series_map.items():
+                    if devices is not None and dev not in devices:
+                        continue
+                    part = series.slice(lo, hi, columns)
+                    if part is not None:
+                        part['dev'] = dev
+                        parts.append(part)
+            return parts, list(self._sources.values), list(self._labels.values)
+
+    def _filtered(self, parts, srcs, bbox=None, radius=None, center=None):
+        """The parts (each cut down to its matching rows) that have rows left"""
+        kept = []
+        for part in parts:
+            masks = [m for m in (self._labelMask(srcs, part), self._regionMask(part, bbox, radius, center))
+                     if m is not None]
+            if masks:
+                mask = np.logical_and.reduce(masks)
+                if not mask.any():
+                    continue
+                part = {k: (v[mask] if isinstance(v, np.ndarray) else v) for k, v in part.items()}
+                part['values'] = {c: v[mask] for c, v in part['values'].items()}
+            kept.append(part)
+        return kept
+
+    @staticmethod
+    def _merged(kept, columns):
+        """Concatenate the parts in Timestamp order: (device index per row, row columns, field values)"""
+        ts = np.concatenate([p['ts'] for p in kept])
+        order = np.argsort(ts, kind='stable')
+        dev = np.concatenate([np.full(len(p['ts']), i) for i, p in enumerate(kept)])[order]
+        cols = {k: np.concatenate([p[k] for p in kept])[order] for k in ('lat', 'lon', 'src', 'lbl')}
+        cols['ts'] = ts[order]
+        values = {c: np.concatenate([p['values'][c] for p in kept])[order] for c in columns}
+        return dev, cols, values
+
+    def pages(self, srcs, fields, start, end, bbox=None, radius=None, center=None, id_ls=None,
+              page_size=STREAM_PAGE_SIZE, clean=False):
+        """
+        Pages (lists of dicts) of buffered rows in [start, end], in Timestamp
+        order, with the same columns as queryBuildFields(fields).
+        With 'clean', values are cleaned/corrected like query_compiler.cleanedSource() does in SQL.
+        Raises NoDataError if nothing matches.
+        """
+        columns = [FIELD_MAP[f] for f in fields]
+        parts, sources, labels = self._slices(_micros(start), _micros(end), columns, set(id_ls) if id_ls else None)
+        kept = self._filtered(parts, srcs, bbox=bbox, radius=radius, center=center)
+        if not kept:
+            raise NoDataError("No data returned.", status_code=222)
+
+        dev, cols, values = self._merged(kept, columns)
+        if clean:
+            cleaning.cleanValues(values, **utils.cleaningKeys(fields), factors=utils.correctionFactors(),
+                                 ts=cols['ts'] / 1e6)
+        dev_ids = [p['dev'] for p in kept]
+
+        def gen():
+            for i0 in range(0, len(dev), page_size):
+                i1 = min(i0 + page_size, len(dev))
+                page_cols = {
+                    FIELD_MAP["DEVICEID"]:  [dev_ids[d] for d in dev[i0:i1]],
+                    FIELD_MAP["TIMESTAMP"]: [_EPOCH + timedelta(microseconds=t) for t in cols['ts'][i0:i1].tolist()],
+                    FIELD_MAP["SOURCE"]:    [sources[c] for c in cols['src'][i0:i1]],
+                    FIELD_MAP["LABEL"]:     [labels[c] for c in cols['lbl'][i0:i1]],
+                }
+                for name, v in [("Latitude", cols['lat']), ("Longitude", cols['lon'])] + \
+                        [(c, values[c]) for c in columns]:
+                    v = v[i0:i1]
+                    page_cols[name] = np.where(np.isnan(v), None, v).tolist()
+                names = list(page_cols)
+                yield [dict(zip(names, row)) for row in zip(*page_cols.values())]
+        return gen()
+
+    def stats(self):
+        with self._lock:
+            all_series = list(self._series.values()) + list(self._tail.values())
+            rows = sum(len(s) for s in all_series)
+            nbytes = sum(len(s) * (8 * (3 + len(s.values)) + s.src.itemsize + s.lbl.itemsize) for s in all_series)
+            tail_rows = sum(len(s) for s in self._tail.values())
+        covered_from = self.coveredFrom()
+        return {
+            'devices': len(self._series.keys() | self._tail.keys()),
+            'rows': rows,
+            'tail_rows': tail_rows,
+            'bytes': nbytes,
+            'covered_from': covered_from.isoformat() if covered_from else None,
+            'watermark': self._watermark.isoformat() if self._watermark else None,
+            'covered_until': self._tail_until.isoformat() if self._tail_until else None,
+        }
@@ -0,0 +1,65 @@
+"""
+Sensor-day quality control, vectorized.
+
+A sensor's readings are dropped for any (Mountain Time day, DeviceID) whose
+mean PM2.5 is over 350 ug/m3, and for the day before and after it. Days are
+counted from 1970-01-01 00:00 MST like the original per-row version, but as
+integer division of epoch seconds, and the per-(day, device) means come from
+np.unique(return_inverse=True) + np.bincount instead of dicts.
+
+Only NumPy and pytz are needed, so tools/check_remove_invalid_sensors.py can
+load this file on its own.
+"""
+from datetime import datetime
+import numpy as np
+from pytz import timezone
+
+
+# Day boundaries: midnight at 1970-01-01's UTC offset in US/Mountain (MST, -7h), every 86400 s
+MOUNTAIN_EPOCH_SEC = timezone('US/Mountain').localize(datetime(1970, 1, 1)).timestamp()
+INVALID_DAY_MEAN_PM = 350
+
+
+def daysSinceEpoch(ts_sec):
+    """Mountain Time day index of each epoch-seconds timestamp (floor, like timedelta.days)"""
+    return np.floor_divide(np.asarray(ts_sec, dtype=np.float64) - MOUNTAIN_EPOCH_SEC, 86400).astype(np.int64)
+
+
+def validMask(ts_sec, device_ids, pm, limit=INVALID_DAY_MEAN_PM):
+    """
+    True for rows to keep: the row's (day, device) and its neighbouring days
+    all have a mean PM2.5 <= 'limit'.
+    """
+    day = daysSinceEpoch(ts_sec)
+    if not len(day):
+        return np.ones(0, dtype=bool)
+    # Device IDs -> small ints in order of first appearance (hashing beats sorting the strings)
+    codes = {}
+    dev = np.fromiter((codes.setdefault(d, len(codes)) for d in device_ids), dtype=np.int64, count=len(day))
+
+    # One int64 per (device, day). Days get one slot of padding on each side,
+    # so day +/- 1 never runs into the next device's range.
+    day0 = day.min() - 1
+    span = day.max() - day0 + 2
+    key = dev * span + (day - day0)
+
+    groups, inverse = np.unique(key, return_inverse=True)
+    counts = np.bincount(inverse)
+    sums = np.bincount(inverse, weights=np.asarray(pm, dtype=np.float64))
+    bad = groups[sums / counts > limit]
+
+    removed = np.concatenate([bad - 1, bad, bad + 1])
+    return ~np.isin(key, removed)
+
+
+def removeInvalidSensors(sensor_data, limit=INVALID_DAY_MEAN_PM):
+    """
+    Rows of 'sensor_data' (dicts with 'Timestamp', 'DeviceID', 'PM2_5') that
+    pass validMask(), in their original order.
+    """
+    if not sensor_data:
+        return sensor_data
+    ts = np.array([datum['Timestamp'].timestamp() for datum in sensor_data], dtype=np.float64)
+    pm = np.array([datum['PM2_5'] for datum in sensor_data], dtype=np.float64)
+    keep = validMask(ts, [datum['DeviceID'] for datum in sensor_data], pm, limit)
+    return [datum for datum, k in zip(sensor_data, keep.tolist()) if k]
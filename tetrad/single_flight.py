@@ -0,0 +1,148 @@
+"""
+Coalesce identical BigQuery queries into a single job.
+
+When a dashboard loads, many clients ask for the same URL within the same
+second. Rather than one BigQuery job each, the first request for a given
+(sql, parameters) starts the job and everyone else, for the next
+SINGLE_FLIGHT_TTL_SEC seconds, attaches to that same job and reads its
+results:
+  - inside a worker, followers wait on the leader's Future;
+  - across gunicorn workers, the leader writes the job id to a marker file
+    (creation is serialized with flock on a lock file) and followers in other
+    workers pick the job up with get_job().
+Only job *creation* is serialized; every waiter then calls job.result()
+itself, so followers never block each other while the job runs.
+SINGLE_FLIGHT_DIR is memory-backed on App Engine, so each worker sweeps out
+marker and lock files older than the TTL (at most once per TTL).
+"""
+from concurrent.futures import Future
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from time import time
+from tetrad.api_consts import *
+import logging
+
+
+_flights = {}   # key -> (Future of (job, nbytes), created)
+_flights_lock = threading.Lock()
+_last_sweep = 0
+
+
+def queryKey(sql, params=None, **extra):
+    """Canonical key for a query: its SQL text, bound parameter values and any job options"""
+    blob = json.dumps([sql, [p.to_api_repr() for p in (params or [])], extra], sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def _markerPaths(key):
+    os.makedirs(SINGLE_FLIGHT_DIR, exist_ok=True)
+    base = os.path.join(SINGLE_FLIGHT_DIR, key)
+    return base + ".lock", base + ".job"
+
+
+def _sweep(now):
+    """
+    Delete files in SINGLE_FLIGHT_DIR not touched for a TTL. Lock files still
+    held by another worker are left alone; losing a race here costs at most
+    one duplicate job, never a wrong result.
+    """
+    global _last_sweep
+    if now - _last_sweep < SINGLE_FLIGHT_TTL_SEC:
+        return
+    _last_sweep = now
+    try:
+        names = os.listdir(SINGLE_FLIGHT_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(SINGLE_FLIGHT_DIR, name)
+        try:
+            if now - os.path.getmtime(path) <= SINGLE_FLIGHT_TTL_SEC:
+                continue
+            if not name.endswith(".lock"):
+                os.unlink(path)
+                continue
+            with open(path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.unlink(path)
+        except OSError:
+            # Gone already, or locked by a worker that is starting a job
+            pass
+
+
+def _readMarker(path, client):
+    """(job, nbytes) from a fresh marker file written by another worker, else None"""
+    try:
+        if time() - os.path.getmtime(path) > SINGLE_FLIGHT_TTL_SEC:
+            return None
+        with open(path) as f:
+            marker = json.load(f)
+        return client.get_job(marker['job_id'], location=marker['location']), marker['nbytes']
+    except (OSError, ValueError, KeyError):
+        return None
+    except Exception as e:
+        logging.warning(f"single_flight: could not attach to job from {path}: {repr(e)}")
+        return None
+
+
+def _writeMarker(path, job, nbytes):
+    tmp = f"{path}.{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump({'job_id': job.job_id, 'location': job.location, 'nbytes': nbytes}, f)
+    os.replace(tmp, path)
+
+
+def _startOrAttach(key, start, client):
+    """Across workers: attach to a job another worker just started, or start one and advertise it"""
+    lock_path, marker_path = _markerPaths(key)
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # Fresh mtime: in use, so _sweep() leaves it
+            os.utime(lock_path)
+            found = _readMarker(marker_path, client)
+            if found is not None:
+                return found
+            job, nbytes = start()
+            _writeMarker(marker_path, job, nbytes)
+            return job, nbytes
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def coalescedJob(key, start, client):
+    """
+    (job, nbytes) for query 'key'. 'start()' creates the job and returns
+    (job, nbytes); it runs at most once per key per TTL across all workers.
+    Returns (job, nbytes, leader) where 'leader' is False if the job was shared.
+    """
+    now = time()
+    with _flights_lock:
+        for k in [k for k, (_, created) in _flights.items() if now - created > SINGLE_FLIGHT_TTL_SEC]:
+            del _flights[k]
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            future = Future()
+            _flights[key] = (future, now)
+        else:
+            future = flight[0]
+
+    if not leader:
+        job, nbytes = future.result()
+        return job, nbytes, False
+
+    _sweep(now)
+    try:
+        job, nbytes = _startOrAttach(key, start, client)
+    except BaseException as e:
+        # Don't leave followers holding a failed flight for the whole TTL
+        with _flights_lock:
+            _flights.pop(key, None)
+        future.set_exception(e)
+        raise
+    future.set_result((job, nbytes))
+    return job, nbytes, True
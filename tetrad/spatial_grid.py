@@ -0,0 +1,63 @@
+"""
+Spatial grid aggregation for zoomed-out maps (/gridData).
+
+Instead of one row per sensor, BigQuery bins readings into cells of a
+regular lat/lon grid or of the hierarchical S2 grid and returns count, mean
+and max per cell, for every epoch-aligned time bucket in the request.
+
+Cell results are cached per time bucket: the key is (sources, field, region,
+grid, resolution, bucket size, calibration version, bucket start). A request whose buckets are
+partly cached only queries the span of the missing ones, so panning the time
+slider on a map mostly hits the cache.
+"""
+from datetime import datetime, timedelta
+import pytz
+from tetrad.api_consts import *
+from tetrad.classes import ArgumentError
+from tetrad import result_cache
+
+
+def bucketStarts(start, end, bucket_sec):
+    """
+    Starts of the epoch-aligned buckets covering [start, end).
+    The first bucket starts at or before 'start'; the last one ends at or after 'end'.
+    """
+    first = int(start.timestamp()) // bucket_sec * bucket_sec
+    last = int(end.timestamp())
+    n = max(1, -(-(last - first) // bucket_sec))
+    if n > GRID_MAX_BUCKETS:
+        raise ArgumentError(
+            f"Request spans {n} time buckets; the limit is {GRID_MAX_BUCKETS}. Use a larger 'agg' or a shorter range.",
+            status_code=400)
+    t0 = datetime.fromtimestamp(first, pytz.utc)
+    return [t0 + timedelta(seconds=i * bucket_sec) for i in range(n)]
+
+
+def gridCells(cache, key_args, buckets, bucket_sec, fetch):
+    """
+    Cells for every bucket in 'buckets', from 'cache' where possible.
+    fetch(start, end) returns the cell rows of [start, end) from BigQuery;
+    it is called at most once, over the span of the uncached buckets.
+    Returns (rows in bucket order, number of buckets that were cached).
+    """
+    step = timedelta(seconds=bucket_sec)
+    keys = {b: result_cache.canonicalKey('gridData', bucket=b, **key_args) for b in buckets}
+    found = {b: cache.get(keys[b]) for b in buckets}
+    missing = [b for b in buckets if found[b] is None]
+
+    if missing:
+        lo, hi = missing[0], missing[-1] + step
+        fetched = {b: [] for b in missing}
+        for row in fetch(lo, hi):
+            cells = fetched.get(row[FIELD_MAP["TIMESTAMP"]])
+            if cells is not None:
+                cells.append(row)
+        for b, cells in fetched.items():
+            # Empty buckets are cached too, so they aren't queried again
+            cache.put(keys[b], cells, result_cache.estimateSize(cells), cache.ttlFor(b + step))
+            found[b] = cells
+
+    rows = []
+    for b in buckets:
+        rows.extend(found[b])
+    return rows, len(buckets) - len(missing)
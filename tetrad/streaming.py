@@ -0,0 +1,229 @@
+"""
+Incremental response bodies for large query results.
+
+Instead of '[dict(r) for r in rows]' + jsonify(), these generators walk a
+BigQuery RowIterator one page at a time and yield encoded chunks, so only a
+single page is ever held in memory and the first bytes go out as soon as the
+first page arrives.
+
+Formats:
+    json     one JSON array of row objects (same as the non-streamed response)
+    ndjson   one JSON row object per line
+    columns  one JSON object per page and per line: {field: [values of that page]}
+    csv      header line + one line per row
+    msgpack  a stream of MessagePack maps, one per row
+    parquet  a Parquet file with one row group per page (needs pyarrow)
+"""
+import csv
+from datetime import datetime
+import io
+from flask import Response, json, stream_with_context
+import msgpack
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+STREAM_FORMATS = {
+    "json":    "application/json",
+    "ndjson":  "application/x-ndjson",
+    "columns": "application/x-ndjson",
+    "csv":     "text/csv",
+    "msgpack": "application/msgpack",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Accept header -> format, for clients that negotiate instead of passing 'format'
+ACCEPT_FORMATS = {
+    "application/json":               "json",
+    "application/x-ndjson":           "ndjson",
+    "text/csv":                       "csv",
+    "application/msgpack":            "msgpack",
+    "application/x-msgpack":          "msgpack",
+    "application/vnd.apache.parquet": "parquet",
+}
+
+
+def iterPages(rows):
+    """
+    Yield lists of dicts, one list per page of the RowIterator.
+    Plain iterables (already-materialized lists) come out as a single page.
+    """
+    pages = getattr(rows, "pages", None)
+    if pages is None:
+        yield [dict(r) for r in rows]
+        return
+    for page in pages:
+        yield [dict(r) for r in page]
+
+
+def genJSON(pages):
+    """Encode pages as one JSON array, written a page at a time"""
+    yield "["
+    first = True
+    for page in pages:
+        if not page:
+            continue
+        chunk = ",".join(json.dumps(r) for r in page)
+        if first:
+            first = False
+            yield chunk
+        else:
+            yield "," + chunk
+    yield "]\n"
+
+
+def genNDJSON(pages):
+    """Encode pages as newline-delimited JSON, one row per line"""
+    for page in pages:
+        if page:
+            yield "\n".join(json.dumps(r) for r in page) + "\n"
+
+
+def genColumns(pages):
+    """Encode each page as one line of {field: [values]}; keys are only written once per page"""
+    for page in pages:
+        if page:
+            names = list(page[0])
+            yield json.dumps({n: [r.get(n) for r in page] for n in names}) + "\n"
+
+
+def _plain(value):
+    """Timestamps as ISO-8601 for the non-JSON encoders"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def genCSV(pages):
+    """Encode pages as CSV. The header comes from the first row"""
+    names = None
+    for page in pages:
+        if not page:
+            continue
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if names is None:
+            names = list(page[0])
+            writer.writerow(names)
+        writer.writerows([_plain(r.get(n)) for n in names] for r in page)
+        yield buf.getvalue()
+
+
+def genMsgpack(pages):
+    """Encode pages as a stream of MessagePack maps (read with msgpack.Unpacker)"""
+    packer = msgpack.Packer(default=_plain)
+    for page in pages:
+        if page:
+            yield b"".join(packer.pack(r) for r in page)
+
+
+class _DrainSink(io.RawIOBase):
+    """
+    Write-only file for ParquetWriter that hands out what was written so far
+    with drain(). tell() keeps counting across drains, so the offsets Arrow
+    records for row groups (and writes into the footer) stay right.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        out = b"".join(self._chunks)
+        self._chunks = []
+        return out
+
+
+def _arrowType(kind):
+    return {
+        "string":    pa.string(),
+        "float":     pa.float64(),
+        "int":       pa.int64(),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+    }[kind]
+
+
+def _arrowSchema(page, columns=None):
+    """
+    Schema for the whole file: the known type of every column in 'columns'
+    ({name: "string"|"float"|"int"|"timestamp"}), anything else inferred from
+    the first page, with all-null columns assumed numeric.
+    """
+    columns = columns or {}
+    names = list(page[0])
+    unknown = [n for n in names if n not in columns]
+    inferred = pa.Table.from_pydict({n: [r.get(n) for r in page] for n in unknown}).schema if unknown else []
+    inferred = {f.name: (pa.float64() if pa.types.is_null(f.type) else f.type) for f in inferred}
+    return pa.schema([
+        pa.field(n, _arrowType(columns[n]) if n in columns else inferred[n])
+        for n in names
+    ])
+
+
+def genParquet(pages, columns=None):
+    """Encode pages as one Parquet file, flushing a row group per page"""
+    sink = _DrainSink()
+    writer = None
+    for page in pages:
+        if not page:
+            continue
+        if writer is None:
+            schema = _arrowSchema(page, columns)
+            writer = pq.ParquetWriter(sink, schema)
+        cols = {n: [r.get(n) for r in page] for n in schema.names}
+        writer.write_table(pa.Table.from_pydict(cols, schema=schema))
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+STREAM_ENCODERS = {
+    "json":    genJSON,
+    "ndjson":  genNDJSON,
+    "columns": genColumns,
+    "csv":     genCSV,
+    "msgpack": genMsgpack,
+    "parquet": genParquet,
+}
+
+
+def availableFormats():
+    if pq is None:
+        return [f for f in STREAM_ENCODERS if f != "parquet"]
+    return list(STREAM_ENCODERS)
+
+
+def negotiateFormat(accept_mimetypes):
+    """Format for a request's Accept header, or None if it doesn't ask for anything but JSON"""
+    best = accept_mimetypes.best_match(list(ACCEPT_FORMATS), default=None)
+    fmt = ACCEPT_FORMATS.get(best)
+    if fmt == "json" or fmt not in availableFormats():
+        return None
+    return fmt
+
+
+def streamResponse(pages, fmt="json", status=200, columns=None):
+    """
+    Wrap an iterable of pages into a chunked Flask Response. 'columns'
+    ({name: kind}, see utils.columnKinds) fixes the Parquet schema up front.
+    """
+    body = genParquet(pages, columns) if fmt == "parquet" else STREAM_ENCODERS[fmt](pages)
+    return Response(stream_with_context(body), status=status, mimetype=STREAM_FORMATS[fmt])
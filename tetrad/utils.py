@@ -1,21 +1,22 @@
 from os import getenv
-from datetime import datetime, timedelta
+from datetime import timedelta
 import dateutil
 from dateutil import parser as dateutil_parser
-from pytz import timezone
 # from utm import from_latlon
 # from matplotlib.path import Path
 # from scipy import interpolate
 # from scipy.io import loadmat
 from csv import reader as csv_reader
-import math 
-from flask import jsonify
+from flask import jsonify, g, has_request_context
 import numpy as np
 import re
-from google.cloud.storage import Client as GSClient
-import json
+from google.cloud.bigquery import ArrayQueryParameter
+import functools
 from tetrad.classes import ArgumentError
+from tetrad import geometry, regions, corrections, cleaning, sensor_qc
+from tetrad.gcs_config import GCSConfig
 from tetrad.api_consts import *
+import logging
 
 
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S+0000"
@@ -30,21 +31,48 @@ BQ_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 # MODEL_BOXES = getModelBoxes()
 
 
-def get_region_info():    
-    gs_client = GSClient()
-    bucket = gs_client.get_bucket(getenv("GS_BUCKET"))
-    blob = bucket.get_blob(getenv("GS_REGION_INFO_FILENAME"))
-    return json.loads(blob.download_as_string())
-REGION_INFO = get_region_info()
+# REGION_INFO lives in GCS. It is loaded and revalidated in the background
+# (gcs_config.py); everything derived from it is rebuilt in _setRegionInfo()
+region_config = GCSConfig(
+    getenv("GS_BUCKET"), getenv("GS_REGION_INFO_FILENAME"), REGION_INFO_REFRESH_SEC, name="region_info")
+
+
+def get_region_info():
+    """Current REGION_INFO, waiting for the first load if it hasn't finished"""
+    return region_config.get()
+
+
+REGION_INFO = {}
+
+# Enabled regions as range-comparison SQL and a vectorized point classifier
+REGIONS = regions.compileRegions(REGION_INFO)
 
 # All regions with bounding boxes
-ACTIVE_REGIONS = [k for k,v in REGION_INFO.items() if v['enabled']]
+ACTIVE_REGIONS = []
 
 # All regions with GPS coordinates
-ALL_GPS_LABELS = ACTIVE_REGIONS + [BQ_LABEL_GLOBAL]
+ALL_GPS_LABELS = [BQ_LABEL_GLOBAL]
 
 # All labels
-ALL_LABELS = ACTIVE_REGIONS + [BQ_LABEL_BADGPS, BQ_LABEL_GLOBAL, "all", "allgps", "tetrad", "purpleair", "aqandu"]
+ALL_LABELS = [BQ_LABEL_BADGPS, BQ_LABEL_GLOBAL, "all", "allgps", "tetrad", "purpleair", "aqandu"]
+
+
+def _setRegionInfo(region_info, generation=None):
+    """Rebuild everything derived from REGION_INFO, then swap it all in at once"""
+    global REGION_INFO, REGIONS, ACTIVE_REGIONS, ALL_GPS_LABELS, ALL_LABELS
+    active = [k for k,v in region_info.items() if v['enabled']]
+    compiled = regions.compileRegions(region_info)
+    REGION_INFO, REGIONS, ACTIVE_REGIONS, ALL_GPS_LABELS, ALL_LABELS = (
+        region_info,
+        compiled,
+        active,
+        active + [BQ_LABEL_GLOBAL],
+        active + [BQ_LABEL_BADGPS, BQ_LABEL_GLOBAL, "all", "allgps", "tetrad", "purpleair", "aqandu"],
+    )
+    queryBuildLabelMode.cache_clear()
+
+
+region_config.onChange(_setRegionInfo)
 
 
 # def getModelRegion(src):
@@ -122,146 +150,198 @@ def parseDatetimeString(datetime_string:str):
 #         return bounding_box_vertices
 
 
+def parseCorrectionFactors(lines):
+    """correction_factors.csv lines -> [{'start_date', 'end_date', '3003_slope', '3003_intercept', ...}]"""
+    rows = [row for row in csv_reader(lines, delimiter=',')]
+    header = rows[0]
+    rows = rows[1:]
+    correction_factors = []
+    for row in rows:
+        rowDict = {name: elem for elem, name in zip(row, header)}
+        rowDict['start_date'] = parseDatetimeString(rowDict['start_date'])
+        rowDict['end_date']   = parseDatetimeString(rowDict['end_date'])
+        rowDict['3003_slope'] = float(rowDict['3003_slope'])
+        rowDict['3003_intercept'] = float(rowDict['3003_intercept'])
+        correction_factors.append(rowDict)
+    return correction_factors
+
+
 def loadCorrectionFactors():
     with open(getenv("CORRECTION_FACTORS_FILENAME")) as csv_file:
-        read_csv = csv_reader(csv_file, delimiter=',')
-        rows = [row for row in read_csv]
-        header = rows[0]
-        rows = rows[1:]
-        correction_factors = []
-        for row in rows:
-            rowDict = {name: elem for elem, name in zip(row, header)}
-            rowDict['start_date'] = parseDatetimeString(rowDict['start_date'])
-            rowDict['end_date']   = parseDatetimeString(rowDict['end_date'])
-            rowDict['3003_slope'] = float(rowDict['3003_slope'])
-            rowDict['3003_intercept'] = float(rowDict['3003_intercept'])
-            correction_factors.append(rowDict)
-        return correction_factors
+        return parseCorrectionFactors(csv_file)
+
+
+@functools.lru_cache(maxsize=1)
+def _localCorrectionFactors():
+    """The CSV deployed with the app, parsed once per process"""
+    return corrections.CorrectionFactors(
+        loadCorrectionFactors(), version="file:" + getenv("CORRECTION_FACTORS_FILENAME"))
+
+
+def _parseCorrectionFactorsBlob(blob_bytes):
+    """A new upload must parse and be non-empty, or the version in use stays active"""
+    factors = parseCorrectionFactors(blob_bytes.decode().splitlines())
+    if not factors:
+        raise ValueError("correction factors blob has no factors")
+    return corrections.CorrectionFactors(factors)
+
+
+# Correction factors live in GCS when GS_CORRECTION_FACTORS_FILENAME is set. They are parsed
+# into an index on the loader thread and swapped in whole, stamped with the blob's generation
+CORRECTION_FACTORS = None
+
+correction_config = GCSConfig(
+    getenv("GS_BUCKET"), getenv("GS_CORRECTION_FACTORS_FILENAME"), CORRECTION_FACTORS_REFRESH_SEC,
+    name="correction_factors",
+    parse=_parseCorrectionFactorsBlob,
+) if getenv("GS_CORRECTION_FACTORS_FILENAME") else None
+
+
+def _setCorrectionFactors(factors, generation):
+    global CORRECTION_FACTORS
+    factors.version = f"gs:{generation}"
+    CORRECTION_FACTORS = factors
+
+
+if correction_config is not None:
+    correction_config.onChange(_setCorrectionFactors)
+
+
+def correctionFactors():
+    """
+    The active correction-factor index (see corrections.py): the GCS version once
+    it has loaded, the deployed CSV until then. Never waits on the network.
+    Records the version used in this request, for the X-Correction-Factors header.
+    """
+    factors = CORRECTION_FACTORS or _localCorrectionFactors()
+    if has_request_context():
+        g.correction_factors_version = factors.version
+    return factors
+
+
+def _timestampSeconds(data):
+    """Epoch seconds of each row's 'Timestamp' (NaN where missing)"""
+    return np.array([d['Timestamp'].timestamp() if d.get('Timestamp') is not None else np.nan for d in data],
+                    dtype=np.float64)
+
+
+def _correctRows(data, rows, pm25_key):
+    """Apply correction factors (in place) to data[i][pm25_key] for every index i in 'rows'"""
+    if not len(rows):
+        return
+    pm = np.array([data[i][pm25_key] for i in rows], dtype=np.float64)
+    ts = _timestampSeconds([data[i] for i in rows])
+    factors = correctionFactors()
+    hit = factors.factorIndex(ts) >= 0
+    corrected = factors.apply(pm, ts)
+    for i, h, v in zip(rows, hit, corrected.tolist()):
+        if h:
+            data[i][pm25_key] = v
 
 
 def applyCorrectionFactor(factors, data_timestamp, data):
-    for factor in factors:
-        factor_start = factor['start_date']
-        factor_end = factor['end_date']
-        if factor_start <= data_timestamp and factor_end > data_timestamp:
-            return max(0, data * factor['3003_slope'] + factor['3003_intercept'])
-    print('\nNo correction factor found for ', data_timestamp)
-    return data
+    """Single reading; 'factors' is a corrections.CorrectionFactors"""
+    return float(factors.apply([data], [data_timestamp.timestamp()])[0])
 
 
 def applyCorrectionFactorsToList(data_list, pm25_key=None):
     """Apply correction factors (in place) to PM2.5 data in data_list"""
-    
-    # Open the file and get correction factors
-    with open(getenv("CORRECTION_FACTORS_FILENAME")) as csv_file:
-        read_csv = csv_reader(csv_file, delimiter=',')
-        rows = [row for row in read_csv]
-        header = rows[0]
-        rows = rows[1:]
-        correction_factors = []
-        for row in rows:
-            rowDict = {name: elem for elem, name in zip(row, header)}
-            rowDict['start_date'] = parseDatetimeString(rowDict['start_date'])
-            rowDict['end_date'] = parseDatetimeString(rowDict['end_date'])
-            rowDict['3003_slope'] = float(rowDict['3003_slope'])
-            rowDict['3003_intercept'] = float(rowDict['3003_intercept'])
-            correction_factors.append(rowDict)
-        
-    # Apply the correction factors to the PM2.5 data
-    for datum in data_list:
-        try:
-            datum[pm25_key] = applyCorrectionFactor(correction_factors, datum['Timestamp'], datum[pm25_key])
-        except: # Only try once. We just assume it isn't there if the first row doesn't have it
-            return data_list
-        # found = False
-        # for factor in correction_factors:
-        #     factor_start = factor['start_date']
-        #     factor_end = factor['end_date']
-        #     if factor_start <= datum['Timestamp'] < factor_end:
-        #         datum['PM2_5'] = datum['PM2_5'] * factor['3003_slope'] + factor['3003_intercept']
-        #         found = True
-        #         break
-        # if not found:
-        #     print('\nNo correction factor found for ', datum['Timestamp'])
+    # We assume the field isn't there if the first row doesn't have it
+    if not data_list or data_list[0].get(pm25_key) is None:
+        return data_list
+    rows = [i for i, datum in enumerate(data_list) if datum.get(pm25_key) is not None]
+    _correctRows(data_list, rows, pm25_key)
     return data_list
 
 
-def _tuneData(data:list, pm25_key=None, temp_key=None, hum_key=None, removeNulls=False):
-    """ Clean data and apply correction factors """
-    # Open the file and get correction factors
-    if pm25_key:
-        with open(getenv("CORRECTION_FACTORS_FILENAME")) as csv_file:
-            read_csv = csv_reader(csv_file, delimiter=',')
-            rows = [row for row in read_csv]
-            header = rows[0]
-            rows = rows[1:]
-            correction_factors = []
-            for row in rows:
-                rowDict = {name: elem for elem, name in zip(row, header)}
-                rowDict['start_date'] = parseDatetimeString(rowDict['start_date'])
-                rowDict['end_date'] = parseDatetimeString(rowDict['end_date'])
-                rowDict['3003_slope'] = float(rowDict['3003_slope'])
-                rowDict['3003_intercept'] = float(rowDict['3003_intercept'])
-                correction_factors.append(rowDict)
-        
-    goodPM, goodTemp, goodHum = True, True, True
-    for datum in data:
-        if pm25_key and goodPM:
-            try:
-                if (datum[pm25_key] == getenv("PM_BAD_FLAG")) or (datum[pm25_key] >= getenv("PM_BAD_THRESH")):
-                    datum[pm25_key] = None
-                else:
-                    datum[pm25_key] = applyCorrectionFactor(correction_factors, datum['Timestamp'], datum[pm25_key])
-            except:
-                goodPM = False
-
-        if temp_key and goodTemp:
-            try:
-                if datum[temp_key] == getenv("TEMP_BAD_FLAG"):
-                    datum[temp_key] = None 
-            except:
-                goodTemp = False
-
-        if hum_key and goodHum:
-            try:
-                if datum[hum_key] == getenv("HUM_BAD_FLAG"):
-                    datum[hum_key] = None 
-            except:
-                goodHum = False
-    
-    if removeNulls:
-
-        # If True, remove all rows with Null data
-        if isinstance(removeNulls, bool):
-            len_before = len(data)
-            data = [datum for datum in data if all(datum.values())]
-            len_after = len(data)
-            print(f"removeNulls=True. Removed {len_before - len_after} rows. [{len_before} -> {len_after}]")
-        
-        # If it's a list, remove the rows missing data listed in removeNulls list        
-        elif isinstance(removeNulls, list):
-            if verifyFields(removeNulls):
-                # Make sure each of the fields specified by removeNulls is in the row. 
-                data = [datum for datum in data if all([datum[field] for field in removeNulls])]
-            else:
-                raise ArgumentError(f"(Internal error): removeNulls bad field name: {removeNulls}", 500)
-        
-        else:
-            raise ArgumentError(f"(Internal error): removeNulls must be bool or list, but was: {type(removeNulls)}", 500)
+def _removeNullsKeys(removeNulls, keys):
+    """Columns whose nulls drop a row: None (removeNulls=False), all 'keys' (True) or the listed fields"""
+    if removeNulls is False or removeNulls is None:
+        return None
 
+    # If True, remove all rows with Null data
+    if isinstance(removeNulls, bool):
+        return list(keys)
+
+    # If it's a list, remove the rows missing data listed in removeNulls list
+    if isinstance(removeNulls, list):
+        if verifyFields(removeNulls):
+            return [FIELD_MAP[field] for field in removeNulls]
+        raise ArgumentError(f"(Internal error): removeNulls bad field name: {removeNulls}", 500)
+
+    raise ArgumentError(f"(Internal error): removeNulls must be bool or list, but was: {type(removeNulls)}", 500)
+
+
+def _tuneData(data:list, pm25_key=None, temp_key=None, hum_key=None, removeNulls=False):
+    """ 
+    Clean data and apply correction factors (see cleaning.py).
+    The rows are turned into columns for the fields being cleaned, cleaned
+    there, and the results written back into the same dicts.
+    """
+    if not data:
+        return data
+
+    # We assume a field isn't there if the first row doesn't have it
+    null_keys = _removeNullsKeys(removeNulls, list(data[0]))
+    value_keys = [k for k in (pm25_key, temp_key, hum_key) if k and k in data[0]]
+    cols = {}
+    for k in set(value_keys) | set(null_keys or []):
+        values = [datum.get(k) for datum in data]
+        col = cleaning.floatColumn(values) if k in value_keys else None
+        if col is None:
+            if k in value_keys:
+                logging.error(f"_tuneData: '{k}' has non-numeric values, not cleaned")
+            col = np.array(values, dtype=object)
+        cols[k] = col
+
+    ts = _timestampSeconds(data) if pm25_key in value_keys else None
+    rejected = cleaning.cleanValues(cols, pm25_key, temp_key, hum_key, factors=correctionFactors(), ts=ts)
+    for k in rejected:
+        out = cols[k].astype(object)
+        out[np.isnan(cols[k])] = None
+        for datum, v in zip(data, out.tolist()):
+            datum[k] = v
+
+    report = {'rows': len(data), 'rejected': rejected, 'nulls': {}, 'removed': 0}
+    if null_keys is not None:
+        keep, report['nulls'] = cleaning.keepMask(cols, null_keys)
+        report['removed'] = len(data) - int(keep.sum())
+        if report['removed']:
+            data = [datum for datum, k in zip(data, keep.tolist()) if k]
+    cleaning.record(report)
     return data
         
 
-def tuneAllFields(data, fields, removeNulls=False):
-    return _tuneData(
-            data,
-            pm25_key=(FIELD_MAP["PM2_5"] if "PM2_5" in fields else None),
-            temp_key=(FIELD_MAP["TEMPERATURE"] if "TEMPERATURE" in fields else None),
-            hum_key=(FIELD_MAP["HUMIDITY"] if "HUMIDITY" in fields else None),
-            removeNulls=removeNulls,
+def cleaningKeys(fields):
+    return dict(
+        pm25_key=(FIELD_MAP["PM2_5"] if "PM2_5" in fields else None),
+        temp_key=(FIELD_MAP["TEMPERATURE"] if "TEMPERATURE" in fields else None),
+        # FIELD_MAP (and so argParseFields) spells it "HUMIDTY"
+        hum_key=(FIELD_MAP["HUMIDTY"] if ("HUMIDTY" in fields or "HUMIDITY" in fields) else None),
     )
 
 
+def tuneAllFields(data, fields, removeNulls=False):
+    return _tuneData(data, removeNulls=removeNulls, **cleaningKeys(fields))
+
+
+def _tuneColumns(cols:dict, pm25_key=None, temp_key=None, hum_key=None, removeNulls=False):
+    """ 
+    Column-wise version of _tuneData() for {name: np.ndarray} batches
+    (see columnar.py). Bad values become NaN, PM2.5 gets correction factors.
+    """
+    ts = None
+    if pm25_key and cols.get(FIELD_MAP["TIMESTAMP"]) is not None:
+        ts = cols[FIELD_MAP["TIMESTAMP"]].astype("datetime64[us]").astype(np.int64) / 1e6
+    cols, _ = cleaning.clean(cols, pm25_key, temp_key, hum_key, factors=correctionFactors(), ts=ts,
+                             null_keys=_removeNullsKeys(removeNulls, list(cols)))
+    return cols
+
+
+def tuneAllColumns(cols, fields, removeNulls=False):
+    return _tuneColumns(cols, removeNulls=removeNulls, **cleaningKeys(fields))
+
+
 # def loadLengthScales():
 #     with open(getenv("LENGTH_SCALES_FILENAME")) as csv_file:
 #         read_csv = csv_reader(csv_file, delimiter=',')
@@ -294,34 +374,12 @@ def tuneAllFields(data, fields, removeNulls=False):
 
 
 def removeInvalidSensors(sensor_data):
-    # sensor is invalid if its average reading for any day exceeds 350 ug/m3
-    epoch = datetime(1970, 1, 1)
-    epoch = timezone('US/Mountain').localize(epoch)
-    dayCounts = {}
-    dayReadings = {}
-
-    # Accumulate total PM and # entries for each sensor and each day
-    for datum in sensor_data:
-        pm25 = datum['PM2_5']
-        datum['daysSinceEpoch'] = (datum['Timestamp'] - epoch).days
-        key = (datum['daysSinceEpoch'], datum['DeviceID'])
-        if key in dayCounts:
-            dayCounts[key] += 1
-            dayReadings[key] += pm25
-        else:
-            dayCounts[key] = 1
-            dayReadings[key] = pm25
-
-    # get days that had higher than 350 avg reading
-    keysToRemove = [key for key in dayCounts if (dayReadings[key] / dayCounts[key]) > 350]
-    keysToRemoveSet = set()
-    for key in keysToRemove:
-        keysToRemoveSet.add(key)
-        keysToRemoveSet.add((key[0] + 1, key[1]))
-        keysToRemoveSet.add((key[0] - 1, key[1]))
-
-    print(f'Removing these days from data due to exceeding 350 ug/m3 avg: {keysToRemoveSet}')
-    sensor_data = [datum for datum in sensor_data if (datum['daysSinceEpoch'], datum['DeviceID']) not in keysToRemoveSet]
+    # sensor is invalid if its average reading for any day exceeds 350 ug/m3 (see sensor_qc.py)
+    len_before = len(sensor_data)
+    sensor_data = sensor_qc.removeInvalidSensors(sensor_data)
+    if len(sensor_data) != len_before:
+        logging.info(f"removeInvalidSensors: removed {len_before - len(sensor_data)} rows on days averaging over "
+                     f"{sensor_qc.INVALID_DAY_MEAN_PM} ug/m3 (and the days around them)")
 
     # TODO NEEDS TESTING!
     # 5003 sensors are invalid if Raw 24-hour average PM2.5 levels are > 5 ug/m3
@@ -417,44 +475,94 @@ def convertRadiusToBBox(r, c):
 def distBetweenCoords(p1, p2):
     """
     Get the Great Circle Distance between two
-    GPS coordinates, in kilometers
+    GPS coordinates, in kilometers.
+    p1 and p2 are (lat, lon); either may also be a pair of arrays
     """
-    R = 6371
-    phi1 = p1[0] * (math.pi / 180)
-    phi2 = p2[0] * (math.pi / 180)
-    del1 = (p2[0] - p1[0]) * (math.pi / 180)
-    del2 = (p2[1] - p1[1]) * (math.pi / 180)
-    
-    a = math.sin(del1 / 2) * math.sin(del1 / 2) +   \
-        math.cos(phi1) * math.cos(phi2) *           \
-        math.sin(del2 / 2) * math.sin(del2 / 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    d = R * c 
-    return d
+    return geometry.haversineKm(p1[0], p1[1], p2[0], p2[1])
+
 
 def coordsInCircle(coords, radius, center):
-    return distBetweenCoords(coords, center) <= radius
+    return geometry.radiusMask(coords[0], coords[1], radius, center[0], center[1])
 
 
 def bboxDataToRadiusData(data, radius, center):
-    inRad = []
-    for datum in data:
-        lat = datum[FIELD_MAP["LATITUDE"]]
-        lon = datum[FIELD_MAP["LONGITUDE"]]
-        if coordsInCircle((lat, lon), radius, center):
-            inRad.append(datum)
-    return inRad
+    """
+    Rows of 'data' (dicts with Latitude/Longitude, as from queryBuildFields)
+    within 'radius' km of 'center', given as (lat, lon) or {'lat':, 'lon':}
+    """
+    if not data:
+        return []
+    if isinstance(center, dict):
+        center = (center['lat'], center['lon'])
+    lat, lon = geometry.coordsFromRows(data)
+    inRad = geometry.radiusMask(lat, lon, radius, center[0], center[1])
+    return [datum for datum, keep in zip(data, inRad) if keep]
+
 
+GRID_TYPES = ("latlon", "s2")
 
-def idsToWHEREClause(ids, id_field_name):
+
+def argParseGrid(grid:str, res:str):
+    """
+    Parse the /gridData 'grid' and 'res' arguments into (grid, res).
+    'latlon' cells are 'res' degrees on a side (default 0.01);
+    's2' cells are S2 level 'res', 0 (coarsest) to GRID_S2_LEVEL_MAX (default 12).
+    """
+    grid = (grid or "latlon").lower()
+    if grid not in GRID_TYPES:
+        raise ArgumentError(f"Argument 'grid' must be one of: {', '.join(GRID_TYPES)}", status_code=400)
+
+    try:
+        if grid == "s2":
+            res = int(res) if res is not None else 12
+            ok = 0 <= res <= GRID_S2_LEVEL_MAX
+        else:
+            res = float(res) if res is not None else 0.01
+            ok = GRID_LATLON_RES_MIN <= res <= 10
+    except ValueError:
+        ok = False
+    if not ok:
+        if grid == "s2":
+            raise ArgumentError(f"Argument 'res' must be an S2 level from 0 to {GRID_S2_LEVEL_MAX}", status_code=400)
+        raise ArgumentError(f"Argument 'res' must be a cell size from {GRID_LATLON_RES_MIN} to 10 (degrees)",
+                            status_code=400)
+    return grid, res
+
+
+def argParseRegion(region:str):
+    """Parse a 'region' argument into its REGION_INFO bounds"""
+    if region is None:
+        return region
+
+    region = region.lower()
+    if region not in ACTIVE_REGIONS:
+        raise ArgumentError(f"Argument 'region' must be one of: {', '.join(ACTIVE_REGIONS)}", status_code=400)
+    r = REGION_INFO[region]
+    return {'lat_lo': r['lat_lo'], 'lat_hi': r['lat_hi'], 'lon_lo': r['lon_lo'], 'lon_hi': r['lon_hi']}
+
+
+def argParseNumericField(field:str):
+    """Parse a single 'field' that can be averaged"""
+    field = field.upper()
+    if field not in VALID_QUERY_FIELDS or field not in FIELD_MAP:
+        valid = ', '.join(f for f in VALID_QUERY_FIELDS if f in FIELD_MAP)
+        raise ArgumentError(f"Argument 'field' must be one of: {valid}", status_code=400)
+    return field
+
+
+def idsToWHEREClause(id_field_name, param_name="ids"):
     """
     Return string that looks like:
-    (<id_field_name> = <id[0]> OR ... OR <id_field_name> = <id[n-1]>)
+    (<id_field_name> IN UNNEST(@ids))
+    The ids themselves are bound with idsQueryParams()
     """
+    return queryIN(id_field_name, param_name)
+
+
+def idsQueryParams(ids, param_name="ids"):
     if isinstance(ids, str):
         ids = [ids]
-
-    return """({})""".format(' OR '.join([f'{id_field_name} = "{ID}"' for ID in ids]))
+    return [ArrayQueryParameter(param_name, "STRING", list(ids))]
 
 
 def verifyDateString(dateString:str) -> bool:
@@ -688,14 +796,98 @@ def argParseRadiusArgs(r:float, c:str):
         raise
 
 
-def queryOR(field, values):
-    '''{field} = "{value[0]}" OR {field} = "{value[1]}" OR ...'''
-    conds = [f'{field} = "{value}"' for value in values]
-    combined = "(" + " OR ".join(conds) + ")"
-    return combined
+def argParseStream(stream:str):
+    """
+    Parse the 'stream' argument. Returns None (don't stream),
+    "json" or "ndjson". 'stream=true' means "json".
+    """
+    if stream is None:
+        return stream
+
+    stream = stream.lower()
+    if stream in ("false", "0", "no"):
+        return None
+    if stream in ("true", "1", "yes"):
+        return "json"
+    if stream in ("json", "ndjson"):
+        return stream
+    raise ArgumentError("Argument 'stream' must be one of: true, false, json, ndjson", status_code=400)
+
+
+def argParseFormat(fmt:str, formats:list):
+    """Parse the 'format' argument against the list of available output formats"""
+    if fmt is None:
+        return fmt
+
+    fmt = fmt.lower()
+    if fmt not in formats:
+        raise ArgumentError(f"Argument 'format' must be one of: {', '.join(formats)}", status_code=400)
+    return fmt
+
+
+def argParseLimit(limit:int):
+    """Rows per page for paginated /requestData"""
+    if limit is None:
+        return limit
+
+    if not (0 < limit <= PAGE_LIMIT_MAX):
+        raise ArgumentError(f"Argument 'limit' must be an integer between 1 and {PAGE_LIMIT_MAX}", status_code=400)
+    return limit
+
+
+def argParsePage(page:int):
+    if page is None:
+        return 0
+
+    if page < 0:
+        raise ArgumentError("Argument 'page' must be a non-negative integer", status_code=400)
+    return page
+
+
+AGG_INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def argParseAgg(agg:str):
+    """
+    Parse the 'agg' (time bucket) argument into seconds.
+    Accepts a number with a unit, e.g. '30s', '5m', '1h', '1d', or plain seconds.
+    """
+    if agg is None:
+        return agg
+
+    m = re.match(r'^(\d+)([smhd]?)$', agg.strip().lower())
+    if not m:
+        raise ArgumentError("Argument 'agg' must look like 30s, 5m, 1h or 1d", status_code=400)
+    seconds = int(m.group(1)) * AGG_INTERVAL_UNITS[m.group(2) or 's']
+    if not (0 < seconds <= 31 * 86400):
+        raise ArgumentError("Argument 'agg' must be between 1 second and 31 days", status_code=400)
+    return seconds
+
+
+def argParseAggFn(fn:str, agg:int, fns:list):
+    """Parse the 'fn' argument. Only valid together with 'agg'; defaults to 'mean'"""
+    if fn is None:
+        return "mean" if agg else None
+
+    if not agg:
+        raise ArgumentError("Argument 'fn' requires 'agg'", status_code=400)
+    fn = fn.lower()
+    if fn not in fns:
+        raise ArgumentError(f"Argument 'fn' must be one of: {', '.join(fns)}", status_code=400)
+    return fn
+
+
+def queryIN(field, param_name):
+    '''({field} IN UNNEST(@{param_name})), values bound as an ARRAY parameter'''
+    return f"({field} IN UNNEST(@{param_name}))"
 
 
 def queryBuildFields(fields):
+    return _queryBuildFields(tuple(fields))
+
+
+@functools.lru_cache(maxsize=256)
+def _queryBuildFields(fields):
     # Build the 'fields' portion of query
     q_fields = f"""{FIELD_MAP["DEVICEID"]}, 
                    {FIELD_MAP["TIMESTAMP"]},
@@ -708,6 +900,25 @@ def queryBuildFields(fields):
     return q_fields
 
 
+def columnKinds(fields, fn=None):
+    """
+    Type of every column queryBuildFields(fields) returns, for encoders that
+    need a fixed schema (streaming.genParquet). 'fn' is the aggregate function, if any.
+    """
+    kinds = {
+        FIELD_MAP["DEVICEID"]:  "string",
+        FIELD_MAP["TIMESTAMP"]: "timestamp",
+        FIELD_MAP["SOURCE"]:    "string",
+        FIELD_MAP["LABEL"]:     "string",
+        "Latitude":             "float",
+        "Longitude":            "float",
+    }
+    # Numeric fields; anything else (e.g. GPS) is left for the encoder to infer
+    numeric = set(VALID_QUERY_FIELDS.values())
+    kinds.update({FIELD_MAP[f]: "int" if fn == "count" else "float" for f in fields if FIELD_MAP[f] in numeric})
+    return kinds
+
+
 # def queryBuildSources(srcs, query_template):
 #     """
 #     turns a list of bigquery table names and a query
@@ -723,24 +934,74 @@ def queryBuildFields(fields):
 #     return tbl_union
 
 
+def queryLabelMode(labels):
+    """
+    Which shape of label predicate 'labels' needs. Everything but an explicit
+    list of labels ("labels") is a fixed predicate with no parameters.
+    """
+    for mode in ("all", "allgps", "tetrad", "purpleair", "aqandu"):
+        if mode in labels:
+            return mode
+    return "labels"
+
+
 def queryBuildLabels(labels):
     """
     Special cases for "all" and "allgps"
-    TODO: Add special cases for "tetrad", "aqandu", "purpleair" as well
+    Explicit label lists are bound with queryLabelParams()
     """
-    if "all" in labels:
+    return queryBuildLabelMode(queryLabelMode(labels))
+
+
+@functools.lru_cache(maxsize=None)
+def queryBuildLabelMode(mode):
+    if mode == "all":
         return "True"
+    elif mode == "allgps":
+        # Parenthesized as a whole: the templates splice it in front of "AND Timestamp >= @start AND ..."
+        return (f'((Source != "PurpleAir") AND (IFNULL(Label, "") != "badgps" AND {REGIONS.sql})'
+                ' OR (Label = "global" AND Source != "PurpleAir"))')
+    elif mode == "tetrad":
+        return 'Source = "Tetrad"'
+    elif mode == "purpleair":
+        return 'Source = "PurpleAir"'
+    elif mode == "aqandu":
+        return 'Source = "AQ&U"'
+    else:
+        return queryIN("Label", "labels")
+
+
+def queryLabelParams(labels):
+    if queryLabelMode(labels) == "labels":
+        return [ArrayQueryParameter("labels", "STRING", list(labels))]
+    return []
+
+
+def rowMatchesLabels(row, labels):
+    """
+    In-process equivalent of queryBuildLabels(), for rows that
+    have already been pulled out of BigQuery (dicts from queryBuildFields)
+    """
+    src = row.get(FIELD_MAP["SOURCE"])
+    lbl = row.get(FIELD_MAP["LABEL"])
+    if "all" in labels:
+        return True
     elif "allgps" in labels:
-        regions = [k for k in REGION_INFO.values() if k['enabled']]
-        return f'(Source != "PurpleAir") AND (IFNULL(Label, "") != "badgps" AND {queryBuildMultipleRegions(regions)}) OR (Label = "global" AND Source != "PurpleAir")'
+        if src is None or src == "PurpleAir":
+            return False
+        if lbl == "global":
+            return True
+        if lbl == "badgps":
+            return False
+        return REGIONS.contains(row.get("Latitude"), row.get("Longitude"))
     elif "tetrad" in labels:
-        return 'Source = "Tetrad"'
+        return src == "Tetrad"
     elif "purpleair" in labels:
-        return 'Source = "PurpleAir"'
+        return src == "PurpleAir"
     elif "aqandu" in labels:
-        return 'Source = "AQ&U"'
+        return src == "AQ&U"
     else:
-        return queryOR("Label", labels)
+        return lbl in labels
 
 
 def queryBuildMultipleRegions(region_list):
@@ -748,24 +1009,20 @@ def queryBuildMultipleRegions(region_list):
     Build multiple bounding boxes for a BigQuery query.
     structure is: (<inside box> OR <inside box> OR ...)
     region_list: {'lat_lo': <>, 'lat_hi': <>, 'lon_lo': <>, 'lon_hi': <>}
+    The enabled regions are precompiled in REGIONS.sql
     '''
-    region_q = []
-    for region in region_list:
-        s = queryBuildRegion(lat_hi=region['lat_hi'], lat_lo=region['lat_lo'], lon_hi=region['lon_hi'], lon_lo=region['lon_lo'])
-        region_q.append(s)
-    region_q = '(' + ' OR '.join(region_q) + ')'
-    return region_q
+    return regions.regionsSQL(region_list)
 
 
 def queryBuildRegion(lat_hi, lat_lo, lon_hi, lon_lo):
     '''
-    Build a bounding box for a BigQuery query
+    Build a bounding box for a BigQuery query, as lat/lon range
+    comparisons rather than an ST_WITHIN polygon
     '''
-    return f"""
-            ST_WITHIN(
-                {FIELD_MAP["GPS"]}, 
-                ST_GeogFromGeoJSON(
-                    '{{"type": "Polygon", "coordinates": [[[{lon_hi},{lat_hi}],[{lon_hi},{lat_lo}],[{lon_lo},{lat_lo}],[{lon_lo},{lat_hi}],[{lon_hi},{lat_hi}]]]}}'
-                )
-            )
-    """
\ No newline at end of file
+    return regions.regionSQL(lat_lo, lat_hi, lon_lo, lon_hi)
+
+
+# Last, so the listeners can't run before everything they touch is defined
+region_config.start()
+if correction_config is not None:
+    correction_config.start()
@@ -0,0 +1,155 @@
+"""
+App Engine warmup (/_ah/warmup).
+
+app.yaml enables 'inbound_services: warmup', so App Engine sends
+/_ah/warmup to each new instance before it gets traffic. The handler
+runs every registered step once per process: client creation, auth token
+fetches, TLS handshakes, config downloads, and starting the background
+caches that are cheap to keep running. That way the first real request
+doesn't pay for them. Each step is
+timed, and the timings are logged and served by /warmupStats, so cold-start
+regressions show up.
+
+Steps are registered with @step("name") and run in registration order. A
+failing step is recorded and skipped; it never fails the warmup.
+
+App Engine warms one gunicorn worker per instance, not all of them. With
+WARMUP_ON_START, every worker also runs the steps on a background thread as
+soon as it has loaded, and /_ah/warmup waits for that run to finish.
+
+The handler is WSGI middleware rather than a Flask route. Warmup requests
+arrive on the instance's own hostname, which doesn't match SERVER_NAME, so
+Flask's subdomain routing would never reach a route.
+"""
+import json
+from os import getenv
+import threading
+from time import perf_counter, time
+from tetrad.api_consts import *
+import logging
+
+
+_steps = []
+_lock = threading.Lock()
+LAST_RUN = None
+
+
+def step(name):
+    """Register a warmup step"""
+    def register(fn):
+        _steps.append((name, fn))
+        return fn
+    return register
+
+
+def run(force=False):
+    """
+    Run every step (once per process unless 'force').
+    Returns {'started': epoch seconds, 'total_ms': .., 'steps': [{name, ms, ok, error}]}
+    """
+    global LAST_RUN
+    with _lock:
+        if LAST_RUN is not None and not force:
+            return LAST_RUN
+
+        started = time()
+        t_all = perf_counter()
+        results = []
+        for name, fn in _steps:
+            t0 = perf_counter()
+            try:
+                fn()
+                results.append({'step': name, 'ms': round((perf_counter() - t0) * 1000, 1), 'ok': True})
+            except Exception as e:
+                results.append({'step': name, 'ms': round((perf_counter() - t0) * 1000, 1), 'ok': False,
+                                'error': repr(e)})
+                logging.error(f"Warmup step '{name}' failed: {repr(e)}")
+
+        LAST_RUN = {
+            'started': started,
+            'total_ms': round((perf_counter() - t_all) * 1000, 1),
+            'steps': results,
+        }
+        logging.info("Warmup: " + json.dumps(LAST_RUN))
+        return LAST_RUN
+
+
+class WarmupMiddleware:
+    """Answers /_ah/warmup before Flask routing; everything else passes through"""
+
+    def __init__(self, wsgi_app, path="/_ah/warmup"):
+        self.wsgi_app = wsgi_app
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != self.path:
+            return self.wsgi_app(environ, start_response)
+        body = json.dumps(run()).encode()
+        start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+        return [body]
+
+
+def install(app):
+    app.wsgi_app = WarmupMiddleware(app.wsgi_app)
+    if WARMUP_ON_START:
+        threading.Thread(target=run, name="warmup", daemon=True).start()
+
+
+#################################
+# Steps
+#################################
+
+@step("region_info")
+def _regionInfo():
+    from tetrad import utils
+    utils.region_config.wait()
+
+
+@step("bigquery")
+def _bigquery():
+    # Auth token, TLS and the HTTP connection pool. A query without a table bills nothing.
+    from tetrad.bq_utils import bq_client
+    list(bq_client.query("SELECT 1").result())
+
+
+@step("bigquery_storage")
+def _bigqueryStorage():
+    from tetrad import columnar
+    if BQ_FETCH_ENGINE == "arrow" and columnar.available():
+        columnar.getBQStorageClient()
+
+
+@step("firestore")
+def _firestore():
+    from tetrad import admin_utils
+    list(admin_utils.fs_client.collection(getenv('FS_USER_GROUPS_COLLECTION')).limit(1).stream())
+
+
+@step("secret_manager")
+def _secretManager():
+    from tetrad import admin_utils
+    admin_utils._access_secret_version(getenv("FB_CONFIG_SECRET"))
+
+
+@step("gcs")
+def _gcs():
+    from tetrad import admin_utils
+    admin_utils._gsClient().get_bucket(getenv("GS_BUCKET_OTA"))
+
+
+@step("correction_factors")
+def _correctionFactors():
+    from tetrad import utils
+    if utils.correction_config is not None:
+        utils.correction_config.wait()
+    utils.correctionFactors()
+
+
+@step("background_caches")
+def _backgroundCaches():
+    # Only the live snapshot: its refresh is a small incremental query. The
+    # telemetry buffer and device index scan hours to days of telemetry on
+    # every refresh, in every worker that runs them, so they start on first
+    # use (/requestData) rather than in all workers of every instance.
+    from tetrad import api_routes
+    api_routes.live_snapshot.start()
@@ -0,0 +1,64 @@
+"""
+Compare rows/second of the two BigQuery fetch engines on a real /requestData query.
+
+    python tools/bench_fetch.py --src slc_ut --field pm2_5 \
+        --start 2021-01-01T00:00:00Z --end 2021-01-08T00:00:00Z
+
+Needs the same environment as the app (app.yaml env_variables + GCP credentials).
+The query runs once up front; each engine then re-issues it and gets BigQuery's
+cached result, so mostly the fetch/convert/clean cost is measured.
+"""
+import argparse
+import os
+import sys
+from time import perf_counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def timeit(label, fn, n_rows):
+    t0 = perf_counter()
+    out = fn()
+    dt = perf_counter() - t0
+    print(f"{label:<28} {n_rows:>10} rows  {dt:8.3f} s  {n_rows / dt:>12,.0f} rows/s")
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--src', default='all')
+    ap.add_argument('--field', default='pm2_5')
+    ap.add_argument('--start', required=True)
+    ap.add_argument('--end', required=True)
+    args = ap.parse_args()
+
+    # Importing tetrad starts the app (clients, GCS config), so only once the arguments are good
+    sys.path.insert(0, ROOT)
+    from tetrad import utils, columnar, streaming
+    from tetrad.api_routes import _requestDataRows
+
+    srcs = utils.argParseSources(args.src)
+    fields = utils.argParseFields(args.field)
+    start = utils.argParseDatetime(args.start)
+    end = utils.argParseDatetime(args.end)
+
+    n = _requestDataRows(srcs, fields, start, end).total_rows
+
+    def dict_path():
+        rows = _requestDataRows(srcs, fields, start, end)
+        data = [r for page in streaming.iterPages(rows) for r in page]
+        return utils.tuneAllFields(data, fields)
+
+    def arrow_path():
+        rows = _requestDataRows(srcs, fields, start, end)
+        return [r for page in columnar.iterColumnPages(rows, fields=fields, tune=True) for r in page]
+
+    timeit("rows  (Row -> dict, tune)", dict_path, n)
+    if columnar.available():
+        timeit("arrow (batches, tune)", arrow_path, n)
+    else:
+        print("arrow engine unavailable: pip install pyarrow google-cloud-bigquery-storage")
+
+
+if __name__ == '__main__':
+    main()
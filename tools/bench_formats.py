@@ -0,0 +1,66 @@
+"""
+Bytes on the wire and encode time for each /requestData output format.
+
+    python tools/bench_formats.py --rows 200000 --page-size 10000
+
+Uses synthetic rows shaped like a PM2.5 pull (DeviceID, Timestamp, Source,
+Label, Latitude, Longitude, PM2_5). tetrad/streaming.py is loaded on its own,
+so no GCP credentials or app environment are needed.
+"""
+import argparse
+from datetime import datetime, timedelta
+import importlib.util
+import os
+import random
+from time import perf_counter
+
+import pytz
+
+
+def loadStreaming():
+    path = os.path.join(os.path.dirname(__file__), '..', 'tetrad', 'streaming.py')
+    spec = importlib.util.spec_from_file_location('streaming', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def syntheticRows(n, n_devices=500):
+    t0 = datetime(2021, 1, 1, tzinfo=pytz.utc)
+    devices = [f"{random.getrandbits(48):012X}" for _ in range(n_devices)]
+    return [
+        {
+            'DeviceID': devices[i % n_devices],
+            'Timestamp': t0 + timedelta(seconds=2 * i),
+            'Source': 'Tetrad',
+            'Label': 'slc_ut',
+            'Latitude': 40.7 + random.random() * 0.2,
+            'Longitude': -111.9 + random.random() * 0.2,
+            'PM2_5': round(random.random() * 40, 2),
+        }
+        for i in range(n)
+    ]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--rows', type=int, default=200000)
+    ap.add_argument('--page-size', type=int, default=10000)
+    args = ap.parse_args()
+
+    streaming = loadStreaming()
+    rows = syntheticRows(args.rows)
+    pages = [rows[i:i + args.page_size] for i in range(0, len(rows), args.page_size)]
+
+    print(f"{'format':<10} {'bytes':>14} {'bytes/row':>10} {'encode s':>10} {'rows/s':>12}")
+    for fmt in streaming.availableFormats():
+        t0 = perf_counter()
+        nbytes = 0
+        for chunk in streaming.STREAM_ENCODERS[fmt](iter(pages)):
+            nbytes += len(chunk.encode() if isinstance(chunk, str) else chunk)
+        dt = perf_counter() - t0
+        print(f"{fmt:<10} {nbytes:>14,} {nbytes / len(rows):>10.1f} {dt:>10.3f} {len(rows) / dt:>12,.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Per-row 'math' haversine vs. tetrad/geometry.py on the same points.
+
+    python tools/bench_geometry.py --points 1000000
+
+Times the radius filter both ways (and the box mask), and checks that the
+vectorized distances match the per-row ones. tetrad/geometry.py is loaded on
+its own, so no GCP credentials or app environment are needed.
+"""
+import argparse
+import importlib.util
+import math
+import os
+from time import perf_counter
+
+import numpy as np
+
+
+def loadGeometry():
+    path = os.path.join(os.path.dirname(__file__), '..', 'tetrad', 'geometry.py')
+    spec = importlib.util.spec_from_file_location('geometry', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def distBetweenCoordsRowwise(p1, p2):
+    """utils.distBetweenCoords as it was: one pair at a time with 'math'"""
+    R = 6371
+    phi1 = p1[0] * (math.pi / 180)
+    phi2 = p2[0] * (math.pi / 180)
+    del1 = (p2[0] - p1[0]) * (math.pi / 180)
+    del2 = (p2[1] - p1[1]) * (math.pi / 180)
+    a = math.sin(del1 / 2) * math.sin(del1 / 2) + \
+        math.cos(phi1) * math.cos(phi2) * \
+        math.sin(del2 / 2) * math.sin(del2 / 2)
+    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = perf_counter()
+        out = fn()
+        best = min(best, perf_counter() - t0)
+    return out, best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--points', type=int, default=1000000)
+    ap.add_argument('--radius', type=float, default=10.0)
+    ap.add_argument('--repeat', type=int, default=3)
+    args = ap.parse_args()
+
+    geometry = loadGeometry()
+    rng = np.random.default_rng(0)
+    lat = 40.5 + rng.random(args.points) * 0.5
+    lon = -112.0 + rng.random(args.points) * 0.5
+    center = (40.75, -111.75)
+    lat_ls, lon_ls = lat.tolist(), lon.tolist()
+
+    rowwise, t_row = timed(lambda: [distBetweenCoordsRowwise((a, b), center) <= args.radius
+                                    for a, b in zip(lat_ls, lon_ls)], 1)
+    vector, t_vec = timed(lambda: geometry.radiusMask(lat, lon, args.radius, *center), args.repeat)
+    _, t_box = timed(lambda: geometry.bboxMask(lat, lon, 40.6, 40.9, -111.9, -111.6), args.repeat)
+
+    sample = slice(0, min(args.points, 100000))
+    d_row = np.array([distBetweenCoordsRowwise((a, b), center) for a, b in zip(lat_ls[sample], lon_ls[sample])])
+    d_vec = geometry.haversineKm(lat[sample], lon[sample], *center)
+
+    print(f"points:            {args.points:,}")
+    print(f"row-wise radius:   {t_row:8.3f} s  {args.points / t_row:>14,.0f} points/s")
+    print(f"numpy radius:      {t_vec:8.3f} s  {args.points / t_vec:>14,.0f} points/s  ({t_row / t_vec:.0f}x)")
+    print(f"numpy bbox:        {t_box:8.3f} s  {args.points / t_box:>14,.0f} points/s")
+    print(f"same mask:         {bool(np.array_equal(np.array(rowwise), vector))}")
+    print(f"max |d| difference {np.max(np.abs(d_row - d_vec)):.3e} km")
+
+
+if __name__ == '__main__':
+    main()
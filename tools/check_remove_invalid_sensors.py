@@ -0,0 +1,175 @@
+"""
+Parity check of tetrad/sensor_qc.py against the original per-row removeInvalidSensors.
+
+    python tools/check_remove_invalid_sensors.py
+    python tools/check_remove_invalid_sensors.py --rows 1000000
+    python tools/check_remove_invalid_sensors.py --record
+
+Runs both versions on the recorded fixture (tools/fixtures/remove_invalid_sensors.json)
+and exits nonzero unless they keep exactly the fixture's rows, in order. With
+--rows it also compares and times them on that many synthetic rows. --record
+regenerates the fixture with the original version. The fixture covers
+readings right at MST midnight, days averaging exactly 350, neighbouring-day
+removal, and summer (MDT) dates.
+
+tetrad/sensor_qc.py is loaded on its own, so no GCP credentials or app
+environment are needed.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone as dt_timezone
+from time import perf_counter
+
+import numpy as np
+from pytz import timezone
+
+HERE = os.path.dirname(__file__)
+FIXTURE = os.path.join(HERE, 'fixtures', 'remove_invalid_sensors.json')
+
+
+def loadSensorQC():
+    path = os.path.join(HERE, '..', 'tetrad', 'sensor_qc.py')
+    spec = importlib.util.spec_from_file_location('sensor_qc', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def removeInvalidSensorsRowwise(sensor_data):
+    """utils.removeInvalidSensors as it was (minus the print)"""
+    epoch = datetime(1970, 1, 1)
+    epoch = timezone('US/Mountain').localize(epoch)
+    dayCounts = {}
+    dayReadings = {}
+
+    for datum in sensor_data:
+        pm25 = datum['PM2_5']
+        datum['daysSinceEpoch'] = (datum['Timestamp'] - epoch).days
+        key = (datum['daysSinceEpoch'], datum['DeviceID'])
+        if key in dayCounts:
+            dayCounts[key] += 1
+            dayReadings[key] += pm25
+        else:
+            dayCounts[key] = 1
+            dayReadings[key] = pm25
+
+    keysToRemove = [key for key in dayCounts if (dayReadings[key] / dayCounts[key]) > 350]
+    keysToRemoveSet = set()
+    for key in keysToRemove:
+        keysToRemoveSet.add(key)
+        keysToRemoveSet.add((key[0] + 1, key[1]))
+        keysToRemoveSet.add((key[0] - 1, key[1]))
+
+    return [datum for datum in sensor_data if (datum['daysSinceEpoch'], datum['DeviceID']) not in keysToRemoveSet]
+
+
+def syntheticRows(n, rng, n_devices=12, n_days=10, t0=datetime(2021, 1, 4, tzinfo=dt_timezone.utc)):
+    devices = [f"{i:012X}" for i in rng.choice(2 ** 40, n_devices, replace=False)]
+    mst_midnight = 7 * 3600
+    rows = []
+    for _ in range(n):
+        day = int(rng.integers(n_days))
+        r = rng.random()
+        if r < 0.05:
+            sec = mst_midnight + int(rng.choice([-1, 0, 1]))                # right at the day boundary
+        elif r < 0.07:
+            sec = mst_midnight - 1e-6 * float(rng.integers(1, 3))           # a microsecond before it
+        else:
+            sec = float(rng.uniform(0, 86400))
+        rows.append({
+            'Timestamp': t0 + timedelta(days=day, seconds=sec),
+            'DeviceID': devices[int(rng.integers(n_devices))],
+            'PM2_5': float(np.round(rng.gamma(2.0, 8.0), 2)),
+        })
+
+    # Polluted (device, day)s: spikes, plus one day that averages exactly 350 (kept: the test is '> 350')
+    for dev in devices[:3]:
+        day = int(rng.integers(n_days))
+        for r in rows:
+            if r['DeviceID'] == dev and (r['Timestamp'] - t0 - timedelta(seconds=mst_midnight)).days == day:
+                r['PM2_5'] = float(np.round(rng.uniform(300, 900), 2))
+    edge_day = t0 + timedelta(days=n_days // 2, hours=12)
+    rows += [{'Timestamp': edge_day + timedelta(minutes=m), 'DeviceID': devices[-1], 'PM2_5': v}
+             for m, v in ((0, 300.0), (5, 400.0))]
+    rows.sort(key=lambda r: r['Timestamp'])
+    return rows
+
+
+def toJSON(rows):
+    return [{'Timestamp': r['Timestamp'].isoformat(), 'DeviceID': r['DeviceID'], 'PM2_5': r['PM2_5']} for r in rows]
+
+
+def fromJSON(rows):
+    return [{'Timestamp': datetime.fromisoformat(r['Timestamp']), 'DeviceID': r['DeviceID'], 'PM2_5': r['PM2_5']}
+            for r in rows]
+
+
+def keptIndices(rows, kept):
+    ids = {id(r): i for i, r in enumerate(rows)}
+    return [ids[id(r)] for r in kept]
+
+
+def record(rng):
+    # A summer stretch too, so MDT dates go through the fixed-MST day boundaries
+    rows = syntheticRows(1200, rng) + syntheticRows(400, rng, t0=datetime(2021, 7, 5, tzinfo=dt_timezone.utc))
+    kept = keptIndices(rows, removeInvalidSensorsRowwise(rows))
+    os.makedirs(os.path.dirname(FIXTURE), exist_ok=True)
+    with open(FIXTURE, 'w') as f:
+        json.dump({'rows': toJSON(rows), 'kept': kept}, f, separators=(',', ':'))
+    print(f"recorded {len(rows)} rows, {len(kept)} kept -> {FIXTURE}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--record', action='store_true')
+    ap.add_argument('--rows', type=int, default=0, help='also compare/time on this many synthetic rows')
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.record:
+        record(rng)
+        return
+
+    sensor_qc = loadSensorQC()
+    with open(FIXTURE) as f:
+        fixture = json.load(f)
+    rows = fromJSON(fixture['rows'])
+
+    ok = True
+    for name, fn in (('row-wise', removeInvalidSensorsRowwise), ('sensor_qc', sensor_qc.removeInvalidSensors)):
+        kept = keptIndices(rows, fn(rows))
+        same = kept == fixture['kept']
+        ok &= same
+        print(f"fixture {name:<10} {len(rows)} rows -> {len(kept)} kept  matches recording: {same}")
+
+    if args.rows:
+        big = syntheticRows(args.rows, rng, n_devices=200, n_days=30)
+        t = perf_counter()
+        ref = keptIndices(big, removeInvalidSensorsRowwise(big))
+        t_row = perf_counter() - t
+        t = perf_counter()
+        new = keptIndices(big, sensor_qc.removeInvalidSensors(big))
+        t_vec = perf_counter() - t
+        ok &= ref == new
+        print(f"synthetic  {args.rows:,} rows  row-wise {t_row:.3f} s  sensor_qc {t_vec:.3f} s "
+              f"({t_row / t_vec:.1f}x)  same rows: {ref == new}")
+
+        # The same data already in columns (no dict/datetime unpacking), as columnar callers have it
+        ts = np.array([r['Timestamp'].timestamp() for r in big])
+        dev = [r['DeviceID'] for r in big]
+        pm = np.array([r['PM2_5'] for r in big])
+        t = perf_counter()
+        keep = sensor_qc.validMask(ts, dev, pm)
+        t_mask = perf_counter() - t
+        ok &= np.flatnonzero(keep).tolist() == ref
+        print(f"columns    {args.rows:,} rows  validMask {t_mask:.3f} s ({t_row / t_mask:.0f}x)")
+
+    print("OK" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Cold-import profile of the 'tetrad' package, with a time budget.
+
+    python tools/import_profile.py --budget-ms 4000
+    python tools/import_profile.py --top 30 --json import_profile.json
+
+Runs 'import tetrad' in a fresh interpreter under '-X importtime' (what every
+gunicorn worker pays at startup) and prints the slowest modules by
+cumulative and by self time. Exits nonzero if
+  - the cumulative import time of 'tetrad' is over --budget-ms, or
+  - any --forbid module (default: torch, scipy) was imported;
+those have to stay behind lazy_import.lazyModule().
+
+Runs offline, so the number is import cost only and the check can run in CI:
+app.yaml env_variables are used as defaults, WARMUP_ON_START=0, the GCP
+client constructors (BigQuery, Storage, Firestore, Cloud Logging,
+firebase_admin.initialize_app) are replaced with inert stand-ins and GCS
+config loading is not started. The client modules are still imported and
+their import time is counted; nothing talks to the network.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# Printed by the probe once its own imports are done; earlier importtime lines are not counted
+_PROBE_START = 'import_profile: probe start\n'
+
+
+class _Offline:
+    """Stands in for a GCP client: takes any arguments, every attribute or call gives another _Offline"""
+    project = 'offline'
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return _Offline()
+
+    def __call__(self, *args, **kwargs):
+        return _Offline()
+
+    def get_default_handler(self, *args, **kwargs):
+        import logging
+        return logging.NullHandler()
+
+
+def _noStart(self):
+    pass
+
+
+# module -> patch applied right after the module has executed, before anything imports from it
+_OFFLINE_PATCHES = {
+    'google.cloud.bigquery': lambda m: setattr(m, 'Client', _Offline),
+    'google.cloud.storage': lambda m: setattr(m, 'Client', _Offline),
+    'google.cloud.firestore': lambda m: setattr(m, 'Client', _Offline),
+    'google.cloud.logging': lambda m: setattr(m, 'Client', _Offline),
+    'firebase_admin': lambda m: setattr(m, 'initialize_app', _Offline),
+    'tetrad.gcs_config': lambda m: setattr(m.GCSConfig, 'start', _noStart),
+}
+
+
+class _PatchOnImport:
+    """Applies _OFFLINE_PATCHES as the modules are imported, so their import time stays where it belongs"""
+
+    def find_spec(self, name, path, target=None):
+        patch = _OFFLINE_PATCHES.get(name)
+        if patch is None:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        exec_module = spec.loader.exec_module
+
+        def patchedExec(module):
+            exec_module(module)
+            patch(module)
+        spec.loader.exec_module = patchedExec
+        return spec
+
+
+def appEnv():
+    """app.yaml env_variables, as strings"""
+    import yaml
+    with open(os.path.join(ROOT, 'app.yaml')) as f:
+        env = yaml.safe_load(f).get('env_variables') or {}
+    return {k: str(v) for k, v in env.items()}
+
+
+def probe(module, forbid):
+    """Child process: import 'module' offline and print the forbidden modules it pulled in (as JSON)"""
+    sys.meta_path.insert(0, _PatchOnImport())
+    sys.path.insert(0, ROOT)
+    sys.stderr.write(_PROBE_START)
+    sys.stderr.flush()
+    __import__(module)  # not importlib.import_module: -X importtime only times the import statement path
+    print(json.dumps([m for m in forbid if m in sys.modules]))
+
+
+def profileImport(module, forbid, repeat):
+    """Best of 'repeat' runs: ({module: (self_us, cumulative_us)}, [forbidden modules imported])"""
+    env = {**appEnv(), **os.environ, 'WARMUP_ON_START': '0'}
+    cmd = [sys.executable, '-X', 'importtime', os.path.abspath(__file__),
+           '--probe', module, '--forbid', ','.join(forbid)]
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.run(cmd, cwd=ROOT, env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            sys.stderr.write(proc.stderr)
+            raise SystemExit(f"'import {module}' failed")
+        timings = parseImportTime(proc.stderr)
+        if best is None or timings[module][1] < best[0][module][1]:
+            best = (timings, json.loads(proc.stdout.strip().splitlines()[-1]))
+    return best
+
+
+def parseImportTime(stderr):
+    """'import time: self [us] | cumulative | imported package' lines -> {module: (self_us, cumulative_us)}"""
+    timings = {}
+    stderr = stderr[stderr.find(_PROBE_START) + len(_PROBE_START):] if _PROBE_START in stderr else stderr
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--module', default='tetrad')
+    ap.add_argument('--budget-ms', type=float, default=float(os.getenv('IMPORT_BUDGET_MS', 4000)))
+    ap.add_argument('--forbid', default='torch,scipy', help='comma separated; empty to allow all')
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--top', type=int, default=20)
+    ap.add_argument('--json', help='also write the full per-module timings here')
+    ap.add_argument('--probe', metavar='MODULE', help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    forbid = [m for m in args.forbid.split(',') if m]
+    if args.probe:
+        return probe(args.probe, forbid)
+    timings, imported = profileImport(args.module, forbid, args.repeat)
+    total_ms = timings[args.module][1] / 1000
+
+    def table(title, items, key):
+        print(title)
+        for name, (s, c) in sorted(items, key=key, reverse=True)[:args.top]:
+            print(f"  {c / 1000:9.1f} ms cum  {s / 1000:9.1f} ms self  {name}")
+
+    own = [kv for kv in timings.items() if kv[0] == args.module or kv[0].startswith(args.module + '.')]
+    table(f"slowest modules by cumulative time (best of {args.repeat}):", timings.items(), lambda kv: kv[1][1])
+    table("slowest modules by self time:", timings.items(), lambda kv: kv[1][0])
+    table(f"{args.module} modules by cumulative time:", own, lambda kv: kv[1][1])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'module': args.module, 'total_ms': total_ms, 'forbidden_imported': imported,
+                       'modules': {k: {'self_us': s, 'cumulative_us': c} for k, (s, c) in timings.items()}},
+                      f, indent=2)
+
+    failed = False
+    print(f"\nimport {args.module}: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    if total_ms > args.budget_ms:
+        print(f"FAIL: over budget by {total_ms - args.budget_ms:.1f} ms")
+        failed = True
+    if imported:
+        print(f"FAIL: imported at startup: {', '.join(imported)} (load these through lazy_import.lazyModule)")
+        failed = True
+    if not failed:
+        print("OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()